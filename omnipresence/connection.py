@@ -2,7 +2,7 @@
 """Core IRC connection protocol class and supporting machinery."""
 
 
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple, OrderedDict
 import re
 from weakref import WeakSet
 
@@ -10,8 +10,9 @@ from twisted.internet import reactor
 from twisted.internet.defer import (DeferredList, maybeDeferred,
                                     inlineCallbacks, returnValue)
 from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
-from twisted.words.protocols.irc import IRCClient
+from twisted.words.protocols.irc import IRCClient, split
 
 from . import __version__, __source__
 from .case_mapping import CaseMapping, CaseMappedDict
@@ -24,8 +25,38 @@ from .plugin import UserVisibleError
 from .settings import ConnectionSettings, PRIVATE_CHANNEL
 
 
-#: The maximum length of a single command reply, in bytes.
-MAX_REPLY_LENGTH = 288
+#: The maximum length of an IRC protocol line, in bytes, including the
+#: trailing CR-LF.  Servers may advertise a different limit using the
+#: ``LINELEN`` ISUPPORT feature.
+MAX_LINE_LENGTH = 512
+
+#: A worst-case reply tail, used to reserve space at the end of each
+#: line when chunking string command replies.
+CHUNK_TAIL = ' (+9999 more)'
+
+#: The default number of seconds that an idle reply buffer is kept
+#: before being discarded.
+REPLY_BUFFER_TTL = 3600
+
+#: The default maximum size of all reply buffers in a single venue, in
+#: bytes.
+REPLY_BUFFER_VENUE_LIMIT = 1048576
+
+#: The default maximum size of all reply buffers on a connection, in
+#: bytes.
+REPLY_BUFFER_TOTAL_LIMIT = 8388608
+
+#: The default number of lines that can be sent in a burst before flood
+#: control begins to delay outgoing lines.
+FLOOD_BURST = 5
+
+#: The default number of seconds needed to earn back one line of the
+#: flood control burst.
+FLOOD_INTERVAL = 2
+
+#: The default maximum number of outgoing lines that can be waiting for
+#: flood control before the oldest low-priority lines are dropped.
+FLOOD_QUEUE_LIMIT = 100
 
 
 class ConnectionBase(IRCClient, object):
@@ -71,6 +102,10 @@ class ConnectionBase(IRCClient, object):
         #: normal PING heartbeat.
         self.signon_timeout = None
 
+        #: The bot's own `.Hostmask` as seen by the server, or `None`
+        #: if it is not yet known.
+        self.hostmask = None
+
         self.log.info('Assuming default CASEMAPPING "rfc1459"')
         #: The `.CaseMapping` currently in effect on this connection.
         #: Defaults to ``rfc1459`` if none is explicitly provided by the
@@ -92,6 +127,19 @@ class ConnectionBase(IRCClient, object):
         """Convenience alias for ``self.case_mapping.upper``."""
         return self.case_mapping.upper(string)
 
+    def _numeric_feature(self, name, default):
+        """Return the integer value of the ISUPPORT feature *name*, or
+        *default* if the server has not advertised a valid one."""
+        value = self.supported.getFeature(name)
+        if isinstance(value, tuple):
+            # Twisted leaves features it doesn't know how to parse as
+            # tuples of their raw parameters.
+            value = value[0] if value else None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
     def is_channel(self, name):
         """Return `True` if *name* belongs to a channel, according to
         the server-provided list of channel prefixes, or `False`
@@ -105,6 +153,7 @@ class ConnectionBase(IRCClient, object):
     def connectionMade(self):
         """See `IRCClient.connectionMade`."""
         self.log.info('Connected to server')
+        self.hostmask = None
         super(ConnectionBase, self).connectionMade()
         self.signon_timeout = self.reactor.callLater(
             self.max_lag, self.signon_timed_out)
@@ -163,6 +212,20 @@ class ConnectionBase(IRCClient, object):
                     self.log.info('Using server-provided CASEMAPPING '
                                   '"{name}"', name=name)
 
+    def irc_JOIN(self, prefix, params):
+        # Our own joins tell us what the server thinks our hostmask is.
+        hostmask = Hostmask.from_string(prefix)
+        if self._lower(hostmask.nick) == self._lower(self.nickname):
+            self.hostmask = hostmask
+        super(ConnectionBase, self).irc_JOIN(prefix, params)
+
+    def irc_396(self, prefix, params):
+        # RPL_HOSTHIDDEN, sent by many servers when a cloak is applied.
+        if self.hostmask is not None and len(params) > 1:
+            user, _, host = params[1].rpartition('@')
+            self.hostmask = self.hostmask._replace(
+                user=user or self.hostmask.user, host=host)
+
     def privmsg(self, prefix, channel, message):
         """See `IRCClient.privmsg`."""
         if not self.is_channel(channel):
@@ -211,25 +274,62 @@ class ConnectionBase(IRCClient, object):
     # Command replies
     #
 
+    def _line_length(self):
+        """Return the maximum length of a line sent by the bot, not
+        including the message prefix added by the server."""
+        if self.hostmask and self.hostmask.user and self.hostmask.host:
+            user, host = self.hostmask.user, self.hostmask.host
+        else:
+            # Assume the worst until the server tells us otherwise.
+            user = 'x' * self._numeric_feature('USERLEN', 10)
+            host = 'x' * self._numeric_feature('HOSTLEN', 63)
+        prefix = ':{}!{}@{} '.format(self.nickname, user, host)
+        return (self._numeric_feature('LINELEN', MAX_LINE_LENGTH) -
+                len(prefix))
+
+    def _reply_format(self, request):
+        """Return the reply format in effect for *request*."""
+        return request.settings.get(
+            'reply_format', default='\x0314{target}: {message}')
+
+    def reply_length(self, request, tail=''):
+        """Return the number of bytes available for the content of a
+        reply to *request* with *tail* appended, after accounting for
+        the server's line length limit, the bot's own hostmask, the
+        reply target, and the venue's reply format."""
+        if request.private:
+            line = 'NOTICE {} :'.format(request.actor.nick)
+        else:
+            line = 'PRIVMSG {} :'.format(request.venue)
+            line += self._reply_format(request).format(
+                target=request.target, message='')
+        if isinstance(line, unicode):
+            line = line.encode(request.encoding)
+        return self._line_length() - len(line) - len('\r\n') - len(tail)
+
     def reply(self, string, request, tail=''):
-        """Send a reply *string*, truncated to `MAX_REPLY_LENGTH`
-        characters, with `tail` appended.  If the request venue is a
-        channel, send the reply to the venue as a standard message
-        addressed to *request*'s `~.Message.target`, formatted using the
+        """Send a reply *string*, truncated to fit on a single line,
+        with `tail` appended.  If the request venue is a channel, send
+        the reply to the venue as a standard message addressed to
+        *request*'s `~.Message.target`, formatted using the
         `~.Message.venue`'s reply format.  Otherwise, send the reply as
-        a notice to *request*'s `~.Message.actor`."""
+        a notice to *request*'s `~.Message.actor`.
+
+        The available space is given by `reply_length`."""
         if not string:
             return
         string = string.replace('\n', ' / ')
+        max_length = self.reply_length(request, tail=tail)
         if isinstance(string, unicode):
             encoding = request.encoding
-            truncated = truncate_unicode(string, MAX_REPLY_LENGTH, encoding)
-            if truncated != string:
-                truncated += u'...'
-            string = truncated.encode(encoding)
-        else:
-            if len(string) > MAX_REPLY_LENGTH:
-                string = string[:MAX_REPLY_LENGTH] + '...'
+            encoded = string.encode(encoding)
+            if len(encoded) > max_length:
+                encoded = truncate_unicode(
+                    string, max_length - len('...'), encoding
+                ).encode(encoding) + '...'
+            string = encoded
+        elif len(string) > max_length:
+            string = string[:max_length - len('...')] + '...'
         string += tail
         if request.private:
             self.log.info('Private reply for {request.actor.nick}: {string}',
@@ -238,10 +338,9 @@ class ConnectionBase(IRCClient, object):
             return
         self.log.info('Reply for {request.actor.nick} in {request.venue}: '
                       '{string}', request=request, string=string)
-        reply_format = request.settings.get(
-            'reply_format', default='\x0314{target}: {message}')
-        self.msg(request.venue, reply_format.format(
-            target=request.target, message=string))
+        self.msg(request.venue, self._reply_format(request).format(
+            target=request.target, message=string),
+                 length=self._line_length())
 
     def reply_from_error(self, failure, request):
         """Call `.reply` with information on a *failure* that occurred
@@ -267,6 +366,65 @@ class ConnectionBase(IRCClient, object):
                          failure=failure, request=request)
         self.reply(message + '.', error_request)
 
+    #
+    # Broadcasts
+    #
+
+    def broadcast(self, venues, string, notice=False, target=None):
+        """Send *string* to every venue in *venues*, as a notice if
+        *notice* is true or a standard message otherwise.  If *target*
+        is given, the string is addressed to that nickname using each
+        venue's reply format.  Unicode strings are encoded using each
+        venue's encoding.
+
+        Venues receiving identical text are addressed together in as few
+        lines as the server's ``TARGMAX`` feature allows."""
+        command = 'NOTICE' if notice else 'PRIVMSG'
+        payloads = OrderedDict()
+        for venue in venues:
+            msg = Message(self, False, command.lower(), venue=venue)
+            payload = string
+            if target is not None:
+                payload = self._reply_format(msg).format(
+                    target=target, message=payload)
+            if isinstance(payload, unicode):
+                payload = payload.encode(msg.encoding)
+            payloads.setdefault(payload, []).append(venue)
+        # Servers that don't advertise a limit for this command may not
+        # support multiple targets at all.
+        targmax = self.supported.getFeature('TARGMAX') or {}
+        limit = targmax.get(command, 1)
+        max_length = self._line_length() - len('\r\n')
+        for payload, group in payloads.iteritems():
+            batch = []
+            for venue in group:
+                candidate = batch + [venue]
+                # Adding a target is only a problem if it pushes a line
+                # that would otherwise fit past the maximum length.  If
+                # the payload has to be split anyway, keep going.
+                if batch and ((limit and len(candidate) > limit) or
+                              len(self._broadcast_line(
+                                  command, candidate, payload)) >
+                              max_length >=
+                              len(self._broadcast_line(
+                                  command, batch, payload))):
+                    self._send_broadcast(command, batch, payload)
+                    candidate = [venue]
+                batch = candidate
+            if batch:
+                self._send_broadcast(command, batch, payload)
+
+    def _broadcast_line(self, command, venues, payload):
+        """Return a line sending *payload* to *venues*."""
+        return '{} {} :{}'.format(command, ','.join(venues), payload)
+
+    def _send_broadcast(self, command, venues, payload):
+        """Send *payload* to *venues* in as many lines as it takes."""
+        max_length = (self._line_length() - len('\r\n') -
+                      len(self._broadcast_line(command, venues, '')))
+        for line in split(payload, max_length):
+            self.sendLine(self._broadcast_line(command, venues, line))
+
 
 #
 # State tracking
@@ -281,7 +439,7 @@ class VenueUserInfo(object):
 
     def __init__(self):
         #: This user's current channel reply buffer.
-        self.reply_buffer = []
+        self.reply_buffer = ReplyBuffer([])
 
 
 class VenueInfo(object):
@@ -458,8 +616,7 @@ class JoinSuspensionMixin(object):
         self.log.info('Resuming channel joins')
         suspended_joins = self.suspended_joins
         self.suspended_joins = None
-        for channel in suspended_joins:
-            self.join(channel)
+        self.join_channels(suspended_joins)
 
     def join(self, channel):
         """Join the given *channel*.  If joins have been suspended with
@@ -471,13 +628,596 @@ class JoinSuspensionMixin(object):
             return
         super(JoinSuspensionMixin, self).join(channel)
 
+    def join_channels(self, channels):
+        """See `JoinSchedulingMixin.join_channels`.  If joins have been
+        suspended with `.suspend_joins`, add the channels to the join
+        queue instead."""
+        if self.suspended_joins is not None:
+            channels = list(channels)
+            self.log.info('Adding {count} channels to join queue',
+                          count=len(channels))
+            self.suspended_joins.extend(channels)
+            return
+        super(JoinSuspensionMixin, self).join_channels(channels)
+
+
+#
+# Join scheduling
+#
+
+class JoinSchedulingMixin(object):
+    """A connection mixin that joins many channels at once by combining
+    them into as few JOIN lines as the server allows, sent no faster
+    than flood control allows."""
+
+    def __init__(self):
+        super(JoinSchedulingMixin, self).__init__()
+        #: An `OrderedDict` mapping lowercased names of channels waiting
+        #: to be joined by `join_channels` to their original names.
+        self.pending_joins = OrderedDict()
+        self.join_call = None
+        #: The number of channels sent and requested by `join_channels`
+        #: since it was last idle, for progress reporting.
+        self.join_progress = [0, 0]
+
+    def connectionLost(self, reason):
+        """See `IRCClient.connectionLost`."""
+        if self.join_call is not None and self.join_call.active():
+            self.join_call.cancel()
+        self.join_call = None
+        self.pending_joins.clear()
+        self.join_progress = [0, 0]
+        super(JoinSchedulingMixin, self).connectionLost(reason)
+
+    def join_channels(self, channels):
+        """Join every channel in the iterable *channels* that the bot is
+        not already in, combining them into JOIN lines within the
+        server's ``TARGMAX`` and line length limits.  Channels beyond
+        the server's ``CHANLIMIT`` are skipped."""
+        for channel in channels:
+            key = self._lower(channel)
+            if channel in self.venues or key in self.pending_joins:
+                continue
+            if self._channel_limit_reached(channel):
+                self.log.info('Not joining {channel}; channel limit '
+                              'reached', channel=channel)
+                continue
+            self.pending_joins[key] = channel
+            self.join_progress[1] += 1
+        if self.join_call is None:
+            self._send_joins()
+
+    def _channel_limit_reached(self, channel):
+        """Return `True` if joining *channel* in addition to any current
+        and pending channels would exceed the server's ``CHANLIMIT``."""
+        for prefixes, limit in self.supported.getFeature('CHANLIMIT', ()):
+            if not limit or channel[0] not in prefixes:
+                continue
+            channels = [name for name in self.venues
+                        if name and name[0] in prefixes]
+            channels.extend(name for name in self.pending_joins.itervalues()
+                            if name[0] in prefixes)
+            if len(channels) >= limit:
+                return True
+        return False
+
+    def _next_join_batch(self):
+        """Remove and return a list of the next channels to join in a
+        single line."""
+        limit = (self.supported.getFeature('TARGMAX') or {}).get('JOIN')
+        max_length = self._line_length() - len('\r\n')
+        batch = []
+        length = len('JOIN ')
+        for key, channel in self.pending_joins.items():
+            added = len(channel) + (1 if batch else 0)
+            if batch and ((limit and len(batch) >= limit) or
+                          length + added > max_length):
+                break
+            batch.append(channel)
+            length += added
+            del self.pending_joins[key]
+        return batch
+
+    def _send_joins(self):
+        """Send JOIN lines for pending channels while flood control
+        allows, and schedule another attempt if any channels remain."""
+        self.join_call = None
+        while self.pending_joins:
+            delay = self.flood_delay()
+            if delay > 0:
+                self.join_call = self.reactor.callLater(delay,
+                                                        self._send_joins)
+                return
+            batch = self._next_join_batch()
+            self.join_progress[0] += len(batch)
+            self.log.info('Joining {channels} ({sent}/{total})',
+                          channels=', '.join(batch),
+                          sent=self.join_progress[0],
+                          total=self.join_progress[1])
+            self.sendLine('JOIN ' + ','.join(batch))
+        self.join_progress = [0, 0]
+
+
+#
+# Reply buffer management
+#
+
+class ReplyBufferRecord(namedtuple('ReplyBufferRecord',
+                                   ('venue', 'buffer', 'last_used'))):
+    """A record of a live reply buffer, its venue, and its last access
+    time."""
+
+    @property
+    def size(self):
+        """The estimated number of bytes held by the buffer's remaining
+        replies."""
+        return self.buffer.size_hint()
+
+
+class ReplyBufferMixin(object):
+    """A connection mixin that bounds the lifetime and memory usage of
+    users' command reply buffers.
+
+    Buffers that have not been touched in ``reply_buffer_ttl`` seconds
+    are discarded, as are the least recently used buffers in a venue or
+    on the whole connection once their estimated sizes exceed
+    ``reply_buffer_venue_limit`` or ``reply_buffer_total_limit`` bytes,
+    respectively.  A user's buffers are also discarded when they part,
+    quit, or are kicked.
+    """
+
+    #: The number of seconds between sweeps for expired reply buffers.
+    reply_buffer_sweep_interval = 60
+
+    def __init__(self):
+        super(ReplyBufferMixin, self).__init__()
+        #: An `OrderedDict` mapping `VenueUserInfo` objects holding live
+        #: reply buffers to `ReplyBufferRecord` objects, from least to
+        #: most recently used.
+        self.reply_buffers = OrderedDict()
+        #: The `LoopingCall` that periodically expires reply buffers.
+        self.reply_buffer_sweeper = None
+
+    def set_reply_buffer(self, venue, nick, buf):
+        """Make the `.ReplyBuffer` *buf* the reply buffer for *nick* in
+        *venue*, then evict other reply buffers as necessary to stay
+        within the configured memory limits."""
+        venue_info = self.venues[venue]
+        venue_info.add_nick(nick)
+        user_info = venue_info.nicks[nick]
+        if user_info.reply_buffer is not buf:
+            user_info.reply_buffer.close()
+        user_info.reply_buffer = buf
+        self.reply_buffers.pop(user_info, None)
+        self.reply_buffers[user_info] = ReplyBufferRecord(
+            venue, buf, self.reactor.seconds())
+        self._evict_reply_buffers(venue, user_info)
+
+    def release_reply_buffer(self, user_info):
+        """Discard the reply buffer held by the `VenueUserInfo` object
+        *user_info*, if any."""
+        if self.reply_buffers.pop(user_info, None) is None:
+            return
+        user_info.reply_buffer.close()
+        user_info.reply_buffer = ReplyBuffer([])
+
+    def _release_venue(self, venue):
+        """Discard all reply buffers held in *venue*."""
+        venue_info = self.venues.get(venue)
+        if venue_info is None:
+            return
+        for user_info in venue_info.nicks.values():
+            self.release_reply_buffer(user_info)
+
+    def _release_nick(self, venue, nick):
+        """Discard the reply buffer held by *nick* in *venue*."""
+        venue_info = self.venues.get(venue)
+        if venue_info is None:
+            return
+        user_info = venue_info.nicks.get(nick)
+        if user_info is not None:
+            self.release_reply_buffer(user_info)
+
+    def _evict_reply_buffers(self, venue, keep):
+        """Evict the least recently used reply buffers, other than that
+        held by the `VenueUserInfo` object *keep*, until the total size
+        of those in *venue* and on this connection are under their
+        configured limits."""
+        venue_limit = self.settings.get_in_venue(
+            'reply_buffer_venue_limit', venue,
+            default=REPLY_BUFFER_VENUE_LIMIT)
+        total_limit = self.settings.get(
+            'reply_buffer_total_limit', default=REPLY_BUFFER_TOTAL_LIMIT)
+        venue_usage = self.reply_buffer_usage(venue)
+        total_usage = self.reply_buffer_usage()
+        for user_info, record in self.reply_buffers.items():
+            if venue_usage <= venue_limit and total_usage <= total_limit:
+                break
+            if user_info is keep:
+                continue
+            in_venue = self.case_mapping.equates(record.venue, venue)
+            if total_usage > total_limit or in_venue:
+                # Releasing the buffer empties it, so measure it first.
+                size = record.size
+                self.log.debug('Evicting {size}-byte reply buffer in '
+                               '{venue}', size=size, venue=record.venue)
+                self.release_reply_buffer(user_info)
+                total_usage -= size
+                if in_venue:
+                    venue_usage -= size
+
+    def expire_reply_buffers(self):
+        """Discard any reply buffers that have been idle for longer than
+        their venue's configured time-to-live."""
+        now = self.reactor.seconds()
+        for user_info, record in self.reply_buffers.items():
+            ttl = self.settings.get_in_venue('reply_buffer_ttl', record.venue,
+                                             default=REPLY_BUFFER_TTL)
+            if now - record.last_used > ttl:
+                self.release_reply_buffer(user_info)
+        self.log.debug('{count} reply buffers using {size} bytes',
+                       count=len(self.reply_buffers),
+                       size=self.reply_buffer_usage())
+
+    def reply_buffer_usage(self, venue=None):
+        """Return the estimated number of bytes held by live reply
+        buffers in *venue*, or on this connection if *venue* is not
+        given."""
+        return sum(record.size for record in self.reply_buffers.itervalues()
+                   if venue is None or
+                   self.case_mapping.equates(record.venue, venue))
+
+    def connectionMade(self):
+        """See `IRCClient.connectionMade`."""
+        super(ReplyBufferMixin, self).connectionMade()
+        self.reply_buffer_sweeper = LoopingCall(self.expire_reply_buffers)
+        self.reply_buffer_sweeper.clock = self.reactor
+        self.reply_buffer_sweeper.start(self.reply_buffer_sweep_interval,
+                                        now=False)
+
+    def connectionLost(self, reason):
+        """See `IRCClient.connectionLost`."""
+        if self.reply_buffer_sweeper is not None:
+            self.reply_buffer_sweeper.stop()
+            self.reply_buffer_sweeper = None
+        for user_info in self.reply_buffers.keys():
+            self.release_reply_buffer(user_info)
+        super(ReplyBufferMixin, self).connectionLost(reason)
+
+    def userLeft(self, prefix, channel):
+        """See `IRCClient.userLeft`."""
+        self._release_nick(channel, Hostmask.from_string(prefix).nick)
+        super(ReplyBufferMixin, self).userLeft(prefix, channel)
+
+    def userQuit(self, nick, quitMessage):
+        """See `IRCClient.userQuit`."""
+        for venue in self.venues.keys():
+            self._release_nick(venue, nick)
+        super(ReplyBufferMixin, self).userQuit(nick, quitMessage)
+
+    def userKicked(self, kickee, channel, kicker, message):
+        """See `IRCClient.userKicked`."""
+        self._release_nick(channel, kickee)
+        super(ReplyBufferMixin, self).userKicked(
+            kickee, channel, kicker, message)
+
+    def left(self, channel):
+        """See `IRCClient.left`."""
+        self._release_venue(channel)
+        super(ReplyBufferMixin, self).left(channel)
+
+    def kickedFrom(self, channel, kicker, message):
+        """See `IRCClient.kickedFrom`."""
+        self._release_venue(channel)
+        super(ReplyBufferMixin, self).kickedFrom(channel, kicker, message)
+
+    def quit(self, message=''):
+        """See `IRCClient.quit`."""
+        for venue in self.venues.keys():
+            self._release_venue(venue)
+        super(ReplyBufferMixin, self).quit(message)
+
+
+#
+# Outgoing flood control
+#
+
+#: Commands that keep the connection itself alive, which are sent ahead
+#: of all other outgoing lines.
+PROTOCOL_COMMANDS = frozenset(['CAP', 'NICK', 'PASS', 'PING', 'PONG',
+                               'QUIT', 'USER'])
+
+
+class FloodControlMixin(object):
+    """A connection mixin that schedules outgoing lines using a token
+    bucket, so that the bot stays within the server's flood limits.
+
+    Lines are sent in order of priority: protocol messages such as PINGs
+    and PONGs first, followed by command replies, followed by any other
+    output.  Command replies to different users are sent in turn, so
+    that one user's long reply cannot hold up everyone else's.  If the
+    queue grows too long, the oldest channel messages and notices that
+    are not command replies are dropped.
+    """
+
+    #: The priority of protocol messages.
+    PROTOCOL = 0
+    #: The priority of command replies.
+    REPLY = 1
+    #: The priority of all other outgoing lines.
+    EVENT = 2
+
+    def __init__(self):
+        super(FloodControlMixin, self).__init__()
+        #: A list of `OrderedDict` objects, indexed by priority, mapping
+        #: requester nicknames (or `None` for non-reply lines) to
+        #: `deque` objects holding ``(time, line, droppable)`` tuples
+        #: waiting to be sent.
+        self.outgoing_queues = [OrderedDict() for _ in xrange(3)]
+        #: The number of lines that can currently be sent immediately,
+        #: or `None` if the bucket has not been filled yet.
+        self.flood_tokens = None
+        self.flood_updated = None
+        self.flood_call = None
+        #: While `reply` is running, the nickname of the user whose
+        #: command reply is being sent.  Otherwise, `None`.
+        self.reply_requester = None
+
+    def connectionLost(self, reason):
+        """See `IRCClient.connectionLost`."""
+        if self.flood_call is not None and self.flood_call.active():
+            self.flood_call.cancel()
+        self.flood_call = None
+        self.flood_tokens = None
+        for queues in self.outgoing_queues:
+            queues.clear()
+        super(FloodControlMixin, self).connectionLost(reason)
+
+    def reply(self, string, request, tail=''):
+        """See `.Connection.reply`."""
+        self.reply_requester = request.actor.nick
+        try:
+            super(FloodControlMixin, self).reply(string, request, tail=tail)
+        finally:
+            self.reply_requester = None
+
+    def outgoing_queue_length(self):
+        """Return the number of outgoing lines waiting to be sent."""
+        return sum(len(queue) for queues in self.outgoing_queues
+                   for queue in queues.itervalues())
+
+    def _classify(self, line):
+        """Return the priority and requester key for an outgoing
+        *line*, and whether it may be dropped if the queue fills up."""
+        parts = line.split(' ', 2)
+        command = parts[0].upper()
+        if command in PROTOCOL_COMMANDS:
+            return self.PROTOCOL, None, False
+        if self.reply_requester is not None:
+            return self.REPLY, self._lower(self.reply_requester), False
+        # Only channel chatter from event plugins can safely be lost.
+        # Anything else, such as a JOIN, a MODE change, or a message to
+        # services, changes the bot's state and must go through.
+        droppable = (command in ('PRIVMSG', 'NOTICE') and len(parts) > 1 and
+                     all(target and self.is_channel(target)
+                         for target in parts[1].split(',')))
+        return self.EVENT, None, droppable
+
+    def sendLine(self, line):
+        """Queue *line* to be sent when flood control allows."""
+        if not self.settings.get('flood_burst', default=FLOOD_BURST):
+            super(FloodControlMixin, self).sendLine(line)
+            return
+        priority, requester, droppable = self._classify(line)
+        queues = self.outgoing_queues[priority]
+        queues.setdefault(requester, deque()).append(
+            (self.reactor.seconds(), line, droppable))
+        self._drop_stale_lines()
+        self._send_queued_lines()
+
+    def _drop_stale_lines(self):
+        """Drop the oldest droppable lines until the queue is within
+        the configured limit, or no droppable lines remain."""
+        limit = self.settings.get('flood_queue_limit',
+                                  default=FLOOD_QUEUE_LIMIT)
+        excess = self.outgoing_queue_length() - limit
+        if excess <= 0:
+            return
+        queues = self.outgoing_queues[self.EVENT]
+        for requester, queue in queues.items():
+            kept = deque()
+            for entry in queue:
+                if excess > 0 and entry[2]:
+                    self.log.debug('Dropping stale outgoing line: {line}',
+                                   line=entry[1])
+                    excess -= 1
+                else:
+                    kept.append(entry)
+            if kept:
+                queues[requester] = kept
+            else:
+                del queues[requester]
+
+    def _next_queued_line(self):
+        """Remove and return the next line to send, or `None` if no
+        lines are waiting."""
+        for queues in self.outgoing_queues:
+            if not queues:
+                continue
+            # Take the first line from the first requester in the queue,
+            # then send that requester to the back of the line.
+            requester = next(iter(queues))
+            queue = queues.pop(requester)
+            line = queue.popleft()[1]
+            if queue:
+                queues[requester] = queue
+            return line
+        return None
+
+    def _refill_flood_tokens(self):
+        """Add any tokens earned since the last refill to the bucket,
+        and return the flood control interval."""
+        burst = self.settings.get('flood_burst', default=FLOOD_BURST)
+        interval = self.settings.get('flood_interval',
+                                     default=FLOOD_INTERVAL)
+        now = self.reactor.seconds()
+        if self.flood_tokens is None:
+            self.flood_tokens = burst
+        else:
+            self.flood_tokens = min(
+                burst,
+                self.flood_tokens + (now - self.flood_updated) / interval)
+        self.flood_updated = now
+        return interval
+
+    def flood_delay(self):
+        """Return the approximate number of seconds before a newly sent
+        line would actually be written to the server, or 0 if it would
+        be written immediately."""
+        if not self.settings.get('flood_burst', default=FLOOD_BURST):
+            return 0
+        interval = self._refill_flood_tokens()
+        needed = self.outgoing_queue_length() + 1 - self.flood_tokens
+        return max(needed, 0) * interval
+
+    def _send_queued_lines(self):
+        """Send as many queued lines as the token bucket allows, and
+        schedule another attempt if any lines remain."""
+        interval = self._refill_flood_tokens()
+        while self.flood_tokens >= 1:
+            line = self._next_queued_line()
+            if line is None:
+                return
+            self.flood_tokens -= 1
+            super(FloodControlMixin, self).sendLine(line)
+        if self.flood_call is not None and self.flood_call.active():
+            return
+        if self.outgoing_queue_length():
+            self.flood_call = self.reactor.callLater(
+                (1 - self.flood_tokens) * interval, self._flood_wakeup)
+
+    def _flood_wakeup(self):
+        self.flood_call = None
+        self._send_queued_lines()
+
+
+#
+# Mode change batching
+#
+
+#: A record of the mode changes waiting to be sent to a channel, as a
+#: list of ``(enable, mode, argument)`` tuples, and the
+#: `~twisted.internet.interfaces.IDelayedCall` that sends them.
+PendingModes = namedtuple('PendingModes', ('channel', 'changes', 'call'))
+
+
+class ModeBatchingMixin(object):
+    """A connection mixin that combines channel mode changes made in
+    quick succession into as few MODE lines as the server allows."""
+
+    #: The number of seconds to collect mode changes for a channel
+    #: before sending them.
+    mode_batch_window = 0.5
+
+    def __init__(self):
+        super(ModeBatchingMixin, self).__init__()
+        #: A mapping of lowercased channel names to `PendingModes`.
+        self.pending_modes = {}
+
+    def connectionLost(self, reason):
+        """See `IRCClient.connectionLost`."""
+        self._discard_all_modes()
+        super(ModeBatchingMixin, self).connectionLost(reason)
+
+    def quit(self, message=''):
+        """See `IRCClient.quit`."""
+        self._discard_all_modes()
+        super(ModeBatchingMixin, self).quit(message)
+
+    def queue_mode(self, channel, enable, mode, argument=None):
+        """Set (if *enable* is true) or unset the single-character
+        *mode* on *channel*, with an optional *argument* such as a
+        nickname or mask, after waiting `mode_batch_window` seconds for
+        other changes to send along with it."""
+        key = self._lower(channel)
+        pending = self.pending_modes.get(key)
+        if pending is None:
+            pending = PendingModes(channel, [], self.reactor.callLater(
+                self.mode_batch_window, self.flush_modes, channel))
+            self.pending_modes[key] = pending
+        change = (enable, mode, argument)
+        if change not in pending.changes:
+            pending.changes.append(change)
+
+    def flush_modes(self, channel):
+        """Immediately send any mode changes waiting for *channel*."""
+        pending = self.pending_modes.pop(self._lower(channel), None)
+        if pending is None:
+            return
+        if pending.call.active():
+            pending.call.cancel()
+        channel = pending.channel
+        # A MODES feature with no value means there's no limit.
+        limit = self.supported.getFeature('MODES')
+        max_length = self._line_length() - len('\r\n')
+        batch = []
+        for change in pending.changes:
+            candidate = batch + [change]
+            if batch and ((limit and len(candidate) > limit) or
+                          len(self._mode_line(channel, candidate)) >
+                          max_length):
+                self.sendLine(self._mode_line(channel, batch))
+                candidate = [change]
+            batch = candidate
+        if batch:
+            self.sendLine(self._mode_line(channel, batch))
+
+    def _mode_line(self, channel, changes):
+        """Return a MODE line making *changes* to *channel*."""
+        modes = ''
+        arguments = []
+        sign = None
+        for enable, mode, argument in changes:
+            if enable != sign:
+                modes += '+' if enable else '-'
+                sign = enable
+            modes += mode
+            if argument is not None:
+                arguments.append(argument)
+        return ' '.join(['MODE', channel, modes] + arguments)
+
+    def _discard_modes(self, channel):
+        """Forget any mode changes waiting for *channel*."""
+        pending = self.pending_modes.pop(self._lower(channel), None)
+        if pending is not None and pending.call.active():
+            pending.call.cancel()
+
+    def _discard_all_modes(self):
+        """Forget the mode changes waiting for every channel."""
+        for channel in self.pending_modes.keys():
+            self._discard_modes(channel)
+
+    def left(self, channel):
+        """See `IRCClient.left`."""
+        self._discard_modes(channel)
+        super(ModeBatchingMixin, self).left(channel)
+
+    def kickedFrom(self, channel, kicker, message):
+        """See `IRCClient.kickedFrom`."""
+        self._discard_modes(channel)
+        super(ModeBatchingMixin, self).kickedFrom(channel, kicker, message)
+
 
 #
 # Mix it all together
 #
 
-class Connection(StateTrackingMixin,
+class Connection(ReplyBufferMixin,
+                 FloodControlMixin,
+                 ModeBatchingMixin,
+                 StateTrackingMixin,
                  JoinSuspensionMixin,
+                 JoinSchedulingMixin,
                  ConnectionBase):
     """Omnipresence's core IRC client protocol."""
 
@@ -496,14 +1236,11 @@ class Connection(StateTrackingMixin,
         """See `IRCClient.signedOn`."""
         super(Connection, self).signedOn()
         self.respond_to(Message(self, False, 'connected'))
-        for channel in self.settings.autojoin_channels:
-            self.join(channel)
+        self.join_channels(self.settings.autojoin_channels)
 
     def after_reload(self):
         """Join or part channels after a settings reload."""
-        for channel in self.settings.autojoin_channels:
-            if channel not in self.venues:
-                self.join(channel)
+        self.join_channels(self.settings.autojoin_channels)
         for channel in self.settings.autopart_channels:
             if channel in self.venues:
                 self.leave(channel)
@@ -589,14 +1326,20 @@ class Connection(StateTrackingMixin,
         venue_info = self.venues[venue]
         if response is None:
             if request.actor.nick in venue_info.nicks:
+                self._release_nick(venue, request.actor.nick)
                 del venue_info.nicks[request.actor.nick]
             returnValue(None)
-        buf = ReplyBuffer(response, request)
+        max_length = self.reply_length(request, tail=CHUNK_TAIL)
+        buf = ReplyBuffer(response, request, max_length=max_length)
+        # Store the buffer before advancing it, so that a reply whose
+        # Deferred fails is still skipped over on the next read.
+        self.set_reply_buffer(venue, request.actor.nick, buf)
         reply_string = (yield maybeDeferred(next, buf, None)) or 'No results.'
+        if request.settings.get('reply_packing', default=False):
+            reply_string = buf.pack(reply_string, max_length,
+                                    encoding=request.encoding)
         remaining = length_hint(buf)
         tail = ' (+{} more)'.format(remaining) if remaining else ''
-        venue_info.nicks.setdefault(request.actor.nick, VenueUserInfo())
-        venue_info.nicks[request.actor.nick].reply_buffer = buf
         self.reply(reply_string, request, tail=tail)
 
     def _lineReceived(self, line):
@@ -1,17 +1,27 @@
 """Reply buffering and chunking functions."""
 
 
-from collections import Iterable, Iterator, Sequence
-import itertools
+from collections import deque, Iterable, Iterator, Sequence
+import re
+import sys
+from weakref import WeakSet
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.python.failure import Failure
 
 from ..compat import length_hint
 from . import DEFAULT_ENCODING
-from .formatting import remove_formatting, unclosed_formatting
+from .formatting import CONTROL_CODES, FormattingState, unclosed_formatting
 
 
 #: The length to chunk string command replies to, in bytes.
 CHUNK_LENGTH = 256
 
+#: String command replies longer than this many characters are chunked
+#: lazily as they are read, rather than all at once.  The number of
+#: remaining replies shown for such a reply is an estimate.
+LAZY_CHUNK_THRESHOLD = 16384
+
 
 def truncate_unicode(string, byte_limit, encoding=DEFAULT_ENCODING):
     """Truncate a Unicode *string* so that it fits within *byte_limit*
@@ -23,7 +33,7 @@ def truncate_unicode(string, byte_limit, encoding=DEFAULT_ENCODING):
 
 
 def chunk(string, encoding=DEFAULT_ENCODING, max_length=CHUNK_LENGTH):
-    """Return a list containing chunks of at most *max_length* bytes
+    """Return an iterator over chunks of at most *max_length* bytes
     from *string*.  Breaks are made at whitespace instead of in the
     middle of words when possible.  If *string* is a Unicode string,
     it is converted to a byte string using *encoding* before calculating
@@ -33,83 +43,341 @@ def chunk(string, encoding=DEFAULT_ENCODING, max_length=CHUNK_LENGTH):
     the beginning of each subsequent chunk until they are overridden or
     a newline is encountered.
 
+    Chunks are computed lazily as the iterator is advanced, so the time
+    taken to produce each one does not depend on the length of the rest
+    of *string*.
+
     Omnipresence uses this function internally to perform command reply
     buffering, as the name implies.  Plugin authors should not need to
     call it themselves.
     """
     if not isinstance(string, basestring):
         raise TypeError('expected basestring, not ' + type(string).__name__)
-    chunks = []
-    remaining = string
-    while remaining:
-        if isinstance(remaining, unicode):
-            # See if the encoded string is longer than the maximum
-            # reply length by truncating it and then comparing it to
-            # the original.  If so, place the rest in the buffer.
-            truncated = truncate_unicode(remaining, max_length, encoding)
-            if truncated == remaining:
-                remaining = u''
-            else:
-                # Try and find whitespace to split the string on.
-                truncated = truncated.rsplit(None, 1)[0]
-                remaining = remaining[len(truncated):]
+    return ChunkIterator(string, encoding, max_length)
+
+
+# Runs of whitespace and formatting codes carry no displayable content
+# on their own, and are never worth sending as a chunk.
+_CONTENTLESS = r'(?:\s|' + CONTROL_CODES.pattern + ')*'
+_CONTENTLESS_BYTES = re.compile(_CONTENTLESS, re.VERBOSE)
+_CONTENTLESS_UNICODE = re.compile(_CONTENTLESS, re.VERBOSE | re.UNICODE)
+
+
+class ChunkIterator(Iterator):
+    """An iterator over the chunks of *string*, as returned by `chunk`.
+    """
+
+    def __init__(self, string, encoding, max_length):
+        self.string = string
+        self.encoding = encoding
+        self.max_length = max_length
+        #: The index in `string` at which the next chunk begins, or
+        #: `None` if there are no chunks remaining.
+        self.position = 0
+        #: The number of encoded bytes in `string` before `position`.
+        self.consumed = 0
+        self.total = self._byte_length(string)
+        self.state = FormattingState()
+        if isinstance(string, unicode):
+            self._contentless = _CONTENTLESS_UNICODE
         else:
-            # We don't have to be so careful about length comparisons
-            # with byte strings; just use slice notation.
-            if len(remaining) <= max_length:
-                truncated = remaining
-                remaining = ''
-            else:
-                truncated = remaining[:max_length].rsplit(None, 1)[0]
-                remaining = remaining[len(truncated):]
-        truncated = truncated.strip()
-        chunks.append(truncated)
-        remaining = ''.join(unclosed_formatting(truncated)) + remaining.strip()
-        # If all that's left are formatting codes, there's basically no
-        # real content remaining in the string.
-        if not remove_formatting(remaining):
-            break
-    return chunks
+            self._contentless = _CONTENTLESS_BYTES
+        self._skip_contentless()
+
+    def _byte_length(self, string):
+        if isinstance(string, unicode):
+            return len(string.encode(self.encoding))
+        return len(string)
+
+    def _skip_contentless(self):
+        """Move past any whitespace at `position`, or exhaust this
+        iterator if only whitespace and formatting codes remain."""
+        string = self.string
+        if self._contentless.match(string, self.position).end() == len(string):
+            self.position = None
+            return
+        start = self.position
+        while string[self.position].isspace():
+            self.position += 1
+        self.consumed += self._byte_length(string[start:self.position])
+
+    def next(self):
+        if self.position is None:
+            raise StopIteration
+        string = self.string
+        prefix = ''.join(self.state.open_codes())
+        byte_limit = self.max_length - len(prefix)
+        # Each character takes up at least one byte, so there's no need
+        # to look any further ahead than the byte limit.
+        window = string[self.position:self.position + byte_limit]
+        if isinstance(window, unicode):
+            window = truncate_unicode(window, byte_limit, self.encoding)
+        if self.position + len(window) == len(string):
+            # Everything that's left fits in this chunk.
+            self.position = None
+            return prefix + window.rstrip()
+        # Try and find whitespace to split the string on.
+        truncated = window.rsplit(None, 1)[0]
+        self.position += len(truncated)
+        self.consumed += self._byte_length(truncated)
+        self.state.update(truncated)
+        self._skip_contentless()
+        return prefix + truncated
+
+    def __length_hint__(self):
+        if self.position is None:
+            return 0
+        remaining = self.total - self.consumed
+        return max(-(-remaining // self.max_length), 1)
+
+
+class _SharedDeferredReply(object):
+    """A placeholder for a `Deferred` reply that allows every reader of
+    a reply store to receive its result."""
+
+    def __init__(self, deferred):
+        self.result = None
+        self.waiters = []
+        deferred.addBoth(self._fire)
+
+    def _fire(self, result):
+        self.result = result
+        waiters, self.waiters = self.waiters, None
+        for waiter in waiters:
+            waiter.callback(result)
+
+    def fork(self):
+        """Return a new `Deferred` firing with the original result."""
+        if self.waiters is None:
+            if isinstance(self.result, Failure):
+                return fail(self.result)
+            return succeed(self.result)
+        deferred = Deferred()
+        self.waiters.append(deferred)
+        return deferred
+
+
+class SequenceStore(object):
+    """A read-only reply store backed by a sequence of replies."""
+
+    def __init__(self, sequence):
+        self.sequence = tuple(sequence)
+        self._cumulative_sizes = None
+
+    def get(self, index):
+        """Return the reply at *index*, or raise `StopIteration` if
+        there is no such reply."""
+        if index >= len(self.sequence):
+            raise StopIteration
+        return self.sequence[index]
+
+    #: Like `get`.  Sequence stores have no pending replies.
+    peek = get
+
+    def remaining(self, index):
+        """Return the number of replies from *index* onward."""
+        return max(len(self.sequence) - index, 0)
+
+    def size(self, index):
+        """Return the estimated memory usage of the replies from *index*
+        onward, in bytes."""
+        if self._cumulative_sizes is None:
+            self._cumulative_sizes = [0]
+            for reply in self.sequence:
+                self._cumulative_sizes.append(
+                    self._cumulative_sizes[-1] + sys.getsizeof(reply))
+        index = min(index, len(self.sequence))
+        return self._cumulative_sizes[-1] - self._cumulative_sizes[index]
+
+    def release(self, reader):
+        """Note that *reader* will no longer read from this store."""
+        pass
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.sequence)
+
+
+class IteratorStore(object):
+    """A reply store that lazily pulls replies from an iterator, holding
+    on to each reply only until every reader has moved past it."""
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+        #: A `deque` of replies that have been pulled from the iterator,
+        #: but not yet consumed by every reader.
+        self.replies = deque()
+        #: The index of the first reply in `replies`.
+        self.offset = 0
+        #: A `WeakSet` of `ReplyBuffer` objects reading from this store.
+        self.readers = WeakSet()
+
+    def get(self, index):
+        """Return the reply at *index*, pulling more replies from the
+        iterator if necessary, or raise `StopIteration` if there is no
+        such reply."""
+        reply = self.peek(index)
+        if isinstance(reply, _SharedDeferredReply):
+            return reply.fork()
+        return reply
+
+    def peek(self, index):
+        """Like `get`, but return a placeholder instead of a new
+        `Deferred` if the reply is still pending."""
+        while index >= self.offset + len(self.replies):
+            reply = next(self.iterator)
+            if isinstance(reply, Deferred):
+                reply = _SharedDeferredReply(reply)
+            self.replies.append(reply)
+        return self.replies[index - self.offset]
+
+    def trim(self):
+        """Discard any replies that every reader has moved past."""
+        if not self.readers:
+            return
+        low = min(reader.cursor for reader in self.readers)
+        while self.replies and self.offset < low:
+            self.replies.popleft()
+            self.offset += 1
+
+    def remaining(self, index):
+        """Return an estimate of the number of replies from *index*
+        onward."""
+        buffered = max(self.offset + len(self.replies) - index, 0)
+        return buffered + length_hint(self.iterator)
+
+    def size(self, index):
+        """Return the estimated memory usage of the replies from *index*
+        onward, in bytes."""
+        start = max(index - self.offset, 0)
+        return (sys.getsizeof(self.iterator) +
+                sum(sys.getsizeof(self.replies[i])
+                    for i in xrange(start, len(self.replies))))
+
+    def release(self, reader):
+        """Note that *reader* will no longer read from this store, and
+        close the underlying iterator if no other readers remain."""
+        self.readers.discard(reader)
+        if self.readers:
+            self.trim()
+            return
+        self.replies.clear()
+        close = getattr(self.iterator, 'close', None)
+        if close is not None:
+            close()
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.iterator)
 
 
 class ReplyBuffer(Iterator):
     """An iterator wrapping the :ref:`command reply <command-replies>`
-    *response* for the invocation `.Message` *request*."""
+    *response* for the invocation `.Message` *request*.  String
+    responses are chunked to *max_length* bytes.
+
+    Each reply buffer is a cursor into a read-only store of replies.
+    Creating a reply buffer from another one, or calling `.tee`, yields
+    independent cursors that share the original's store instead of
+    copying it.
+    """
 
-    def __init__(self, response, request=None):
+    def __init__(self, response, request=None, max_length=CHUNK_LENGTH):
         if isinstance(response, ReplyBuffer):
-            self.response = response.response
-        elif isinstance(response, basestring):
-            if request is None:
-                encoding = DEFAULT_ENCODING
-            else:
-                encoding = request.encoding
-            self.response = chunk(response, encoding)
-        elif isinstance(response, (Iterable, Sequence)):
-            self.response = response
+            self.store = response.store
+            self.cursor = response.cursor
         else:
-            raise TypeError('invalid command reply type ' +
-                            type(response).__name__)
+            if isinstance(response, basestring):
+                if request is None:
+                    encoding = DEFAULT_ENCODING
+                else:
+                    encoding = request.encoding
+                chunks = chunk(response, encoding, max_length)
+                if len(response) > LAZY_CHUNK_THRESHOLD:
+                    self.store = IteratorStore(chunks)
+                else:
+                    self.store = SequenceStore(chunks)
+            elif isinstance(response, Sequence):
+                self.store = SequenceStore(response)
+            elif isinstance(response, Iterable):
+                self.store = IteratorStore(iter(response))
+            else:
+                raise TypeError('invalid command reply type ' +
+                                type(response).__name__)
+            self.cursor = 0
+        if isinstance(self.store, IteratorStore):
+            self.store.readers.add(self)
 
     def next(self):
-        if isinstance(self.response, Sequence):
-            if not self.response:
-                raise StopIteration
-            reply_string = self.response[0]
-            self.response = self.response[1:]
-            return reply_string
-        return next(self.response)
+        reply = self.store.get(self.cursor)
+        self.cursor += 1
+        if isinstance(self.store, IteratorStore):
+            self.store.trim()
+        return reply
+
+    def skip(self, count):
+        """Advance this buffer past the next *count* replies without
+        returning them.  This takes constant time for sequence replies.
+        """
+        if count <= 0:
+            return
+        if isinstance(self.store, IteratorStore):
+            try:
+                self.store.get(self.cursor + count - 1)
+            except StopIteration:
+                pass
+        self.cursor += count
+        if isinstance(self.store, IteratorStore):
+            self.store.trim()
+
+    def pack(self, reply, max_length, encoding=DEFAULT_ENCODING,
+             separator=' / '):
+        """Return *reply* joined by *separator* to as many of the
+        following replies in this buffer as fit within *max_length*
+        bytes, and advance this buffer past the replies that were used.
+        Packing stops at the first reply that is not yet available.
+        Unicode replies are encoded using *encoding*."""
+        if isinstance(reply, unicode):
+            reply = reply.encode(encoding)
+        while True:
+            try:
+                following = self.store.peek(self.cursor)
+            except StopIteration:
+                break
+            if not isinstance(following, basestring):
+                break
+            if isinstance(following, unicode):
+                following = following.encode(encoding)
+            # Keep any formatting from spilling over into the next reply.
+            joiner = ('\x0F' if unclosed_formatting(reply) else '') + separator
+            packed = reply + joiner + following
+            if len(packed.replace('\n', ' / ')) > max_length:
+                break
+            reply = packed
+            self.skip(1)
+        return reply
 
     def tee(self, num=2):
         """Return *num* independent reply buffers from this one, like
         `itertools.tee`, but without making unnecessary copies of the
         underlying response."""
-        if isinstance(self.response, Sequence):
-            return (ReplyBuffer(self.response),) * num
-        return tuple(ReplyBuffer(t) for t in itertools.tee(self.response, num))
+        return tuple(ReplyBuffer(self) for _ in xrange(num))
+
+    def size_hint(self):
+        """Return an estimate of the number of bytes of memory held by
+        the replies remaining in this buffer.  Only the iterator object
+        itself is counted for lazily evaluated responses."""
+        return self.store.size(self.cursor)
+
+    def close(self):
+        """Discard any remaining replies in this buffer, closing the
+        underlying response if it supports doing so and no other buffer
+        is reading from it."""
+        self.store.release(self)
+        self.store = SequenceStore(())
+        self.cursor = 0
 
     def __length_hint__(self):
-        return length_hint(self.response)
+        return self.store.remaining(self.cursor)
 
     def __repr__(self):
-        return '{}({})'.format(type(self).__name__, repr(self.response))
+        return '{}({!r}, cursor={})'.format(
+            type(self).__name__, self.store, self.cursor)
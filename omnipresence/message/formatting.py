@@ -31,33 +31,59 @@ def remove_formatting(string):
 def unclosed_formatting(string):
     """Return a `frozenset` containing any mIRC-style formatting codes
     that remain in effect at the end of *string*."""
-    fg = bg = ''
-    bold = reverse = underline = False
-    # ^O resets everything, so we split on it and only operate on the
-    # portion of the string that is beyond the rightmost occurrence.
-    for match in CONTROL_CODES.finditer(string.rsplit('\x0F')[-1]):
-        code = match.group(0)
-        if code.startswith('\x03'):
-            if code == '\x03':
-                # No color codes were specified.  Reset everything.
-                fg = bg = ''
-            else:
-                fg = match.group(1) or fg
-                bg = match.group(2) or bg
-        elif code == '\x02':
-            bold = not bold
-        elif code == '\x16':
-            reverse = not reverse
-        elif code == '\x1F':  # pragma: no branch
-            underline = not underline
-    # Thankfully, we don't have to keep track of proper nesting.
-    open_codes = []
-    if fg or bg:
-        open_codes.append('\x03' + fg + (',' + bg if bg else ''))
-    if bold:
-        open_codes.append('\x02')
-    if reverse:
-        open_codes.append('\x16')
-    if underline:
-        open_codes.append('\x1F')
-    return frozenset(open_codes)
+    state = FormattingState()
+    state.update(string)
+    return state.open_codes()
+
+
+class FormattingState(object):
+    """The mIRC-style formatting in effect at some point in a string.
+
+    Calling `.update` with consecutive pieces of a string tracks the
+    formatting across all of them, without rescanning any earlier
+    pieces.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Revert to the default formatting."""
+        self.fg = self.bg = ''
+        self.bold = self.reverse = self.underline = False
+
+    def update(self, string):
+        """Apply any formatting codes in *string* to this state."""
+        for match in CONTROL_CODES.finditer(string):
+            code = match.group(0)
+            if code.startswith('\x03'):
+                if code == '\x03':
+                    # No color codes were specified.  Reset everything.
+                    self.fg = self.bg = ''
+                else:
+                    self.fg = match.group(1) or self.fg
+                    self.bg = match.group(2) or self.bg
+            elif code == '\x02':
+                self.bold = not self.bold
+            elif code == '\x0F':
+                self.reset()
+            elif code == '\x16':
+                self.reverse = not self.reverse
+            elif code == '\x1F':  # pragma: no branch
+                self.underline = not self.underline
+
+    def open_codes(self):
+        """Return a `frozenset` containing the formatting codes needed
+        to restore this state."""
+        # Thankfully, we don't have to keep track of proper nesting.
+        open_codes = []
+        if self.fg or self.bg:
+            open_codes.append(
+                '\x03' + self.fg + (',' + self.bg if self.bg else ''))
+        if self.bold:
+            open_codes.append('\x02')
+        if self.reverse:
+            open_codes.append('\x16')
+        if self.underline:
+            open_codes.append('\x1F')
+        return frozenset(open_codes)
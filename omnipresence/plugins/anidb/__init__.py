@@ -6,12 +6,11 @@ import re
 import urllib
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import readBody
 
 from ...message import collapse
 from ...plugin import EventPlugin, UserVisibleError
-from ...web.html import parse as parse_html, textify
-from ...web.http import default_agent
+from ...web.html import FAST_BS4_PARSER, parse as parse_html, textify
+from ...web.http import cache_by_default, default_agent, read_body
 
 
 #: A regex matching AniDB's day.month.year date format.
@@ -92,6 +91,11 @@ def parse_anime_all(anime_all):
     return [anime]
 
 
+#: The number of seconds to cache search results for.
+CACHE_TTL = 6 * 60 * 60
+cache_by_default('http://anidb.net/', CACHE_TTL)
+
+
 class Default(EventPlugin):
     u"""Look up an anime title on `AniDB`__.
 
@@ -117,8 +121,9 @@ class Default(EventPlugin):
            'http://anidb.net/perl-bin/animedb.pl?show=animelist&'
            'adb.search={}&orderby.ucnt=0.2&do.update=update&noalias=1'
            .format(urllib.quote_plus(msg.content)))
-        content = yield readBody(response)
-        soup = parse_html(content)
+        content = yield read_body(response)
+        soup = parse_html(content, only='table.animelist, div.anime_all',
+                          parser=FAST_BS4_PARSER)
 
         # We get one of two response formats, depending on the number
         # of results.  If there is exactly one result, we're redirected
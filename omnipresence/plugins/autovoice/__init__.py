@@ -13,6 +13,10 @@ class Default(EventPlugin):
     moderation is set with the ``+m`` channel mode.  Useful for managing
     a sudden influx of new users.
 
+    Voices are sent shortly after each join, combined into as few mode
+    changes as the server allows, so that a flood of joins does not
+    produce a flood of mode changes.
+
     Note that Omnipresence almost certainly has to have channel operator
     privileges (``+o``) in order for this plugin to work.
     """
@@ -23,4 +27,4 @@ class Default(EventPlugin):
         venue_info = msg.connection.venues.get(msg.venue)
         if venue_info is None or venue_info.modes['m']:
             return
-        msg.connection.mode(msg.venue, True, 'v', user=msg.actor.nick)
+        msg.connection.queue_mode(msg.venue, True, 'v', msg.actor.nick)
@@ -22,6 +22,8 @@ class AutovoiceTestCase(ConnectionTestMixin, TestCase):
     @inlineCallbacks
     def test_unmoderated_voice(self):
         yield self.receive('JOIN ' + self.channels[0])
+        self.assertNotEqual(self.outgoing.last_seen.action, MessageType.mode)
+        self.connection.reactor.advance(self.connection.mode_batch_window)
         self.assertEqual(self.outgoing.last_seen.action, MessageType.mode)
         self.assertEqual(self.outgoing.last_seen.venue, self.channels[0])
         self.assertEqual(self.outgoing.last_seen.content,
@@ -31,4 +33,17 @@ class AutovoiceTestCase(ConnectionTestMixin, TestCase):
     def test_moderated_no_voice(self):
         yield self.receive('MODE {} +m'.format(self.channels[0]))
         yield self.receive('JOIN ' + self.channels[0])
+        self.connection.reactor.advance(self.connection.mode_batch_window)
         self.assertNotEqual(self.outgoing.last_seen.action, MessageType.mode)
+
+    @inlineCallbacks
+    def test_join_flood(self):
+        self.connection.supported.parse(['MODES=3'])
+        for i in xrange(5):
+            yield self.connection._lineReceived(
+                ':user{}!user@host JOIN {}'.format(i, self.channels[0]))
+        self.transport.clear()
+        self.connection.reactor.advance(self.connection.mode_batch_window)
+        self.assertEqual(self.transport.value(), (
+            'MODE #foo +vvv user0 user1 user2\r\n'
+            'MODE #foo +vv user3 user4\r\n'))
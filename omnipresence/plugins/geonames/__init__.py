@@ -6,17 +6,36 @@ __ http://geonames.org/
 
 The ``geonames.username`` :ref:`settings variable <settings-variable>`
 must be set to a valid GeoNames API username for them to function.
+
+Locations, their time zones, and their nearest weather stations are
+cached, so that repeated lookups of the same place need fewer API
+requests.  If ``geonames.cache_path`` is set to the path of an SQLite
+database file, which is created if it does not exist, these results
+are also written there every few seconds, and when the bot shuts down,
+so that they survive restarts.
+
+Places can also be looked up in an offline index built from the
+GeoNames `data dumps`__ with :file:`scripts/import_geonames.py`.  If
+``geonames.index_path`` is set to the path of such an index, locations
+found in it need no API requests, and neither does ``time`` when pytz
+is installed.  Other locations are still looked up online.
+
+__ http://download.geonames.org/export/dump/
 """
 
 
-from collections import namedtuple
-from datetime import datetime
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta
+from itertools import islice
+import json
 try:
     import pytz
 except ImportError:
     pytz = None
+import sqlite3
 import urllib
 
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from ...humanize import ago
@@ -38,6 +57,279 @@ class Location(namedtuple('Location', ['name', 'lat', 'lng'])):
         return u'{} ({:.2f}, {:.2f})'.format(self.name, lat, lng)
 
 
+#: The maximum number of lookup results to keep in memory.
+CACHE_SIZE = 256
+
+#: The number of seconds between a weather station's observations.
+WEATHER_INTERVAL = 3600
+
+#: The number of seconds to keep a weather observation that should
+#: already have been superseded, such as one from a slow station.
+WEATHER_MIN_TTL = 300
+
+
+def normalize_query(query):
+    """Return the location query *query* with case and runs of
+    whitespace normalized, for use as a cache key."""
+    return u' '.join(query.lower().split())
+
+
+def location_key(location):
+    """Return a string identifying `Location` *location*, for use as a
+    cache key."""
+    return u'{},{}'.format(location.lat, location.lng)
+
+
+class GeoCache(object):
+    """A least-recently-used cache holding at most *size* GeoNames
+    lookup results in memory, optionally backed by the SQLite database
+    at *path*.  Each result is a JSON-serializable value stored under a
+    *kind*, such as ``location``, and a Unicode *key*.
+
+    Writes to the database are collected for `flush_delay` seconds and
+    committed together, instead of once per result."""
+
+    #: The number of seconds to collect writes before committing them.
+    flush_delay = 5
+
+    def __init__(self, path=None, size=CACHE_SIZE, clock=reactor):
+        self.size = size
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.path = path
+        self.db = None
+        #: A dictionary mapping ``(kind, key)`` tuples to values, or
+        #: `None` for deletions, waiting to be written to the database.
+        self.pending = {}
+        self.flush_call = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            with self.db:
+                self.db.execute('CREATE TABLE IF NOT EXISTS geocache ('
+                                'kind TEXT, key TEXT, value TEXT, '
+                                'PRIMARY KEY (kind, key))')
+
+    def get(self, kind, key):
+        """Return the value stored under *kind* and *key*, or `None`."""
+        value = self.entries.pop((kind, key), None)
+        if value is None and (kind, key) in self.pending:
+            value = self.pending[kind, key]
+        elif value is None and self.db is not None:
+            row = self.db.execute(
+                'SELECT value FROM geocache WHERE kind = ? AND key = ?',
+                (kind, key)).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+        if value is not None:
+            self._remember(kind, key, value)
+        return value
+
+    def put(self, kind, key, value):
+        """Store *value* under *kind* and *key*."""
+        self.entries.pop((kind, key), None)
+        self._remember(kind, key, value)
+        self._write(kind, key, value)
+
+    def delete(self, kind, key):
+        """Remove any value stored under *kind* and *key*."""
+        self.entries.pop((kind, key), None)
+        self._write(kind, key, None)
+
+    def _remember(self, kind, key, value):
+        self.entries[kind, key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def _write(self, kind, key, value):
+        if self.db is None:
+            return
+        self.pending[kind, key] = value
+        if self.flush_call is None:
+            self.flush_call = self.clock.callLater(self.flush_delay,
+                                                   self.flush)
+
+    def flush(self):
+        """Immediately commit any pending writes to the database."""
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        if self.db is None or not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO geocache VALUES (?, ?, ?)',
+                ((kind, key, json.dumps(value))
+                 for (kind, key), value in pending.iteritems()
+                 if value is not None))
+            self.db.executemany(
+                'DELETE FROM geocache WHERE kind = ? AND key = ?',
+                (kind_key for kind_key, value in pending.iteritems()
+                 if value is None))
+
+    def close(self):
+        """Commit any pending writes and close the database."""
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+#: A dictionary mapping database paths, or `None` for memory only, to
+#: the `GeoCache` objects shared by the GeoNames plugins.
+default_caches = {}
+
+
+def close_default_caches():
+    """Commit any pending writes to the caches in `default_caches`, and
+    close them.  Called when the reactor shuts down."""
+    for cache in default_caches.itervalues():
+        cache.close()
+    default_caches.clear()
+
+
+reactor.addSystemEventTrigger('before', 'shutdown', close_default_caches)
+
+
+#: The GeoNames feature classes imported into an offline index, which
+#: are administrative divisions and populated places.
+INDEX_FEATURE_CLASSES = frozenset('AP')
+
+#: The maximum number of candidate places considered per index lookup.
+INDEX_CANDIDATES = 50
+
+
+def _dump_rows(lines, columns):
+    """Yield lists of the tab-separated fields in GeoNames dump *lines*
+    that have at least *columns* fields, skipping comments."""
+    for line in lines:
+        if isinstance(line, str):
+            line = line.decode('utf-8')
+        if line.startswith(u'#'):
+            continue
+        fields = line.rstrip(u'\r\n').split(u'\t')
+        if len(fields) >= columns:
+            yield fields
+
+
+class GeoNamesIndex(object):
+    """An offline index of places from a GeoNames dump, kept in the
+    SQLite database at *path*, or no index if *path* is `None`.  Places
+    can be found by any of their names or alternate names, with the
+    most populous match preferred, or by a prefix of a name if only one
+    place matches it."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            with self.db:
+                self.db.execute(
+                    'CREATE TABLE IF NOT EXISTS places ('
+                    'geonameid INTEGER PRIMARY KEY, name TEXT, '
+                    'admin1 TEXT, admin1_code TEXT, country TEXT, '
+                    'country_code TEXT, lat REAL, lng REAL, '
+                    'population INTEGER, timezone TEXT)')
+                self.db.execute(
+                    'CREATE TABLE IF NOT EXISTS names ('
+                    'name TEXT, geonameid INTEGER, '
+                    'PRIMARY KEY (name, geonameid)) WITHOUT ROWID')
+
+    def load(self, places, countries=(), admin1_codes=()):
+        """Add the places in the GeoNames dump file lines *places*, such
+        as those of :file:`cities15000.txt` or :file:`allCountries.txt`,
+        to this index.  Country and first-level administrative division
+        names are taken from the lines of :file:`countryInfo.txt` and
+        :file:`admin1CodesASCII.txt` in *countries* and *admin1_codes*,
+        if given.  Return the number of places added."""
+        country_names = dict((fields[0], fields[4])
+                             for fields in _dump_rows(countries, 5))
+        admin1_names = dict((fields[0], fields[1])
+                            for fields in _dump_rows(admin1_codes, 2))
+        count = 0
+        with self.db:
+            for fields in _dump_rows(places, 18):
+                if fields[6] not in INDEX_FEATURE_CLASSES:
+                    continue
+                geonameid, country_code = int(fields[0]), fields[8]
+                self.db.execute(
+                    'INSERT OR REPLACE INTO places VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (geonameid, fields[1],
+                     admin1_names.get(u'{}.{}'.format(country_code,
+                                                      fields[10])),
+                     fields[10], country_names.get(country_code, country_code),
+                     country_code, float(fields[4]), float(fields[5]),
+                     int(fields[14] or 0), fields[17] or None))
+                names = set([fields[1], fields[2]])
+                names.update(fields[3].split(u','))
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO names VALUES (?, ?)',
+                    ((normalize_query(name), geonameid)
+                     for name in names if name.strip()))
+                count += 1
+        return count
+
+    def _candidates(self, name, prefix):
+        if prefix:
+            condition = 'n.name >= ? AND n.name < ?'
+            params = (name, name + u'\U0010FFFF')
+        else:
+            condition = 'n.name = ?'
+            params = (name,)
+        return self.db.execute(
+            'SELECT DISTINCT p.geonameid, p.name, p.admin1, '
+            'p.admin1_code, p.country, p.country_code, p.lat, p.lng, '
+            'p.timezone '
+            'FROM names n JOIN places p ON p.geonameid = n.geonameid '
+            'WHERE ' + condition + ' '
+            'ORDER BY p.population DESC LIMIT ?',
+            params + (INDEX_CANDIDATES,))
+
+    def _matches(self, name, qualifiers, prefix):
+        """Yield tuples of a `Location` and its tz database zone for the
+        places named *name*, or with a name starting with *name* if
+        *prefix* is true, that match all of *qualifiers*, most populous
+        first."""
+        for row in self._candidates(name, prefix):
+            (_, place, admin1, admin1_code, country, country_code,
+             lat, lng, timezone_id) = row
+            known = set(normalize_query(part or u'') for part in
+                        (admin1, admin1_code, country, country_code))
+            if all(qualifier in known for qualifier in qualifiers):
+                canonical = filter(None, [place, admin1, country])
+                yield (Location(u', '.join(canonical), lat, lng),
+                       timezone_id)
+
+    def lookup(self, query):
+        """Return a tuple of a `Location` and its tz database zone for
+        the place best matching the string *query*, or `None` if there
+        is no such place.  Any comma-separated parts of *query* after
+        the first must name or give the code of the place's
+        administrative division or country, as in ``Portland, Maine``
+        or ``Portland, ME, US``."""
+        if self.db is None:
+            return None
+        parts = [normalize_query(part) for part in query.split(u',')]
+        name, qualifiers = parts[0], [part for part in parts[1:] if part]
+        if not name:
+            return None
+        for match in self._matches(name, qualifiers, prefix=False):
+            return match
+        # Only accept a partial name if it can mean just one place.
+        matches = list(islice(self._matches(name, qualifiers, prefix=True),
+                              2))
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+
+#: A dictionary mapping index paths, or `None` for no index, to the
+#: `GeoNamesIndex` objects shared by the GeoNames plugins.
+default_indexes = {}
+
+
 class GeoNamesMixin(object):
     """A mixin for plugins that query the GeoNames API."""
 
@@ -45,20 +337,53 @@ class GeoNamesMixin(object):
 
     def __init__(self):
         self.agent = default_agent
+        #: A dictionary mapping ``geonames.cache_path`` values to the
+        #: `GeoCache` objects for them.
+        self.caches = default_caches
+        #: A dictionary mapping ``geonames.index_path`` values to the
+        #: `GeoNamesIndex` objects for them.
+        self.indexes = default_indexes
         #: Time provider that can be stubbed out for unit tests, given
         #: that time is being computed locally as with tzdata requests.
         self.utcnow = datetime.utcnow
 
+    def cache_for(self, msg):
+        """Return the `GeoCache` for the database named in *msg*'s
+        settings, opening it if necessary."""
+        path = msg.settings.get('geonames.cache_path')
+        if path not in self.caches:
+            self.caches[path] = GeoCache(path)
+        return self.caches[path]
+
+    def index_for(self, msg):
+        """Return the `GeoNamesIndex` named in *msg*'s settings,
+        opening it if necessary."""
+        path = msg.settings.get('geonames.index_path')
+        if path not in self.indexes:
+            self.indexes[path] = GeoNamesIndex(path)
+        return self.indexes[path]
+
     def request(self, action, params, username):
         """Make a request to the GeoNames API."""
         return self.agent.request('GET', '{}{}?{}&username={}'.format(
             self.endpoint_uri, action, urllib.urlencode(params), username))
 
     @inlineCallbacks
-    def geocode(self, query, username):
-        """Return a `Deferred` yielding a `Location` object for the
-        string *query*, or raise `UserVisibleError` if no matches could
-        be found."""
+    def geocode(self, query, username, cache, index):
+        """Return a `Deferred` yielding a tuple of a `Location` object
+        for the string *query* and its tz database zone, or `None` if
+        the zone isn't known, or raise `UserVisibleError` if no matches
+        could be found.  The `GeoNamesIndex` *index* is searched first,
+        then the `GeoCache` *cache*."""
+        found = index.lookup(query)
+        if found is not None:
+            returnValue(found)
+        key = normalize_query(query)
+        cached = cache.get('location', key)
+        if cached is not None:
+            location = Location(*cached)
+            returnValue((location,
+                         cache.get('timezone', location_key(location))))
         params = [('maxRows', 1), ('style', 'FULL'), ('q', query)]
         response = yield self.request('searchJSON', params, username)
         data = yield read_json_body(response)
@@ -69,8 +394,20 @@ class GeoNamesMixin(object):
         canonical = filter(None, [details.get('name'),
                                   details.get('adminName1'),
                                   details.get('countryName')])
-        returnValue(Location(
-            u', '.join(canonical), details['lat'], details['lng']))
+        location = Location(
+            u', '.join(canonical), details['lat'], details['lng'])
+        cache.put('location', key, list(location))
+        timezone_id = details.get('timezone', {}).get('timeZoneId')
+        if timezone_id:
+            cache.put('timezone', location_key(location), timezone_id)
+        returnValue((location, timezone_id))
+
+    def local_time(self, timezone_id):
+        """Return the current time in the tz database zone
+        *timezone_id*, formatted like GeoNames time strings."""
+        return (self.utcnow().replace(tzinfo=pytz.utc)
+                    .astimezone(pytz.timezone(timezone_id))
+                    .strftime('%Y-%m-%d %H:%M'))
 
 
 class Time(GeoNamesMixin, EventPlugin):
@@ -86,6 +423,9 @@ class Time(GeoNamesMixin, EventPlugin):
 
     :alice: time UTC
     :bot: UTC (tz database): 2015-08-14 03:10
+
+    With pytz, the time in a location whose time zone is already known
+    is also computed locally, without any GeoNames requests.
     """
 
     def __init__(self):
@@ -96,18 +436,24 @@ class Time(GeoNamesMixin, EventPlugin):
         if not msg.content:
             raise UserVisibleError('Please specify a location.')
         if pytz and msg.content in pytz.all_timezones:
-            time = (self.utcnow().replace(tzinfo=pytz.utc)
-                        .astimezone(pytz.timezone(msg.content))
-                        .strftime('%Y-%m-%d %H:%M'))
-            returnValue(u'{} (tz database): {}'.format(msg.content, time))
+            returnValue(u'{} (tz database): {}'.format(
+                msg.content, self.local_time(msg.content)))
+        cache = self.cache_for(msg)
         username = msg.settings.get('geonames.username')
-        location = yield self.geocode(msg.content, username)
+        location, timezone_id = yield self.geocode(
+            msg.content, username, cache, self.index_for(msg))
+        if pytz and timezone_id in pytz.all_timezones_set:
+            returnValue(u'{}: {}'.format(location,
+                                         self.local_time(timezone_id)))
         params = zip(['lat', 'lng'], location[1:])
         response = yield self.request('timezoneJSON', params, username)
         data = yield read_json_body(response)
         if 'time' not in data:
             raise UserVisibleError(u'There is no time information for {}.'
                                    .format(location))
+        if data.get('timezoneId'):
+            cache.put('timezone', location_key(location),
+                      data['timezoneId'])
         returnValue(u'{}: {}'.format(location, data['time']))
 
     def on_cmdhelp(self, msg):
@@ -125,22 +471,70 @@ class Weather(GeoNamesMixin, EventPlugin):
     :bot: London, England, United Kingdom (51.51, -0.13):
           19.0°C/66.2°F, broken clouds, 93% humidity
           from London City Airport (EGLC) as of 26 minutes ago
+
+    Observations are reused until the station is due to report again.
     """
 
+    def __init__(self):
+        super(Weather, self).__init__()
+        #: A dictionary mapping station ICAO codes to tuples of the
+        #: expiry time and contents of their latest observations.
+        self.observations = {}
+
     @inlineCallbacks
-    def on_command(self, msg):
-        if not msg.content:
-            raise UserVisibleError('Please specify a location.')
-        username = msg.settings.get('geonames.username')
-        location = yield self.geocode(msg.content, username)
-        params = zip(['lat', 'lng'], location[1:])
-        response = yield self.request('findNearByWeatherJSON',
-                                      params, username)
-        data = yield read_json_body(response)
+    def observe(self, location, username, cache):
+        """Return a `Deferred` yielding the latest weather observation
+        from the station nearest to *location*, using the `GeoCache`
+        *cache*, or raise `UserVisibleError` if there is none."""
+        key = location_key(location)
+        station = cache.get('station', key)
+        data = {}
+        if station is not None:
+            expires, observation = self.observations.get(station,
+                                                         (None, None))
+            if observation is not None and expires > self.utcnow():
+                returnValue(observation)
+            response = yield self.request('weatherIcaoJSON',
+                                          [('ICAO', station)], username)
+            data = yield read_json_body(response)
+            if 'weatherObservation' not in data:
+                # The station may have been retired.  Forget it, and
+                # look for the nearest one again.
+                cache.delete('station', key)
+                self.observations.pop(station, None)
+        if 'weatherObservation' not in data:
+            params = zip(['lat', 'lng'], location[1:])
+            response = yield self.request('findNearByWeatherJSON',
+                                          params, username)
+            data = yield read_json_body(response)
         if 'weatherObservation' not in data:
             raise UserVisibleError(u'There is no weather information for {}.'
                                    .format(location))
         observation = data['weatherObservation']
+        cache.put('station', key, observation['ICAO'])
+        now = self.utcnow()
+        try:
+            expires = (datetime.strptime(observation['datetime'],
+                                         '%Y-%m-%d %H:%M:%S') +
+                       timedelta(seconds=WEATHER_INTERVAL))
+        except ValueError:
+            expires = now
+        expires = max(expires, now + timedelta(seconds=WEATHER_MIN_TTL))
+        self.observations = dict(
+            (icao, entry) for icao, entry in self.observations.iteritems()
+            if entry[0] > now)
+        self.observations[observation['ICAO']] = (expires, observation)
+        returnValue(observation)
+
+    @inlineCallbacks
+    def on_command(self, msg):
+        if not msg.content:
+            raise UserVisibleError('Please specify a location.')
+        cache = self.cache_for(msg)
+        username = msg.settings.get('geonames.username')
+        location, _ = yield self.geocode(
+            msg.content, username, cache, self.index_for(msg))
+        observation = yield self.observe(location, username, cache)
         temp = float(observation['temperature'])
         weather = u'{:.1f}°C/{:.1f}°F'.format(temp, temp * 1.8 + 32)
         if observation.get('weatherCondition', 'n/a') != 'n/a':
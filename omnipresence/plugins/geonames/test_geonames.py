@@ -4,14 +4,68 @@
 
 
 from datetime import datetime
+import json
 
-from twisted.internet.defer import inlineCallbacks
+from mock import Mock
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import TestCase
+from twisted.web.client import ResponseDone
 
-from ...message import collapse
+from ...message import Message, collapse
 from ...test.helpers import CommandTestMixin
 
-from . import Time, Weather
+from . import (close_default_caches, default_caches, location_key,
+               GeoCache, GeoNamesIndex, Location, Time, Weather)
+
+
+def dump_line(*fields):
+    # geonameid, name, asciiname, alternatenames, latitude, longitude,
+    # feature class, feature code, country code, admin1 code,
+    # population, timezone
+    (geonameid, name, asciiname, alternates, lat, lng, feature_class,
+     feature_code, country, admin1, population, timezone) = fields
+    return u'\t'.join([
+        geonameid, name, asciiname, alternates, lat, lng, feature_class,
+        feature_code, country, u'', admin1, u'', u'', u'', population,
+        u'', u'', timezone, u'2015-11-01']) + u'\n'
+
+
+PLACES = [
+    dump_line(u'1816670', u'Beijing', u'Beijing', u'Pekin,Peking,北京',
+              u'39.9075', u'116.39723', u'P', u'PPLC', u'CN', u'22',
+              u'11716620', u'Asia/Shanghai'),
+    dump_line(u'5746545', u'Portland', u'Portland', u'',
+              u'45.52345', u'-122.67621', u'P', u'PPLA2', u'US', u'OR',
+              u'632309', u'America/Los_Angeles'),
+    dump_line(u'4975802', u'Portland', u'Portland', u'',
+              u'43.66147', u'-70.25533', u'P', u'PPLA2', u'US', u'ME',
+              u'66881', u'America/New_York'),
+    dump_line(u'1816671', u'Beijing Shi', u'Beijing Shi', u'',
+              u'40.0', u'116.5', u'T', u'MT', u'CN', u'22',
+              u'0', u'Asia/Shanghai'),
+    ]
+COUNTRIES = [u'#ISO\tISO3\tISO-Numeric\tfips\tCountry\n',
+             u'CN\tCHN\t156\tCH\tChina\n',
+             u'US\tUSA\t840\tUS\tUnited States\n']
+ADMIN1_CODES = [u'CN.22\tBeijing\tBeijing\t2038349\n',
+                u'US.OR\tOregon\tOregon\t5744337\n',
+                u'US.ME\tMaine\tMaine\t4971068\n']
+
+
+class JSONResponse(object):
+    code = 200
+    phrase = 'OK'
+
+    def __init__(self, data):
+        self.body = json.dumps(data)
+
+    def deliverBody(self, protocol):
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(Failure(ResponseDone()))
 
 
 class GeoNamesTestMixin(CommandTestMixin):
@@ -19,6 +73,34 @@ class GeoNamesTestMixin(CommandTestMixin):
         super(GeoNamesTestMixin, self).setUp()
         self.connection.settings.set('geonames.username', 'USERNAME')
         self.command.utcnow = lambda: datetime(2015, 11, 1, 22, 04)
+        self.command.caches = {}
+        self.command.indexes = {}
+
+    def use_index(self):
+        path = self.mktemp()
+        GeoNamesIndex(path).load(PLACES, COUNTRIES, ADMIN1_CODES)
+        self.connection.settings.set('geonames.index_path', path)
+
+
+class CacheForTestCase(GeoNamesTestMixin, TestCase):
+    command_class = Time
+
+    def message(self, venue):
+        return Message(self.connection, False, 'privmsg', venue=venue)
+
+    def test_per_path(self):
+        self.connection.settings.set('geonames.cache_path', self.mktemp(),
+                                     scope='#foo')
+        self.connection.settings.set('geonames.cache_path', self.mktemp(),
+                                     scope='#bar')
+        foo = self.command.cache_for(self.message('#foo'))
+        bar = self.command.cache_for(self.message('#bar'))
+        self.addCleanup(foo.close)
+        self.addCleanup(bar.close)
+        self.assertIsNot(foo, bar)
+        self.assertIs(self.command.cache_for(self.message('#foo')), foo)
+        foo.put('location', u'a', 1)
+        self.assertIsNone(bar.get('location', u'a'))
 
 
 class TimeTestCase(GeoNamesTestMixin, TestCase):
@@ -31,6 +113,29 @@ class TimeTestCase(GeoNamesTestMixin, TestCase):
         yield self.assert_reply(
             'Beijing, Beijing, China (39.91, 116.40): 2015-11-02 06:04')
 
+    @CommandTestMixin.use_cassette('geonames/time-simple')
+    @inlineCallbacks
+    def test_cached(self):
+        yield self.send_command('beijing')
+        yield self.assert_reply(
+            'Beijing, Beijing, China (39.91, 116.40): 2015-11-02 06:04')
+        # The cassette would fail any further requests.
+        self.command.utcnow = lambda: datetime(2015, 11, 1, 23, 04)
+        yield self.send_command('  BEIJING ')
+        yield self.assert_reply(
+            'Beijing, Beijing, China (39.91, 116.40): 2015-11-02 07:04')
+
+    @inlineCallbacks
+    def test_offline(self):
+        self.use_index()
+        self.command.agent = Mock()
+        yield self.send_command('peking')
+        yield self.assert_reply(
+            'Beijing, Beijing, China (39.91, 116.40): 2015-11-02 06:04')
+        self.assertFalse(self.command.agent.request.called)
+        # The index's time zone is used directly, not cached.
+        self.assertFalse(self.command.caches[None].entries)
+
     @inlineCallbacks
     def test_tzdata(self):
         yield self.send_command('UTC')
@@ -48,3 +153,146 @@ class WeatherTestCase(GeoNamesTestMixin, TestCase):
             Beijing, Beijing, China (39.91, 116.40): 2.0°C/35.6°F,
             clouds and visibility OK, 74% humidity from Beijing (ZBAA)
             as of 4 minutes ago"""))
+
+    @CommandTestMixin.use_cassette('geonames/weather-simple')
+    @inlineCallbacks
+    def test_cached(self):
+        yield self.send_command('beijing')
+        yield self.send_command('Beijing')
+        yield self.assert_reply(collapse(u"""\
+            Beijing, Beijing, China (39.91, 116.40): 2.0°C/35.6°F,
+            clouds and visibility OK, 74% humidity from Beijing (ZBAA)
+            as of 4 minutes ago"""))
+        self.assertEqual(list(self.command.observations), ['ZBAA'])
+
+    @inlineCallbacks
+    def test_retired_station(self):
+        cache = GeoCache()
+        location = Location(u'Beijing, Beijing, China', u'39.9075',
+                            u'116.39723')
+        cache.put('location', u'beijing', list(location))
+        cache.put('station', location_key(location), u'ZZZZ')
+        observation = {'ICAO': u'ZBAA', 'datetime': u'2015-11-01 22:00:00'}
+        responses = {'weatherIcaoJSON': {'status': {'value': 15}},
+                     'findNearByWeatherJSON':
+                         {'weatherObservation': observation}}
+        self.command.agent = Mock()
+        self.command.agent.request.side_effect = lambda method, uri: succeed(
+            JSONResponse(responses[uri.split('?')[0].rsplit('/', 1)[1]]))
+        self.assertEqual(
+            (yield self.command.observe(location, 'USERNAME', cache)),
+            observation)
+        self.assertEqual(cache.get('station', location_key(location)),
+                         u'ZBAA')
+
+    @CommandTestMixin.use_cassette('geonames/weather-offline')
+    @inlineCallbacks
+    def test_offline(self):
+        self.use_index()
+        yield self.send_command('beijing')
+        yield self.assert_reply(collapse(u"""\
+            Beijing, Beijing, China (39.91, 116.40): 2.0°C/35.6°F,
+            clouds and visibility OK, 74% humidity from Beijing (ZBAA)
+            as of 4 minutes ago"""))
+
+
+class GeoNamesIndexTestCase(TestCase):
+    def setUp(self):
+        self.index = GeoNamesIndex(self.mktemp())
+        self.assertEqual(
+            self.index.load(PLACES, COUNTRIES, ADMIN1_CODES), 3)
+
+    def assert_lookup(self, query, name, lat, lng, timezone_id):
+        self.assertEqual(self.index.lookup(query),
+                         (Location(name, lat, lng), timezone_id))
+
+    def test_name(self):
+        self.assert_lookup(u'  BEIJING ', u'Beijing, Beijing, China',
+                           39.9075, 116.39723, u'Asia/Shanghai')
+
+    def test_alternate_name(self):
+        self.assert_lookup(u'北京', u'Beijing, Beijing, China',
+                           39.9075, 116.39723, u'Asia/Shanghai')
+
+    def test_prefix(self):
+        self.assert_lookup(u'beij', u'Beijing, Beijing, China',
+                           39.9075, 116.39723, u'Asia/Shanghai')
+        self.assert_lookup(u'pek', u'Beijing, Beijing, China',
+                           39.9075, 116.39723, u'Asia/Shanghai')
+
+    def test_ambiguous_prefix(self):
+        self.assertIsNone(self.index.lookup(u'port'))
+        self.assertIsNone(self.index.lookup(u'p'))
+        self.assert_lookup(u'port, me', u'Portland, Maine, United States',
+                           43.66147, -70.25533, u'America/New_York')
+
+    def test_population(self):
+        self.assert_lookup(u'portland', u'Portland, Oregon, United States',
+                           45.52345, -122.67621, u'America/Los_Angeles')
+
+    def test_qualifiers(self):
+        self.assert_lookup(u'Portland, Maine', u'Portland, Maine, '
+                           u'United States', 43.66147, -70.25533,
+                           u'America/New_York')
+        self.assert_lookup(u'portland, me, us', u'Portland, Maine, '
+                           u'United States', 43.66147, -70.25533,
+                           u'America/New_York')
+        self.assertIsNone(self.index.lookup(u'Portland, China'))
+
+    def test_feature_classes(self):
+        self.assertIsNone(self.index.lookup(u'beijing shi'))
+
+    def test_no_index(self):
+        self.assertIsNone(GeoNamesIndex().lookup(u'beijing'))
+
+
+class GeoCacheTestCase(TestCase):
+    def test_lru(self):
+        cache = GeoCache(size=2)
+        cache.put('location', u'a', 1)
+        cache.put('location', u'b', 2)
+        cache.get('location', u'a')
+        cache.put('timezone', u'a', 3)
+        self.assertIsNone(cache.get('location', u'b'))
+        self.assertEqual(cache.get('location', u'a'), 1)
+        self.assertEqual(cache.get('timezone', u'a'), 3)
+
+    def test_persistence(self):
+        path = self.mktemp()
+        clock = Clock()
+        cache = GeoCache(path, size=1, clock=clock)
+        cache.put('location', u'beijing', [u'Beijing', u'39.9', u'116.4'])
+        cache.put('timezone', u'39.9,116.4', u'Asia/Shanghai')
+        # Evicted from memory, but still waiting to be written.
+        self.assertEqual(cache.get('location', u'beijing'),
+                         [u'Beijing', u'39.9', u'116.4'])
+        self.assertIsNone(GeoCache(path).get('timezone', u'39.9,116.4'))
+        clock.advance(cache.flush_delay)
+        self.assertEqual(GeoCache(path).get('timezone', u'39.9,116.4'),
+                         u'Asia/Shanghai')
+        cache.delete('timezone', u'39.9,116.4')
+        cache.close()
+        self.assertIsNone(GeoCache().get('location', u'beijing'))
+        reopened = GeoCache(path)
+        self.assertEqual(reopened.get('location', u'beijing'),
+                         [u'Beijing', u'39.9', u'116.4'])
+        self.assertIsNone(reopened.get('timezone', u'39.9,116.4'))
+        self.assertFalse(clock.getDelayedCalls())
+
+    def test_memory_only(self):
+        clock = Clock()
+        cache = GeoCache(clock=clock)
+        cache.put('location', u'a', 1)
+        self.assertFalse(clock.getDelayedCalls())
+
+    def test_close_at_shutdown(self):
+        path = self.mktemp()
+        clock = Clock()
+        default_caches[path] = GeoCache(path, clock=clock)
+        self.addCleanup(default_caches.clear)
+        default_caches[path].put('timezone', u'39.9,116.4', u'Asia/Shanghai')
+        close_default_caches()
+        self.assertFalse(default_caches)
+        self.assertFalse(clock.getDelayedCalls())
+        self.assertEqual(GeoCache(path).get('timezone', u'39.9,116.4'),
+                         u'Asia/Shanghai')
@@ -2,11 +2,11 @@
 """Event plugins for Google searches."""
 
 
-from collections import Iterator
+from collections import Iterator, OrderedDict
 import urllib
 
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import readBody
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 
 from ...message import collapse
 from ...plugin import EventPlugin, UserVisibleError
@@ -14,21 +14,126 @@ from ...web.html import textify
 from ...web.http import default_agent, read_json_body
 
 
+#: The number of seconds a cached result page is considered current.
+CACHE_TTL = 3600
+
+#: The maximum number of result pages to cache.
+CACHE_SIZE = 256
+
+#: Google API error reasons indicating that the search quota has been
+#: exhausted, in which case stale cached pages are used instead.
+QUOTA_ERROR_REASONS = frozenset(['dailyLimitExceeded', 'rateLimitExceeded',
+                                 'userRateLimitExceeded', 'quotaExceeded'])
+
+#: Once this few results remain from the current page, the next page is
+#: requested in the background.
+PREFETCH_THRESHOLD = 3
+
+
+def is_quota_error(data):
+    """Return `True` if the decoded API response *data* reports that
+    the search quota has been exhausted."""
+    error = data.get('error')
+    if not error:
+        return False
+    if error.get('code') == 429:
+        return True
+    return any(detail.get('reason') in QUOTA_ERROR_REASONS
+               for detail in error.get('errors', ()))
+
+
+class PageCache(object):
+    """A least-recently-used cache holding at most *size* decoded result
+    pages shared between searches.  Pages are current for *ttl* seconds,
+    unless a lookup asks for a different lifetime, after which they are
+    kept only as a fallback for when the search quota runs out."""
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL, clock=reactor):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def get(self, key, ttl=None):
+        """Return the page cached under *key* if it was stored less than
+        *ttl* seconds ago, defaulting to this cache's `ttl`, or `None`
+        otherwise."""
+        if ttl is None:
+            ttl = self.ttl
+        entry = self.entries.get(key)
+        if entry is None or entry[0] + ttl <= self.clock.seconds():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = self.entries.pop(key)
+        return entry[1]
+
+    def get_stale(self, key):
+        """Return the page cached under *key*, whether or not it is
+        still current, or `None`."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.stale_hits += 1
+        return entry[1]
+
+    def put(self, key, data):
+        """Cache the page *data* under *key*."""
+        self.entries.pop(key, None)
+        self.entries[key] = (self.clock.seconds(), data)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def statistics(self):
+        """Return a dictionary of statistics about this cache's use:
+
+        * ``hits``, the number of pages answered from the cache.
+        * ``misses``, the number of pages that had to be fetched.
+        * ``stale_hits``, the number of expired pages used because the
+          search quota was exhausted.
+        * ``hit_ratio``, the fraction of page requests answered from
+          the cache, including stale hits.
+        * ``entries``, the number of pages currently cached.
+        """
+        requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'hit_ratio': ((self.hits + self.stale_hits) / float(requests)
+                              if requests else 0.0),
+                'entries': len(self.entries)}
+
+
 class SearchIterator(Iterator):
     """An iterator returnable as an Omnipresence reply that fetches new
-    Google result pages on demand."""
+    Google result pages on demand.  The next page is requested ahead of
+    time once fewer than *prefetch_threshold* results remain.  If
+    *cache* is a `PageCache`, pages are looked up there before being
+    requested, and used if they were stored less than *cache_ttl*
+    seconds ago, or the cache's own lifetime if it is not given."""
 
     endpoint_uri = 'https://www.googleapis.com/customsearch/v1'
 
-    def __init__(self, agent, num, key, cx, q):
+    def __init__(self, agent, num, key, cx, q,
+                 prefetch_threshold=PREFETCH_THRESHOLD, cache=None,
+                 cache_ttl=None):
         self.agent = agent
         self.num = num
         self.key = key
         self.cx = cx
         self.q = q
+        self.prefetch_threshold = prefetch_threshold
+        self.cache = cache
+        self.cache_ttl = cache_ttl
         self.items = []
         self.start = 1
         self.total_results = NotImplemented
+        #: A `Deferred` yielding the next result page's data, or `None`
+        #: if it failed, while a prefetch is in progress.
+        self.prefetch = None
 
     @staticmethod
     def format_item(item):
@@ -38,28 +143,71 @@ class SearchIterator(Iterator):
         return u'{} \u2014 \x02{}\x02: {}'.format(
             item['link'], item['title'], textify(snippet))
 
+    def fetch_page(self, start):
+        """Return a `Deferred` yielding the decoded API response for the
+        result page beginning at *start*.  Cancelling it cancels the
+        underlying request."""
+        key = (self.cx, self.q, self.num, start)
+        if self.cache is not None:
+            data = self.cache.get(key, self.cache_ttl)
+            if data is not None:
+                return succeed(data)
+        query_string = urllib.urlencode([
+            ('key', self.key),
+            ('cx', self.cx),
+            ('q', self.q),
+            ('num', self.num),
+            ('start', start)])
+        # Build the chain on the agent's own Deferred, instead of using
+        # inlineCallbacks, so that cancellation reaches the request.
+        fetch = self.agent.request(
+            'GET', '{}?{}'.format(self.endpoint_uri, query_string))
+        fetch.addCallback(read_json_body)
+        fetch.addCallback(self._fetched, key)
+        return fetch
+
+    def _fetched(self, data, key):
+        if self.cache is not None:
+            if 'error' not in data:
+                self.cache.put(key, data)
+            elif is_quota_error(data):
+                data = self.cache.get_stale(key) or data
+        return data
+
+    def _start_prefetch(self):
+        if (self.prefetch is not None or self.start is None or
+                len(self.items) >= self.prefetch_threshold):
+            return
+        self.prefetch = self.fetch_page(self.start)
+        # Errors are dealt with when the page is actually needed, by
+        # fetching it again.
+        self.prefetch.addErrback(lambda failure: None)
+
+    def _pop_item(self):
+        self.total_results -= 1
+        item = self.items.pop(0)
+        self._start_prefetch()
+        return SearchIterator.format_item(item)
+
     @inlineCallbacks
     def next(self):
         if self.items:
-            self.total_results -= 1
-            returnValue(SearchIterator.format_item(self.items.pop(0)))
+            returnValue(self._pop_item())
         if self.start is None:
             # We can't use StopIteration because that gets eaten by
             # inlineCallbacks, so instead we just return None.
             returnValue(None)
-        query_string = urllib.urlencode([
-            ('key', self.key),
-            ('cx', self.cx),
-            ('q', self.q),
-            ('num', self.num),
-            ('start', self.start)])
-        response = yield self.agent.request(
-            'GET', '{}?{}'.format(self.endpoint_uri, query_string))
-        data = yield read_json_body(response)
+        data = None
+        prefetch, self.prefetch = self.prefetch, None
+        if prefetch is not None:
+            data = yield prefetch
+        if data is None:
+            data = yield self.fetch_page(self.start)
         if 'error' in data:
             raise UserVisibleError('Google API error: ' +
                                    data['error']['message'])
-        self.items = data.get('items')
+        # Copy the list, since the page may be shared through the cache.
+        self.items = list(data.get('items') or ())
         if not self.items:
             self.start = None
             returnValue(None)
@@ -71,8 +219,14 @@ class SearchIterator(Iterator):
             # The API will, bafflingly, return the last result if you
             # give it a start offset past the end of known results.
             self.start = None
-        self.total_results -= 1
-        returnValue(SearchIterator.format_item(self.items.pop(0)))
+        returnValue(self._pop_item())
+
+    def close(self):
+        """Cancel any page request in progress.  Called when the reply
+        buffer holding this iterator is discarded."""
+        prefetch, self.prefetch = self.prefetch, None
+        if prefetch is not None:
+            prefetch.cancel()
 
     def __length_hint__(self):
         return self.total_results
@@ -89,6 +243,14 @@ class Default(EventPlugin):
 
     __ http://stackoverflow.com/a/11206266
 
+    Result pages are cached and shared between searches for the same
+    query, even from different users or channels.  The
+    ``google.cache_ttl`` variable sets the number of seconds a cached
+    page is used for; the default is 3600 (one hour).  Expired pages
+    are still used if the search quota has been exhausted.  The plugin's
+    ``cache`` attribute is a `PageCache`, whose `~PageCache.statistics`
+    method reports how often cached pages are used.
+
     :alice: google far-out son of lung
     :bot: https://www.youtube.com/watch?v=7g0sNbHWf9k \u2014
           FSOL - Far Out Son Of Lung - YouTube: Aug 19, 2006 ... Far Out
@@ -98,14 +260,17 @@ class Default(EventPlugin):
     def __init__(self):
         self.agent = default_agent
         self.num = 10  # number of results to request at each fetch
+        self.cache = PageCache()
 
     def on_command(self, msg):
         if not msg.content:
             raise UserVisibleError('Please specify a search query.')
-        return SearchIterator(self.agent, self.num,
-                              msg.settings.get('google.key'),
-                              msg.settings.get('google.cx'),
-                              msg.content)
+        return SearchIterator(
+            self.agent, self.num,
+            msg.settings.get('google.key'), msg.settings.get('google.cx'),
+            msg.content, cache=self.cache,
+            cache_ttl=msg.settings.get('google.cache_ttl',
+                                       default=CACHE_TTL))
 
     def on_cmdhelp(self, msg):
         return collapse("""\
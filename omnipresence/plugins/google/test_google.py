@@ -3,14 +3,25 @@
 # pylint: disable=missing-docstring,too-few-public-methods
 
 
-from twisted.internet.defer import inlineCallbacks
+import json
+
+from mock import Mock
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.internet.error import ConnectError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import TestCase
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
 
 from ...compat import length_hint
 from ...message import collapse
 from ...test.helpers import CommandTestMixin
+from ...web.http import CachingAgent, CoalescingAgent
 
-from . import Default
+from . import Default, PageCache, SearchIterator
 
 
 class GoogleTestCase(CommandTestMixin, TestCase):
@@ -65,3 +76,165 @@ class GoogleTestCase(CommandTestMixin, TestCase):
             During the planet's societal height, he...
             """))
         self.assertEqual(length_hint(self.reply_buffer), 27998)
+
+
+def page(start, count, next_start=None):
+    data = {'items': [{'link': 'http://{}.test/'.format(start + i),
+                       'title': str(start + i), 'htmlSnippet': ''}
+                      for i in xrange(count)],
+            'searchInformation': {'totalResults': '100'},
+            'queries': {}}
+    if next_start is not None:
+        data['queries']['nextPage'] = [{'startIndex': next_start}]
+    return data
+
+
+class SearchIteratorTestCase(TestCase):
+    def setUp(self):
+        self.iterator = SearchIterator(None, 4, '<KEY>', '<CX>', 'q',
+                                       prefetch_threshold=2)
+        self.pages = {}
+        self.iterator.fetch_page = Mock(side_effect=self.fetch_page)
+
+    def fetch_page(self, start):
+        self.pages[start] = Deferred()
+        return self.pages[start]
+
+    def assert_next(self, number):
+        self.assertEqual(self.successResultOf(next(self.iterator)),
+                         u'http://{0}.test/ \u2014 \x02{0}\x02: '
+                         .format(number))
+
+    def test_prefetch(self):
+        first = next(self.iterator)
+        self.pages[1].callback(page(1, 4, next_start=5))
+        self.successResultOf(first)
+        self.assertNotIn(5, self.pages)
+        self.assert_next(2)
+        self.assert_next(3)
+        # Only one result remains, so the next page is on its way.
+        self.assertIn(5, self.pages)
+        self.pages[5].callback(page(5, 4))
+        self.assert_next(4)
+        self.assert_next(5)
+        self.assertEqual(self.iterator.fetch_page.call_count, 2)
+
+    def test_prefetch_pending(self):
+        next(self.iterator)
+        self.pages[1].callback(page(1, 1, next_start=2))
+        second = next(self.iterator)
+        self.assertNoResult(second)
+        self.pages[2].callback(page(2, 4))
+        self.successResultOf(second)
+        self.assertEqual(self.iterator.fetch_page.call_count, 2)
+
+    def test_prefetch_failure(self):
+        next(self.iterator)
+        self.pages[1].callback(page(1, 1, next_start=2))
+        self.pages[2].errback(ConnectError())
+        second = next(self.iterator)
+        self.assertEqual(self.iterator.fetch_page.call_count, 3)
+        self.pages[2].callback(page(2, 4))
+        self.successResultOf(second)
+
+    def test_close(self):
+        requests = []
+        cancelled = []
+
+        def request(method, uri, headers=None):
+            requests.append(Deferred(lambda d: cancelled.append(uri)))
+            return requests[-1]
+        agent = Mock()
+        agent.request.side_effect = request
+        # Cancellation has to get through the wrappers in default_agent.
+        agent = CachingAgent(CoalescingAgent(agent))
+        iterator = SearchIterator(agent, 4, '<KEY>', '<CX>', 'q',
+                                  prefetch_threshold=2)
+        first = next(iterator)
+        requests[0].callback(JSONResponse(page(1, 1, next_start=2)))
+        self.successResultOf(first)
+        self.assertEqual(len(requests), 2)
+        iterator.close()
+        self.assertEqual(len(cancelled), 1)
+        self.assertIn('start=2', cancelled[0])
+        self.assertIsNone(iterator.prefetch)
+
+
+class JSONResponse(object):
+    code = 200
+    phrase = 'OK'
+    length = UNKNOWN_LENGTH
+
+    def __init__(self, data):
+        self.body = json.dumps(data)
+        self.headers = Headers()
+
+    def deliverBody(self, protocol):
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+QUOTA_ERROR = {'error': {
+    'code': 403, 'message': 'Daily Limit Exceeded',
+    'errors': [{'reason': 'dailyLimitExceeded'}]}}
+
+
+class PageCacheTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = PageCache(ttl=60, clock=self.clock)
+        self.agent = Mock()
+        self.respond(page(1, 4))
+
+    def respond(self, data):
+        self.agent.request.side_effect = lambda *args: succeed(
+            JSONResponse(data))
+
+    def search(self, q='q'):
+        iterator = SearchIterator(self.agent, 4, '<KEY>', '<CX>', q,
+                                  cache=self.cache)
+        return self.successResultOf(next(iterator))
+
+    def test_shared(self):
+        first = self.search()
+        self.assertEqual(self.search(), first)
+        self.assertEqual(self.agent.request.call_count, 1)
+        self.search('other')
+        self.assertEqual(self.agent.request.call_count, 2)
+        self.assertEqual(self.cache.statistics(),
+                         {'hits': 1, 'misses': 2, 'stale_hits': 0,
+                          'hit_ratio': 1 / 3.0, 'entries': 2})
+
+    def test_expiry(self):
+        self.search()
+        self.clock.advance(60)
+        self.search()
+        self.assertEqual(self.agent.request.call_count, 2)
+
+    def test_ttl_per_search(self):
+        self.search()
+        self.clock.advance(30)
+        iterator = SearchIterator(self.agent, 4, '<KEY>', '<CX>', 'q',
+                                  cache=self.cache, cache_ttl=10)
+        self.successResultOf(next(iterator))
+        self.assertEqual(self.agent.request.call_count, 2)
+        self.search()
+        self.assertEqual(self.agent.request.call_count, 2)
+        self.assertEqual(self.cache.ttl, 60)
+
+    def test_quota_fallback(self):
+        first = self.search()
+        self.clock.advance(60)
+        self.respond(QUOTA_ERROR)
+        self.assertEqual(self.search(), first)
+        self.assertEqual(self.cache.statistics()['stale_hits'], 1)
+
+    def test_quota_error(self):
+        self.respond(QUOTA_ERROR)
+        iterator = SearchIterator(self.agent, 4, '<KEY>', '<CX>', 'q',
+                                  cache=self.cache)
+        failure = self.failureResultOf(next(iterator))
+        self.assertEqual(failure.getErrorMessage(),
+                         'Google API error: Daily Limit Exceeded')
+        self.assertEqual(self.cache.statistics()['entries'], 0)
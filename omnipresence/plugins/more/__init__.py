@@ -2,9 +2,6 @@
 """Event plugins for reading command reply buffers."""
 
 
-from collections import Sequence
-from itertools import tee
-
 from ...message import collapse
 from ...message.buffering import ReplyBuffer
 from ...plugin import EventPlugin, UserVisibleError
@@ -28,30 +25,38 @@ class Default(EventPlugin):
     :bot: alice: 1
     :brian: more alice
     :bot: brian: 2
+
+    A numeric argument skips that many messages ahead.
+
+    :brian: more 5
+    :bot: 9
     """
 
     def on_command(self, msg):
+        args = msg.content.split()
+        count = 0
+        if args and args[-1].isdigit():
+            count = int(args.pop())
         venue = PRIVATE_CHANNEL if msg.private else msg.venue
-        source = msg.content or msg.actor.nick
+        source = args[0] if args else msg.actor.nick
         try:
             buf = msg.connection.venues[venue].nicks[source].reply_buffer
         except KeyError:
             buf = ReplyBuffer([])
-        if msg.connection.case_mapping.equates(source, msg.actor.nick):
-            return buf
-        if msg.private:
-            raise UserVisibleError("You cannot read another user's "
-                                   "private reply buffer.")
-        # The original iterator can no longer be advanced after using
-        # `tee`, so we place one of the children back into the buffer
-        # instead.
-        one, two = buf.tee()
-        msg.connection.venues[venue].add_nick(source)
-        msg.connection.venues[venue].nicks[source].reply_buffer = one
-        return two
+        if not msg.connection.case_mapping.equates(source, msg.actor.nick):
+            if msg.private:
+                raise UserVisibleError("You cannot read another user's "
+                                       "private reply buffer.")
+            # Read from an independent cursor, leaving the other user's
+            # own position in their buffer untouched.
+            buf = ReplyBuffer(buf)
+        buf.skip(count)
+        return buf
 
     def on_cmdhelp(self, msg):
         return collapse("""\
-            [\x1Fnick\x1F] - Return the next message in \x1Fnick\x1F's
-            command reply buffer, or your own if no nick is specified.
+            [\x1Fnick\x1F] [\x1Fcount\x1F] - Return the next message
+            in \x1Fnick\x1F's command reply buffer, or your own if no
+            nick is specified.  If \x1Fcount\x1F is given, skip that
+            many messages first.
             """)
@@ -54,6 +54,18 @@ class MoreTestCase(CommandTestMixin, TestCase):
         self.assert_reply('party3', '2 (+7 more)')
         self.assert_reply('', '2 (+7 more)', actor='party3')
 
+    def test_skip(self):
+        self.buffer_reply('#foo', self.other_users[0].nick,
+                          map(str, xrange(10)))
+        self.assert_reply('2', '2 (+7 more)')
+        self.assert_reply('', '3 (+6 more)')
+        self.assert_reply('100', 'No results.')
+
+    def test_other_buffer_skip(self):
+        self.buffer_reply('#foo', 'party3', map(str, xrange(10)))
+        self.assert_reply('party3 2', '2 (+7 more)')
+        self.assert_reply('', '0 (+9 more)', actor='party3')
+
     def test_other_buffer_iterator(self):
         self.buffer_reply('#foo', 'party3', imap(str, count()))
         self.assert_reply('party3', '0')
@@ -2,21 +2,25 @@
 """Event plugins for Microsoft Translator."""
 
 
+from collections import OrderedDict
 import json
+import os
 import re
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
-import time
 import urllib
 
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import readBody
+from twisted.internet import reactor
+from twisted.internet.defer import (Deferred, inlineCallbacks, returnValue,
+                                    succeed)
+from twisted.logger import Logger
+from twisted.python.failure import Failure
 from twisted.web.http_headers import Headers
 
 from ...plugin import EventPlugin, UserVisibleError
-from ...web.http import default_agent, read_json_body
+from ...web.http import default_agent, read_body, read_json_body
 
 
 #: The default target language to use if neither the user nor the plugin
@@ -38,11 +42,47 @@ AUTH_URL = 'https://api.cognitive.microsoft.com/sts/v1.0/issueToken'
 # of 10 minutes, but recommend obtaining a new token every 8.
 AUTH_TOKEN_TTL = 480
 
+#: The number of seconds before a token expires at which a new one is
+#: requested in the background.
+AUTH_TOKEN_REFRESH_MARGIN = 60
+
+#: The number of seconds to wait before retrying a failed background
+#: token request.
+AUTH_TOKEN_RETRY_DELAY = 30
+
+#: The number of seconds a list of supported languages is used before
+#: it is fetched again in the background.
+LANGUAGES_TTL = 86400
+
+#: The default number of seconds to wait for more translation requests
+#: to send together with the first one.
+BATCH_WINDOW = 0.05
+
+#: The maximum number of texts to send in a single request.
+MAX_BATCH_TEXTS = 25
+
+#: The maximum number of bytes of encoded texts to send in a single
+#: request, which keeps its URL well within common length limits.
+MAX_BATCH_BYTES = 4096
+
+#: The maximum number of translations to cache.
+CACHE_SIZE = 512
+
 #: The URL of the Microsoft Translator Text Translation API.  The format
 #: template item is replaced with the operation.
 TRANSLATOR_URL = 'https://api.microsofttranslator.com/V2/Ajax.svc/{}'
 
 
+#: The HTTP status codes with which Microsoft Translator rejects the
+#: texts in a request, as opposed to the request as a whole.
+REJECTED_CODES = frozenset([400, 414])
+
+
+class TranslationRejected(IOError):
+    """Raised when Microsoft Translator rejects the texts it was asked
+    to translate."""
+
+
 def default_target(msg):
     """Return the default target specified in the settings for *msg*, or
     `DEFAULT_TARGET` if none is set."""
@@ -50,6 +90,224 @@ def default_target(msg):
                             default=DEFAULT_TARGET)
 
 
+class TokenManager(object):
+    """Obtains Microsoft Cognitive Services authentication tokens for
+    *subscription_key*, making at most one token request at a time.
+    Once a token has been obtained, a new one is requested in the
+    background shortly before it expires, so that callers of `get`
+    never have to wait for one again."""
+
+    log = Logger()
+
+    def __init__(self, agent, subscription_key, clock=reactor):
+        self.agent = agent
+        self.subscription_key = subscription_key
+        self.clock = clock
+        #: The last authentication token obtained, or `None` if none has
+        #: been obtained yet.
+        self.token = None
+        #: The timestamp at which `token` expires.
+        self.expiry = -1
+        #: A list of `Deferred` objects waiting on the token request in
+        #: progress, or `None` if there is no such request.
+        self.waiters = None
+        #: The `IDelayedCall` for the next background token request.
+        self.refresh_call = None
+
+    @inlineCallbacks
+    def request_token(self):
+        """Request a new token, and return a `Deferred` yielding it."""
+        headers = Headers()
+        headers.addRawHeader('Ocp-Apim-Subscription-Key',
+                             self.subscription_key)
+        headers.addRawHeader('Content-Length', '0')
+        response = yield self.agent.request('POST', AUTH_URL, headers=headers)
+        if response.code != 200:
+            data = yield read_body(response)
+            self.log.error(
+                'Could not authenticate to Microsoft Cognitive '
+                'Services: {data}', data=data)
+            raise UserVisibleError(
+                'Could not authenticate to Microsoft Cognitive '
+                'Services. Try again later.')
+        # Coerce the access token to a byte string to avoid problems
+        # inside Twisted's header handling code down the line.
+        returnValue((yield read_body(response)).strip().decode('ascii'))
+
+    def get(self):
+        """Return a `Deferred` yielding a valid token, requesting one
+        only if there is none."""
+        if self.token is not None and self.expiry > self.clock.seconds():
+            return succeed(self.token)
+        return self._issue()
+
+    def _issue(self):
+        finished = Deferred()
+        if self.waiters is not None:
+            self.waiters.append(finished)
+            return finished
+        self.waiters = [finished]
+        issued = self.request_token()
+        issued.addCallbacks(self._issued, self._fan_out,
+                            callbackArgs=(self.clock.seconds(),))
+        return finished
+
+    def _issued(self, token, start_time):
+        self.token = token
+        self.expiry = start_time + AUTH_TOKEN_TTL
+        self._schedule(AUTH_TOKEN_TTL - AUTH_TOKEN_REFRESH_MARGIN)
+        self._fan_out(token)
+
+    def _fan_out(self, result):
+        waiters, self.waiters = self.waiters, None
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+    def _schedule(self, delay):
+        if self.refresh_call is not None and self.refresh_call.active():
+            self.refresh_call.cancel()
+        self.refresh_call = self.clock.callLater(delay, self.refresh)
+
+    def refresh(self):
+        """Request a new token in the background, continuing to hand
+        out the current one until it arrives."""
+        self.refresh_call = None
+        self._issue().addErrback(self._refresh_failed)
+
+    def _refresh_failed(self, failure):
+        self.log.failure('Could not renew Microsoft Cognitive Services '
+                         'authentication token', failure=failure)
+        # Keep trying for as long as the current token is good.  After
+        # that, the next caller requests a new one.
+        if (self.expiry - self.clock.seconds() >
+                AUTH_TOKEN_RETRY_DELAY):
+            self._schedule(AUTH_TOKEN_RETRY_DELAY)
+
+    def stop(self):
+        """Stop requesting tokens in the background."""
+        if self.refresh_call is not None and self.refresh_call.active():
+            self.refresh_call.cancel()
+        self.refresh_call = None
+
+
+class TranslationCache(object):
+    """A least-recently-used cache holding at most *size* translations,
+    keyed on tuples of source language, target language, and text."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """Return the translation cached under *key*, or `None`."""
+        translation = self.entries.pop(key, None)
+        if translation is not None:
+            self.entries[key] = translation
+        return translation
+
+    def put(self, key, translation):
+        """Cache *translation* under *key*."""
+        self.entries.pop(key, None)
+        self.entries[key] = translation
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+def encoded_size(text):
+    """Return the number of bytes the byte string *text* takes up in
+    the query string of a ``TranslateArray`` request."""
+    return len(urllib.quote_plus(json.dumps(text))) + len('%2C+')
+
+
+class TranslationBatcher(object):
+    """Collects translation requests between the same pair of languages
+    made close together, and passes their texts to *translate* in
+    batches of at most `MAX_BATCH_TEXTS` texts and `MAX_BATCH_BYTES`
+    bytes.  *translate* is called with the source language, the target
+    language, and a list of texts, and returns a `Deferred` yielding a
+    list of their translations.  If a batch fails with
+    `TranslationRejected`, its texts are sent again one at a time, so
+    that one bad text only fails the requests for it.  Other failures
+    are passed on to every request in the batch."""
+
+    def __init__(self, translate, clock=reactor):
+        self.translate = translate
+        self.clock = clock
+        #: A dictionary mapping ``(source, target)`` tuples to lists of
+        #: ``(text, deferred)`` tuples waiting to be sent.
+        self.pending = {}
+        #: A dictionary mapping ``(source, target)`` tuples to the
+        #: `IDelayedCall` objects that will send their pending texts.
+        self.calls = {}
+
+    def add(self, source, target, text, window=BATCH_WINDOW):
+        """Return a `Deferred` yielding the translation of *text* from
+        *source* to *target*, which is requested along with any others
+        for the same languages within the next *window* seconds."""
+        finished = Deferred()
+        key = (source, target)
+        size = encoded_size(text)
+        if size + sum(encoded_size(pending_text) for pending_text, _
+                      in self.pending.get(key, ())) > MAX_BATCH_BYTES:
+            self.flush(key)
+        self.pending.setdefault(key, []).append((text, finished))
+        if window <= 0 or len(self.pending[key]) >= MAX_BATCH_TEXTS:
+            self.flush(key)
+        elif key not in self.calls:
+            self.calls[key] = self.clock.callLater(window, self.flush, key)
+        elif self.calls[key].getTime() > self.clock.seconds() + window:
+            # Don't make this request wait longer than it asked to.
+            self.calls[key].reset(window)
+        return finished
+
+    def flush(self, key):
+        """Send the texts waiting to be translated between the languages
+        in the tuple *key*."""
+        call = self.calls.pop(key, None)
+        if call is not None and call.active():
+            call.cancel()
+        requests = self.pending.pop(key, [])
+        if not requests:
+            return
+        texts = list(OrderedDict.fromkeys(text for text, _ in requests))
+        self._send(key, texts, requests)
+
+    def _send(self, key, texts, requests):
+        translated = self.translate(key[0], key[1], texts)
+        translated.addCallback(self._check, texts)
+        translated.addCallbacks(self._split, self._failed,
+                                callbackArgs=(texts, requests),
+                                errbackArgs=(key, texts, requests))
+
+    @staticmethod
+    def _check(translations, texts):
+        if len(translations) != len(texts):
+            raise TranslationRejected(
+                'expected {} translations, got {}'.format(
+                    len(texts), len(translations)))
+        return translations
+
+    @staticmethod
+    def _split(translations, texts, requests):
+        by_text = dict(zip(texts, translations))
+        for text, finished in requests:
+            finished.callback(by_text[text])
+
+    def _failed(self, failure, key, texts, requests):
+        # Retrying texts separately won't help if the failure has
+        # nothing to do with them, as with authentication errors.
+        if len(texts) == 1 or not failure.check(TranslationRejected):
+            for _, finished in requests:
+                finished.errback(failure)
+            return
+        for text in texts:
+            self._send(key, [text], [request for request in requests
+                                     if request[0] == text])
+
+
 class Default(EventPlugin):
     """Translate text between languages with Microsoft Translator.
 
@@ -64,6 +322,18 @@ class Default(EventPlugin):
     two-letter language code specifying the target language to use if
     the user does not specify one.  It defaults to ``en`` for English.
 
+    Both variables may be set differently for each channel.  The bot
+    obtains an authentication token and the list of supported languages
+    when it connects or joins a channel, and keeps the token fresh in
+    the background, so that translations never wait on them.  If the
+    ``mstranslate.cache_path`` variable is set to a file path, the
+    language list is saved there and reused across restarts.
+
+    Recent translations are cached.  Requests between the same pair of
+    languages that arrive within ``mstranslate.batch_window`` seconds of
+    each other, 0.05 by default, are sent to Microsoft Translator in a
+    single request.  Set it to 0 to send each request immediately.
+
     :alice: mstranslate hola
     :bot: Hello
     :alice: mstranslate hola de:
@@ -73,81 +343,203 @@ class Default(EventPlugin):
     def __init__(self):
         self.agent = default_agent
 
-        #: The set of valid language codes.
-        self.languages = None
-
-        # TODO:  For strictly correct per-channel request behavior, the
-        # following properties need to be keyed on the settings venue.
+        #: The `IReactorTime` provider used to schedule background
+        #: token requests.
+        self.clock = reactor
 
-        #: The bot's Microsoft Cognitive Services subscription key.
-        self.subscription_key = None
+        #: A dictionary mapping subscription keys to `TokenManager`
+        #: objects.
+        self.tokens = {}
 
-        #: The last authentication token obtained, or `None` if none has
-        #: been requested yet.
-        self.auth_token = None
+        #: The set of valid language codes.
+        self.languages = None
 
-        #: The timestamp at which `auth_token` expires.
-        self.token_expiry = -1
+        #: The timestamp at which `languages` was fetched.
+        self.languages_fetched = None
+
+        #: A list of `Deferred` objects waiting on the language list
+        #: request in progress, or `None` if there is no such request.
+        self.languages_pending = None
+
+        #: A dictionary mapping subscription keys to the
+        #: `TranslationBatcher` objects collecting their requests.
+        self.batchers = {}
+
+        #: The `TranslationCache` of recent translations.
+        self.cache = TranslationCache()
+
+    def subscription_key(self, msg):
+        """Return the subscription key to use for *msg*, or raise
+        `UserVisibleError` if none has been set."""
+        subscription_key = msg.settings.get('mstranslate.subscription_key')
+        if subscription_key is None:
+            self.log.error(
+                'No Microsoft Cognitive Services subscription key '
+                'has been specified in the Omnipresence settings. '
+                'Set the "mstranslate.subscription_key" variable '
+                'to a valid key, and reload the bot settings.')
+            raise UserVisibleError(
+                'Could not authenticate to Microsoft Cognitive Services.')
+        return subscription_key
+
+    def obtain_auth_token(self, subscription_key):
+        """Return a `Deferred` yielding a valid Microsoft Cognitive
+        Services authentication token for *subscription_key*."""
+        if subscription_key not in self.tokens:
+            self.tokens[subscription_key] = TokenManager(
+                self.agent, subscription_key, self.clock)
+        return self.tokens[subscription_key].get()
 
     @inlineCallbacks
-    def obtain_auth_token(self):
-        """Return a valid Microsoft Cognitive Services authentication
-        token, obtained with the current subscription key if necessary.
-        """
-        start_time = time.time()
-        if self.auth_token is None or self.token_expiry < start_time:
-            headers = Headers()
-            headers.addRawHeader('Ocp-Apim-Subscription-Key',
-                                 self.subscription_key)
-            headers.addRawHeader('Content-Length', '0')
-            response = yield self.agent.request(
-                'POST', AUTH_URL, headers=headers)
-            if response.code != 200:
-                data = yield readBody(response)
-                self.log.error(
-                    'Could not authenticate to Microsoft Cognitive '
-                    'Services: {data}', data=data)
-                raise UserVisibleError(
-                    'Could not authenticate to Microsoft Cognitive '
-                    'Services. Try again later.')
-            # Coerce the access token to a byte string to avoid problems
-            # inside Twisted's header handling code down the line.
-            self.auth_token = (
-                (yield readBody(response)).strip().decode('ascii'))
-            self.token_expiry = start_time + AUTH_TOKEN_TTL
-        returnValue(self.auth_token)
-
-    @inlineCallbacks
-    def call_endpoint(self, operation, params=None):
+    def call_endpoint(self, subscription_key, operation, params=None):
         """Make a request to the Microsoft Translator API endpoint with
-        the given operation and parameters, and return the body of the
-        response."""
-        auth_token = yield self.obtain_auth_token()
+        the given operation and parameters, authenticating with
+        *subscription_key*, and return the body of the response."""
+        auth_token = yield self.obtain_auth_token(subscription_key)
         headers = Headers()
         headers.addRawHeader('Authorization', 'Bearer ' + auth_token)
         url = TRANSLATOR_URL.format(operation)
         if params is not None:
             url += '?' + urllib.urlencode(sorted(params.iteritems()))
         response = yield self.agent.request('GET', url, headers=headers)
-        returnValue(json.loads((yield readBody(response)).decode('utf-8-sig')))
+        body = (yield read_body(response)).decode('utf-8-sig')
+        if response.code != 200:
+            error_class = (TranslationRejected
+                           if response.code in REJECTED_CODES else IOError)
+            raise error_class('Microsoft Translator returned HTTP {}: {}'
+                              .format(response.code,
+                                      body.encode(errors='replace')))
+        returnValue(json.loads(body))
 
     @inlineCallbacks
-    def initialize(self, msg):
-        if self.subscription_key is None:
-            self.subscription_key = msg.settings.get(
-                'mstranslate.subscription_key')
-            if self.subscription_key is None:
-                self.log.error(
-                    'No Microsoft Cognitive Services subscription key '
-                    'has been specified in the Omnipresence settings. '
-                    'Set the "mstranslate.subscription_key" variable '
-                    'to a valid key, and reload the bot settings.')
-                raise UserVisibleError(
-                    'Could not authenticate to Microsoft Cognitive Services.')
+    def translate_texts(self, subscription_key, source, target, texts):
+        """Return a `Deferred` yielding a list of the translations of
+        the byte strings in *texts* from *source*, or an automatically
+        detected language if *source* is `None`, to *target*."""
+        params = {'to': target}
+        if source is not None:
+            params['from'] = source
+        if len(texts) == 1:
+            params['text'] = texts[0]
+            translation = yield self.call_endpoint(
+                subscription_key, 'Translate', params)
+            if 'Exception:' in translation:
+                raise TranslationRejected(
+                    translation.encode(errors='replace'))
+            returnValue([translation])
+        params['texts'] = json.dumps(texts)
+        translations = yield self.call_endpoint(
+            subscription_key, 'TranslateArray', params)
+        if isinstance(translations, basestring):
+            raise TranslationRejected(
+                translations.encode(errors='replace'))
+        returnValue([result['TranslatedText'] for result in translations])
+
+    def translate(self, subscription_key, source, target, text, window):
+        """Return a `Deferred` yielding the translation of the byte
+        string *text*, from the cache if possible, or else batched with
+        other requests made within *window* seconds."""
+        key = (source, target, text)
+        translation = self.cache.get(key)
+        if translation is not None:
+            return succeed(translation)
+        if subscription_key not in self.batchers:
+            self.batchers[subscription_key] = TranslationBatcher(
+                lambda *args: self.translate_texts(subscription_key, *args),
+                self.clock)
+        translated = self.batchers[subscription_key].add(
+            source, target, text, window)
+        translated.addCallback(self._translated, key)
+        return translated
+
+    def _translated(self, translation, key):
+        self.cache.put(key, translation)
+        return translation
+
+    def load_languages(self, path):
+        """Load the language list saved at *path*, if there is one."""
+        try:
+            with open(path, 'rb') as cache_file:
+                data = json.load(cache_file)
+            self.languages = frozenset(data['languages'])
+            self.languages_fetched = data['fetched']
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def save_languages(self, path):
+        """Save the language list to *path*."""
+        with open(path + '.tmp', 'wb') as cache_file:
+            json.dump({'languages': sorted(self.languages),
+                       'fetched': self.languages_fetched}, cache_file)
+        os.rename(path + '.tmp', path)
+
+    def fetch_languages(self, subscription_key, path=None):
+        """Fetch the list of supported languages, saving it to *path* if
+        given, and return a `Deferred` that fires when it is done.  Only
+        one request is made at a time."""
+        finished = Deferred()
+        if self.languages_pending is not None:
+            self.languages_pending.append(finished)
+            return finished
+        self.languages_pending = [finished]
+        fetch = self.call_endpoint(subscription_key,
+                                   'GetLanguagesForTranslate')
+        fetch.addCallback(self._languages_fetched, path)
+        fetch.addBoth(self._languages_fan_out)
+        return finished
+
+    def _languages_fetched(self, languages, path):
+        self.languages = frozenset(languages)
+        self.languages_fetched = self.clock.seconds()
+        if path is not None:
+            self.save_languages(path)
+
+    def _languages_fan_out(self, result):
+        waiters, self.languages_pending = self.languages_pending, None
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
 
+    @inlineCallbacks
+    def initialize(self, msg):
+        """Make sure that an authentication token for *msg*'s
+        subscription key and the language list are available."""
+        subscription_key = self.subscription_key(msg)
+        yield self.obtain_auth_token(subscription_key)
+        path = msg.settings.get('mstranslate.cache_path')
+        if self.languages is None and path is not None:
+            self.load_languages(path)
         if self.languages is None:
-            self.languages = frozenset((
-                yield self.call_endpoint('GetLanguagesForTranslate')))
+            yield self.fetch_languages(subscription_key, path)
+        elif (self.clock.seconds() - self.languages_fetched >
+                LANGUAGES_TTL):
+            # Use the old list until the new one arrives.
+            self.fetch_languages(subscription_key, path).addErrback(
+                lambda failure: self.log.failure(
+                    'Could not update Microsoft Translator language list',
+                    failure=failure))
+
+    def warm_up(self, msg):
+        """Obtain an authentication token and language list for *msg*'s
+        settings ahead of any commands, if a subscription key is set."""
+        if msg.settings.get('mstranslate.subscription_key') is None:
+            return None
+        return self.initialize(msg)
+
+    def on_connected(self, msg):
+        return self.warm_up(msg)
+
+    def on_join(self, msg):
+        if msg.actor.matches(msg.connection.nickname):
+            return self.warm_up(msg)
+        return None
+
+    def on_disconnected(self, msg):
+        for manager in self.tokens.itervalues():
+            manager.stop()
+        self.tokens.clear()
 
     @inlineCallbacks
     def on_command(self, msg):
@@ -159,40 +551,37 @@ class Default(EventPlugin):
         if match is None:
             raise UserVisibleError("Couldn't parse argument string.")
 
-        params = {'to': default_target(msg)}
         text = match.group('text')
         source = match.group('from')
         target = match.group('to')
 
         # Check the validity of the source language code.
-        if source is not None:
-            if source in self.languages:
-                params['from'] = source
-            else:
-                text = u'{}:{}'.format(source, text)
+        if source is not None and source not in self.languages:
+            text = u'{}:{}'.format(source, text)
+            source = None
         # Same for the target language code.
-        if target is not None:
-            if target in self.languages:
-                params['to'] = target
-            else:
-                text = u'{} {}:'.format(text, target)
+        if target is not None and target not in self.languages:
+            text = u'{} {}:'.format(text, target)
+            target = None
 
-        params['text'] = text.encode('utf-8').strip()
-        if not params['text']:
+        text = text.encode('utf-8').strip()
+        if not text:
             raise UserVisibleError('Please specify a string to translate.')
 
-        translation = yield self.call_endpoint('Translate', params)
-        if 'Exception:' in translation:
-            raise IOError(translation.encode(errors='replace'))
+        translation = yield self.translate(
+            self.subscription_key(msg), source, target or default_target(msg),
+            text, msg.settings.get('mstranslate.batch_window',
+                                   default=BATCH_WINDOW))
         returnValue(translation)
 
     @inlineCallbacks
     def on_cmdhelp(self, msg):
         if msg.content == 'languages':
             yield self.initialize(msg)
-            language_names = yield self.call_endpoint('GetLanguageNames', {
-                'languageCodes': json.dumps(list(self.languages)),
-                'locale': default_target(msg)})
+            language_names = yield self.call_endpoint(
+                self.subscription_key(msg), 'GetLanguageNames', {
+                    'languageCodes': json.dumps(list(self.languages)),
+                    'locale': default_target(msg)})
             if not language_names:
                 returnValue(u'No supported languages were found.')
             codes_to_names = zip(self.languages, language_names)
@@ -3,12 +3,23 @@
 # pylint: disable=missing-docstring,too-few-public-methods
 
 
-from twisted.internet.defer import inlineCallbacks
+import json
+
+from mock import Mock
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.internet.error import ConnectError
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import TestCase
+from twisted.web.client import Response
+from twisted.web.http_headers import Headers
 
+from ...message import Message
+from ...plugin import UserVisibleError
 from ...test.helpers import CommandTestMixin
 
-from . import Default
+from . import (AUTH_TOKEN_TTL, BATCH_WINDOW, MAX_BATCH_BYTES, Default,
+               TokenManager, TranslationCache, TranslationRejected)
 
 
 class MicrosoftTranslatorTestCase(CommandTestMixin, TestCase):
@@ -17,6 +28,8 @@ class MicrosoftTranslatorTestCase(CommandTestMixin, TestCase):
     def setUp(self):
         super(MicrosoftTranslatorTestCase, self).setUp()
         self.connection.settings.set('mstranslate.subscription_key', '<KEY>')
+        self.connection.settings.set('mstranslate.batch_window', 0)
+        self.command.clock = Clock()
 
     @CommandTestMixin.use_cassette('mstranslate/no-language-spec')
     @inlineCallbacks
@@ -48,3 +61,242 @@ class MicrosoftTranslatorTestCase(CommandTestMixin, TestCase):
         yield self.send_command(u'ja:手紙 de:')
         yield self.assert_reply('Brief')
         yield self.assert_no_replies()
+
+
+class BatchingTestCase(TestCase):
+    def setUp(self):
+        self.command = Default()
+        self.clock = self.command.clock = Clock()
+        self.requests = []
+        self.command.call_endpoint = Mock(side_effect=self.call_endpoint)
+
+    def call_endpoint(self, subscription_key, operation, params):
+        self.requests.append((operation, params, Deferred()))
+        return self.requests[-1][2]
+
+    def translate(self, text, source=None, target='en'):
+        return self.command.translate('<KEY>', source, target, text,
+                                      BATCH_WINDOW)
+
+    def test_batch(self):
+        first = self.translate('hola')
+        second = self.translate('adios')
+        third = self.translate('hola')
+        self.assertEqual(self.requests, [])
+        self.clock.advance(BATCH_WINDOW)
+        self.assertEqual(len(self.requests), 1)
+        operation, params, finished = self.requests[0]
+        self.assertEqual(operation, 'TranslateArray')
+        self.assertEqual(params['to'], 'en')
+        self.assertEqual(json.loads(params['texts']), ['hola', 'adios'])
+        finished.callback([{'TranslatedText': u'Hello'},
+                           {'TranslatedText': u'Goodbye'}])
+        self.assertEqual(self.successResultOf(first), u'Hello')
+        self.assertEqual(self.successResultOf(second), u'Goodbye')
+        self.assertEqual(self.successResultOf(third), u'Hello')
+
+    def test_separate_languages(self):
+        self.translate('hola', target='en')
+        self.translate('hola', target='ja')
+        self.translate(u'手紙'.encode('utf-8'), source='ja')
+        self.clock.advance(BATCH_WINDOW)
+        self.assertEqual(
+            sorted((params.get('from'), params['to'], params['text'])
+                   for operation, params, _ in self.requests),
+            [(None, 'en', 'hola'), (None, 'ja', 'hola'),
+             ('ja', 'en', u'手紙'.encode('utf-8'))])
+        self.assertTrue(all(operation == 'Translate'
+                            for operation, _, _ in self.requests))
+
+    def test_failure(self):
+        first = self.translate('hola')
+        second = self.translate('adios')
+        self.clock.advance(BATCH_WINDOW)
+        self.requests[0][2].callback(u'ArgumentException: bad request')
+        # Each text is retried on its own.
+        self.assertEqual([params['text'] for _, params, _
+                          in self.requests[1:]], ['hola', 'adios'])
+        self.requests[1][2].callback(u'Hello')
+        self.requests[2][2].callback(u'ArgumentException: bad request')
+        self.assertEqual(self.successResultOf(first), u'Hello')
+        self.failureResultOf(second, TranslationRejected)
+
+    def test_unrelated_failure(self):
+        first = self.translate('hola')
+        second = self.translate('adios')
+        self.clock.advance(BATCH_WINDOW)
+        self.requests[0][2].errback(UserVisibleError(
+            'Could not authenticate to Microsoft Cognitive Services.'))
+        self.assertEqual(len(self.requests), 1)
+        self.failureResultOf(first, UserVisibleError)
+        self.failureResultOf(second, UserVisibleError)
+
+    def test_byte_limit(self):
+        texts = ['x' * (MAX_BATCH_BYTES // 4) + str(i) for i in xrange(4)]
+        for text in texts:
+            self.translate(text)
+        # The first batch was sent as soon as the fourth text would
+        # have pushed it over the limit.
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(json.loads(self.requests[0][1]['texts']),
+                         texts[:3])
+        self.clock.advance(BATCH_WINDOW)
+        self.assertEqual(self.requests[1][1]['text'], texts[3])
+
+    def test_shorter_window(self):
+        self.translate('hola')
+        self.command.translate('<KEY>', None, 'en', 'adios', 0)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(json.loads(self.requests[0][1]['texts']),
+                         ['hola', 'adios'])
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_cache(self):
+        first = self.translate('hola')
+        self.clock.advance(BATCH_WINDOW)
+        self.requests[0][2].callback(u'Hello')
+        self.assertEqual(self.successResultOf(first), u'Hello')
+        self.assertEqual(self.successResultOf(self.translate('hola')),
+                         u'Hello')
+        self.assertEqual(len(self.requests), 1)
+
+
+class CallEndpointTestCase(TestCase):
+    def setUp(self):
+        self.command = Default()
+        self.command.obtain_auth_token = Mock(return_value=succeed('token'))
+        self.command.agent = Mock()
+
+    def call_endpoint(self, code, body):
+        response = Response(('HTTP', 1, 1), code, 'OK', Headers(),
+                            StringTransport())
+        response._bodyDataReceived(body)
+        response._bodyDataFinished()
+        self.command.agent.request.return_value = succeed(response)
+        return self.command.call_endpoint('<KEY>', 'Translate',
+                                          {'text': 'hola'})
+
+    def test_success(self):
+        self.assertEqual(self.successResultOf(self.call_endpoint(
+            200, '\xef\xbb\xbf"Hello"')), u'Hello')
+
+    def test_rejected(self):
+        self.failureResultOf(self.call_endpoint(400, 'Bad Request'),
+                             TranslationRejected)
+
+    def test_forbidden(self):
+        failure = self.failureResultOf(self.call_endpoint(403, 'Forbidden'),
+                                       IOError)
+        self.assertFalse(failure.check(TranslationRejected))
+
+
+class TranslationCacheTestCase(TestCase):
+    def test_eviction(self):
+        cache = TranslationCache(size=2)
+        cache.put(('es', 'en', 'hola'), u'Hello')
+        cache.put(('es', 'en', 'adios'), u'Goodbye')
+        self.assertEqual(cache.get(('es', 'en', 'hola')), u'Hello')
+        cache.put(('es', 'en', 'gato'), u'Cat')
+        self.assertIsNone(cache.get(('es', 'en', 'adios')))
+        self.assertEqual(cache.get(('es', 'en', 'hola')), u'Hello')
+        self.assertEqual(cache.get(('es', 'en', 'gato')), u'Cat')
+
+
+class TokenManagerTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.manager = TokenManager(None, '<KEY>', self.clock)
+        self.requests = []
+        self.manager.request_token = Mock(side_effect=self.request_token)
+
+    def request_token(self):
+        self.requests.append(Deferred())
+        return self.requests[-1]
+
+    def test_single_flight(self):
+        first = self.manager.get()
+        second = self.manager.get()
+        self.assertEqual(len(self.requests), 1)
+        self.requests[0].callback(u'token')
+        self.assertEqual(self.successResultOf(first), u'token')
+        self.assertEqual(self.successResultOf(second), u'token')
+        self.assertEqual(self.successResultOf(self.manager.get()), u'token')
+        self.assertEqual(len(self.requests), 1)
+
+    def test_background_refresh(self):
+        self.manager.get()
+        self.requests[0].callback(u'old')
+        self.clock.advance(AUTH_TOKEN_TTL - 60)
+        self.assertEqual(len(self.requests), 2)
+        # The old token is still handed out while the new one arrives.
+        self.assertEqual(self.successResultOf(self.manager.get()), u'old')
+        self.requests[1].callback(u'new')
+        self.clock.advance(59)
+        self.assertEqual(self.successResultOf(self.manager.get()), u'new')
+
+    def test_refresh_failure(self):
+        self.manager.get()
+        self.requests[0].callback(u'old')
+        self.clock.advance(AUTH_TOKEN_TTL - 60)
+        self.requests[1].errback(ConnectError())
+        self.assertEqual(len(self.flushLoggedErrors(ConnectError)), 1)
+        self.clock.advance(30)
+        self.assertEqual(len(self.requests), 3)
+        self.requests[2].callback(u'new')
+        self.assertEqual(self.successResultOf(self.manager.get()), u'new')
+
+    def test_failure(self):
+        result = self.manager.get()
+        self.requests[0].errback(ConnectError())
+        self.failureResultOf(result, ConnectError)
+        self.manager.get()
+        self.assertEqual(len(self.requests), 2)
+
+    def test_stop(self):
+        self.manager.get()
+        self.requests[0].callback(u'token')
+        self.manager.stop()
+        self.clock.advance(AUTH_TOKEN_TTL)
+        self.assertEqual(len(self.requests), 1)
+
+
+class WarmUpTestCase(CommandTestMixin, TestCase):
+    command_class = Default
+
+    def setUp(self):
+        super(WarmUpTestCase, self).setUp()
+        self.command.clock = Clock()
+        self.call_endpoint = Mock(return_value=succeed([u'en', u'ja']))
+        self.command.call_endpoint = self.call_endpoint
+        self.tokens = []
+
+        def request_token(manager):
+            self.tokens.append(manager.subscription_key)
+            return succeed(u'token')
+        self.patch(TokenManager, 'request_token', request_token)
+
+    def connected(self):
+        return Message(self.connection, False, 'connected')
+
+    def test_connected(self):
+        self.connection.settings.set('mstranslate.subscription_key', '<KEY>')
+        self.command.on_connected(self.connected())
+        self.assertEqual(self.tokens, ['<KEY>'])
+        self.assertEqual(self.command.languages, frozenset([u'en', u'ja']))
+
+    def test_no_key(self):
+        self.assertIsNone(self.command.on_connected(self.connected()))
+        self.assertEqual(self.tokens, [])
+
+    def test_languages_saved(self):
+        path = self.mktemp()
+        self.connection.settings.set('mstranslate.subscription_key', '<KEY>')
+        self.connection.settings.set('mstranslate.cache_path', path)
+        self.command.on_connected(self.connected())
+        with open(path) as cache_file:
+            self.assertEqual(json.load(cache_file)['languages'],
+                             [u'en', u'ja'])
+        restarted = Default()
+        restarted.clock = self.command.clock
+        restarted.load_languages(path)
+        self.assertEqual(restarted.languages, frozenset([u'en', u'ja']))
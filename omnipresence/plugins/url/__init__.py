@@ -2,48 +2,493 @@
 """Event plugins for previewing the content of mentioned URLs."""
 
 
+import cgi
+from collections import Counter, OrderedDict
+from fnmatch import fnmatchcase
 import re
+import struct
+from urlparse import urlsplit, urlunsplit
 
-from littlebrother import TitleFetcher
-from twisted.internet.defer import DeferredList
+from littlebrother import ITitleExtractor, TitleFetcher, describe_error
+from littlebrother.humanize import filesize
+from littlebrother.plugins.html import HTMLTitleExtractor
+from twisted.internet import reactor
+from twisted.internet.defer import (Deferred, DeferredList, maybeDeferred,
+                                    succeed)
+from twisted.internet.protocol import Protocol
+from twisted.python.components import proxyForInterface
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http import PARTIAL_CONTENT, REQUESTED_RANGE_NOT_SATISFIABLE
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgent, IResponse, UNKNOWN_LENGTH
+from zope.interface import implementer
 
 from ...plugin import EventPlugin
+from ...web.html import FAST_BS4_PARSER
 from ...web.http import IdentifyingAgent
 
 
+#: The number of seconds to cache a fetched title for.
+CACHE_TTL = 3600
+
+#: The number of seconds to cache a connection error message for.
+ERROR_CACHE_TTL = 60
+
+#: The maximum number of titles to cache.
+CACHE_SIZE = 512
+
+#: Glob patterns matching the names of query parameters that are
+#: ignored when deciding whether two URLs are the same.
+TRACKING_PARAMETERS = ['utm_*', 'fbclid', 'gclid', 'dclid', 'yclid',
+                       'mc_cid', 'mc_eid', 'igshid', '_hsenc', '_hsmi']
+
+#: Ports implied by each URL scheme.
+DEFAULT_PORTS = {u'http': 80, u'https': 443}
+
+#: The maximum number of titles to fetch at once.
+MAX_FETCHES = 4
+
+#: The maximum number of titles to fetch at once from a single host.
+MAX_HOST_FETCHES = 2
+
+#: The maximum number of URLs to fetch titles for from one message.
+MAX_URLS = 5
+
+#: The maximum number of bytes of an HTML document to read while
+#: looking for its title.
+MAX_TITLE_BYTES = 65536
+
+#: A regex matching the end of an HTML ``<title>`` element.
+TITLE_END_RE = re.compile(r'</title\s*>', re.IGNORECASE)
+
+#: The maximum number of bytes of an image to read while looking for
+#: its dimensions.
+MAX_PREVIEW_BYTES = 65536
+
+#: A regex matching the value of a Content-Range header.
+CONTENT_RANGE_RE = re.compile(r'^bytes\s+\d+-\d+/(\d+|\*)$', re.IGNORECASE)
+
+#: JPEG start-of-frame markers, which are followed by the image size.
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+#: JPEG markers that are not followed by a segment length.
+JPEG_BARE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
+
+
 # Based on django.utils.html.urlize from the Django project.
 TRAILING_PUNCTUATION = [u'.', u',', u':', u';', u'.)', u'"', u"'", u'!']
 WRAPPING_PUNCTUATION = [(u'(', u')'), (u'<', u'>'), (u'[', u']'),
                         (u'"', u'"'), (u"'", u"'")]
-WORD_SPLIT_RE = re.compile(ur"""([\s<>"']+)""")
 SIMPLE_URL_RE = re.compile(ur'^https?://\[?\w', re.IGNORECASE | re.UNICODE)
 
+#: A regex matching whole words that may contain an IRI once wrapping
+#: punctuation is removed.  Words are delimited by whitespace, angle
+#: brackets, and quotation marks.
+CANDIDATE_RE = re.compile(ur"""(?<![^\s<>"'])\(?\[?https?://[^\s<>"']*""",
+                          re.IGNORECASE)
+
+#: A regex matching byte strings that might contain an IRI.
+PREFILTER_RE = re.compile(r'http', re.IGNORECASE)
+
+
+def strip_punctuation(word):
+    """Return *word* with any surrounding punctuation removed."""
+    middle = word
+    for punctuation in TRAILING_PUNCTUATION:
+        if middle.endswith(punctuation):
+            middle = middle[:-len(punctuation)]
+    for opening, closing in WRAPPING_PUNCTUATION:
+        if middle.startswith(opening):
+            middle = middle[len(opening):]
+        # Keep parentheses at the end only if they're balanced.
+        if (middle.endswith(closing) and
+                middle.count(closing) == middle.count(opening) + 1):
+            middle = middle[:-len(closing)]
+    return middle
+
 
 def extract_iris(text):
     """Return an iterator yielding IRIs from a Unicode string."""
-    for word in WORD_SPLIT_RE.split(text):
-        if not (u'.' in word or u':' in word):
-            continue
-        # Deal with punctuation.
-        lead, middle, trail = u'', word, u''
-        for punctuation in TRAILING_PUNCTUATION:
-            if middle.endswith(punctuation):
-                middle = middle[:-len(punctuation)]
-                trail = punctuation + trail
-        for opening, closing in WRAPPING_PUNCTUATION:
-            if middle.startswith(opening):
-                middle = middle[len(opening):]
-                lead += opening
-            # Keep parentheses at the end only if they're balanced.
-            if (middle.endswith(closing) and
-                    middle.count(closing) == middle.count(opening) + 1):
-                middle = middle[:-len(closing)]
-                trail = closing + trail
-        # Yield the resulting URL.
+    for match in CANDIDATE_RE.finditer(text):
+        middle = strip_punctuation(match.group())
         if SIMPLE_URL_RE.match(middle):
             yield middle
 
 
+def normalize_iri(iri, strip_parameters=()):
+    """Return a normalized form of the Unicode string *iri* for use as
+    a cache key.  The scheme and hostname are lowercased, any default
+    port and fragment are removed, and query parameters whose names
+    match one of the glob patterns in *strip_parameters* are dropped.
+    """
+    parts = urlsplit(iri)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    try:
+        host, port = parts.hostname, parts.port
+    except ValueError:
+        pass
+    else:
+        if host is not None:
+            userinfo, _, _ = parts.netloc.rpartition(u'@')
+            netloc = u'[{}]'.format(host) if u':' in host else host
+            if port is not None and port != DEFAULT_PORTS.get(scheme):
+                netloc += u':{}'.format(port)
+            if userinfo:
+                netloc = userinfo + u'@' + netloc
+    query = u'&'.join(
+        parameter for parameter in parts.query.split(u'&')
+        if parameter and not any(
+            fnmatchcase(parameter.partition(u'=')[0], pattern)
+            for pattern in strip_parameters))
+    return urlunsplit((scheme, netloc, parts.path or u'/', query, u''))
+
+
+class TitleCache(object):
+    """A least-recently-used cache holding at most *size* titles, each
+    of which expires after its own time-to-live."""
+
+    def __init__(self, size=CACHE_SIZE, clock=reactor):
+        self.size = size
+        self.clock = clock
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """Return the title cached under *key*, or `None`."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        expires, title = entry
+        if expires <= self.clock.seconds():
+            return None
+        self.entries[key] = entry
+        return title
+
+    def put(self, key, title, ttl):
+        """Cache *title* under *key* for *ttl* seconds."""
+        self.entries.pop(key, None)
+        if ttl <= 0:
+            return
+        self.entries[key] = (self.clock.seconds() + ttl, title)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class FetchLimiter(object):
+    """Runs fetches with at most *limit* in progress at once, and at
+    most *host_limit* of those for any one host.  Fetches that cannot
+    start yet wait in the order they were requested."""
+
+    def __init__(self, limit=MAX_FETCHES, host_limit=MAX_HOST_FETCHES):
+        self.limit = limit
+        self.host_limit = host_limit
+        #: The number of fetches in progress for each host.
+        self.active = Counter()
+        #: A list of ``(host, function, args, kwargs, deferred)`` tuples
+        #: for fetches that have not yet started.
+        self.waiting = []
+
+    def run(self, host, function, *args, **kwargs):
+        """Call *function* with *args* and *kwargs* once a slot for
+        *host* is free, and return a `Deferred` yielding its result."""
+        finished = Deferred()
+        self.waiting.append((host, function, args, kwargs, finished))
+        self._start()
+        return finished
+
+    def _start(self):
+        for item in list(self.waiting):
+            if sum(self.active.itervalues()) >= self.limit:
+                break
+            host, function, args, kwargs, finished = item
+            if self.active[host] >= self.host_limit:
+                continue
+            self.waiting.remove(item)
+            self.active[host] += 1
+            fetch = maybeDeferred(function, *args, **kwargs)
+            fetch.addBoth(self._release, host)
+            fetch.chainDeferred(finished)
+
+    def _release(self, result, host):
+        self.active[host] -= 1
+        if not self.active[host]:
+            del self.active[host]
+        self._start()
+        return result
+
+
+class TitleStoppingProtocol(Protocol):
+    """A protocol wrapper that forwards response body data to
+    *protocol* until the end of the document's ``<title>`` element or
+    *max_bytes* bytes, then stops the transfer and tells *protocol*
+    that the body is complete."""
+
+    def __init__(self, protocol, max_bytes=MAX_TITLE_BYTES):
+        self.protocol = protocol
+        self.remaining = max_bytes
+        self.tail = ''
+        self.finished = False
+
+    def makeConnection(self, transport):
+        Protocol.makeConnection(self, transport)
+        # Hand the wrapped protocol ourselves as its transport, so that
+        # any attempt it makes to stop the transfer goes through us.
+        self.protocol.makeConnection(self)
+
+    def dataReceived(self, data):
+        if self.finished:
+            return
+        window = self.tail + data
+        match = TITLE_END_RE.search(window)
+        if match is not None:
+            data = data[:match.end() - len(self.tail)]
+        data = data[:self.remaining]
+        self.remaining -= len(data)
+        self.tail = window[-16:]
+        self.protocol.dataReceived(data)
+        if match is not None or self.remaining <= 0:
+            self.stopProducing()
+
+    def connectionLost(self, reason=None):
+        if not self.finished:
+            self.finished = True
+            self.protocol.connectionLost(reason)
+
+    # Transport methods for the wrapped protocol.
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        """Stop the transfer, treating the body as complete."""
+        if self.finished:
+            return
+        self.finished = True
+        self.protocol.connectionLost(Failure(ResponseDone()))
+        self.transport.stopProducing()
+
+    loseConnection = stopProducing
+
+
+class TitleStoppingResponse(proxyForInterface(IResponse)):
+    """A response wrapper that delivers its body only up to the end of
+    the document's ``<title>`` element or *max_bytes* bytes."""
+
+    def __init__(self, original, max_bytes=MAX_TITLE_BYTES):
+        super(TitleStoppingResponse, self).__init__(original)
+        self.max_bytes = max_bytes
+
+    def deliverBody(self, protocol):
+        self.original.deliverBody(
+            TitleStoppingProtocol(protocol, self.max_bytes))
+
+
+class StreamingHTMLTitleExtractor(HTMLTitleExtractor):
+    """An HTML title extractor that stops downloading a document as
+    soon as its title has arrived.  Any ``<meta>`` refreshes after the
+    title are not seen."""
+
+    def __init__(self, parser=FAST_BS4_PARSER):
+        HTMLTitleExtractor.__init__(self, parser)
+        self.max_download_bytes = MAX_TITLE_BYTES
+
+    def extract(self, response):
+        return HTMLTitleExtractor.extract(self, TitleStoppingResponse(
+            response, self.max_download_bytes))
+
+
+def _jpeg_dimensions(data):
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != '\xFF':
+            return None
+        marker = ord(data[offset + 1])
+        if marker == 0xFF:
+            # Fill byte before the actual marker.
+            offset += 1
+            continue
+        if marker in JPEG_BARE_MARKERS:
+            offset += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack_from('>HH', data, offset + 5)
+            return width, height
+        offset += 2 + struct.unpack_from('>H', data, offset + 2)[0]
+    return None
+
+
+def _webp_dimensions(data):
+    chunk = data[12:16]
+    if chunk == 'VP8 ' and data[23:26] == '\x9D\x01\x2A' and len(data) >= 30:
+        width, height = struct.unpack_from('<HH', data, 26)
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == 'VP8L' and data[20:21] == '\x2F' and len(data) >= 25:
+        bits = struct.unpack_from('<I', data, 21)[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == 'VP8X' and len(data) >= 30:
+        width = struct.unpack('<I', data[24:27] + '\0')[0]
+        height = struct.unpack('<I', data[27:30] + '\0')[0]
+        return width + 1, height + 1
+    return None
+
+
+def image_dimensions(data):
+    """Return a tuple of the format name, width, and height of the
+    image whose first bytes are the byte string *data*, or `None` if
+    its format is not recognized or *data* is too short to tell."""
+    size = None
+    if data.startswith('\x89PNG\r\n\x1A\n') and data[12:16] == 'IHDR':
+        if len(data) >= 24:
+            size = struct.unpack_from('>II', data, 16)
+        image_format = 'PNG'
+    elif data[:6] in ('GIF87a', 'GIF89a'):
+        if len(data) >= 10:
+            size = struct.unpack_from('<HH', data, 6)
+        image_format = 'GIF'
+    elif data.startswith('\xFF\xD8'):
+        size = _jpeg_dimensions(data)
+        image_format = 'JPEG'
+    elif data.startswith('RIFF') and data[8:12] == 'WEBP':
+        size = _webp_dimensions(data)
+        image_format = 'WEBP'
+    elif data.startswith('BM') and len(data) >= 26:
+        if struct.unpack_from('<I', data, 14)[0] == 12:
+            size = struct.unpack_from('<HH', data, 18)
+        else:
+            width, height = struct.unpack_from('<ii', data, 18)
+            # Top-down bitmaps have negative heights.
+            size = width, abs(height)
+        image_format = 'BMP'
+    if size is None:
+        return None
+    return (image_format,) + tuple(size)
+
+
+class ImageHeaderProtocol(Protocol):
+    """A protocol that reads response body data until the dimensions
+    of the image it contains are known or *max_bytes* bytes have
+    arrived, then stops the transfer and fires *finished* with the
+    result of `image_dimensions`."""
+
+    def __init__(self, finished, max_bytes=MAX_PREVIEW_BYTES):
+        self.finished = finished
+        self.max_bytes = max_bytes
+        self.data = ''
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        self.data = (self.data + data)[:self.max_bytes]
+        dimensions = image_dimensions(self.data)
+        if dimensions is not None or len(self.data) >= self.max_bytes:
+            self.finished.callback(dimensions)
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason=None):
+        if not self.finished.called:
+            self.finished.callback(image_dimensions(self.data))
+
+
+@implementer(ITitleExtractor)
+class ImageHeaderExtractor(object):
+    """A title extractor that describes images by their format and
+    dimensions, reading only as much of each image as it needs to."""
+
+    content_types = ('image/png', 'image/gif', 'image/jpeg', 'image/webp',
+                     'image/bmp', 'image/x-ms-bmp')
+
+    def __init__(self):
+        #: The maximum number of bytes this extractor will download.
+        self.max_download_bytes = MAX_PREVIEW_BYTES
+
+    def extract(self, response):
+        finished = Deferred()
+        response.deliverBody(
+            ImageHeaderProtocol(finished, self.max_download_bytes))
+        finished.addCallback(self._describe, response.length)
+        return finished
+
+    def _describe(self, dimensions, length):
+        if dimensions is None:
+            return None
+        title = u'{} image ({:n} \u00d7 {:n} pixels'.format(*dimensions)
+        if length is not UNKNOWN_LENGTH:
+            title += u', ' + filesize(length)
+        return title + u')'
+
+
+@implementer(IAgent)
+class RangeAgent(object):
+    """An agent that asks servers to send only the first *max_bytes*
+    bytes of the body of each GET response.  The `length` of a partial
+    response is set to the size of the whole document, as given by its
+    Content-Range header, so that it can still be reported."""
+
+    def __init__(self, agent, max_bytes):
+        self.agent = agent
+        self.max_bytes = max_bytes
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        if method != 'GET' or (headers is not None and
+                               headers.hasHeader('Range')):
+            return self.agent.request(method, uri, headers, bodyProducer)
+        ranged = Headers() if headers is None else headers.copy()
+        ranged.setRawHeaders('Range',
+                             ['bytes=0-{}'.format(self.max_bytes - 1)])
+        d = self.agent.request(method, uri, ranged, bodyProducer)
+        d.addCallback(self._ranged, method, uri, headers, bodyProducer)
+        return d
+
+    def _ranged(self, response, method, uri, headers, bodyProducer):
+        if response.code == REQUESTED_RANGE_NOT_SATISFIABLE:
+            # Usually an empty document.  Ask for all of it instead.
+            response.deliverBody(_DiscardingProtocol())
+            return self.agent.request(method, uri, headers, bodyProducer)
+        if response.code == PARTIAL_CONTENT:
+            match = CONTENT_RANGE_RE.match(
+                response.headers.getRawHeaders('Content-Range', [''])[0])
+            if match is None or match.group(1) == '*':
+                response.length = UNKNOWN_LENGTH
+            else:
+                response.length = int(match.group(1))
+        return response
+
+
+class _DiscardingProtocol(Protocol):
+    def makeConnection(self, transport):
+        Protocol.makeConnection(self, transport)
+        transport.stopProducing()
+
+
+@implementer(IAgent)
+class BodySkippingAgent(object):
+    """An agent that abandons the bodies of responses whose
+    Content-Type is not one of *content_types*, closing the connection
+    instead of leaving it to wait for a reader that never comes."""
+
+    def __init__(self, agent, content_types):
+        self.agent = agent
+        self.content_types = content_types
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        d = self.agent.request(method, uri, headers, bodyProducer)
+        d.addCallback(self._skip_body)
+        return d
+
+    def _skip_body(self, response):
+        content_type = cgi.parse_header(
+            response.headers.getRawHeaders('Content-Type', [''])[0])[0]
+        if content_type not in self.content_types:
+            response.deliverBody(_DiscardingProtocol())
+        return response
+
+
 class Default(EventPlugin):
     """Fetch the titles of URLs mentioned in normal messages or actions.
 
@@ -56,24 +501,148 @@ class Default(EventPlugin):
     :alice: http://www.example.org/ and http://www.example.net/ too
     :bot: [www.example.org] Example Domain
     :bot: [www.example.net] Example Domain
+
+    Titles are cached, so that the same URL mentioned in several
+    channels or repeated soon afterwards is only fetched once.  URLs
+    that differ only in the case of their hostnames, explicit default
+    ports, fragments, or tracking parameters share a cache entry.
+    The following :ref:`settings variables <settings-variable>` control
+    the cache:
+
+    * ``url.cache_ttl`` is the number of seconds to cache a title.
+      The default is 3600 (one hour).
+
+    * ``url.error_cache_ttl`` is the number of seconds to cache a
+      connection error.  The default is 60.
+
+    * ``url.cache_size`` is the maximum number of titles to cache.
+      It is only read from the root of the configuration file.
+      The default is 512.
+
+    * ``url.strip_parameters`` is a list of glob patterns matching the
+      names of query parameters to ignore when comparing URLs, such as
+      ``utm_*``.  The default covers common tracking parameters.
+
+    Only the first 64 KiB of each document is requested.  HTML
+    documents are read only up to the end of their titles, and common
+    image formats only until their dimensions are known; other
+    documents, such as PDFs and video files, are described by their
+    Content-Type and size without reading any of their contents.
+    The following settings variables limit the work done for each
+    message:
+
+    * ``url.max_urls`` is the maximum number of URLs in a single
+      message to fetch titles for.  The default is 5.
+
+    * ``url.max_fetches`` is the maximum number of titles to fetch at
+      once.  It is only read from the root of the configuration file.
+      The default is 4.
+
+    * ``url.max_host_fetches`` is the maximum number of titles to fetch
+      at once from a single host.  It is only read from the root of the
+      configuration file.  The default is 2.
     """
 
     def __init__(self):
         self.fetcher = TitleFetcher()
-        self.fetcher.agent = IdentifyingAgent(self.fetcher.agent)
+        self.fetcher.extractors = {}
+        for extractor in (StreamingHTMLTitleExtractor(),
+                          ImageHeaderExtractor()):
+            self.fetcher.extractors.update(
+                dict.fromkeys(extractor.content_types, extractor))
+        self.fetcher.agent = IdentifyingAgent(BodySkippingAgent(
+            RangeAgent(self.fetcher.agent,
+                       max(MAX_TITLE_BYTES, MAX_PREVIEW_BYTES)),
+            self.fetcher.extractors.viewkeys()))
+        self.limiter = FetchLimiter()
+        self.cache = TitleCache()
+        #: A dictionary mapping cache keys of titles being fetched to
+        #: lists of `Deferred` objects waiting on them.
+        self.pending = {}
 
     def on_privmsg(self, msg):
+        # Most messages contain no URLs at all, so check for them before
+        # doing anything more expensive, such as decoding.
+        if not PREFILTER_RE.search(msg.content):
+            return
+        self.configure_limits(msg.connection.settings)
+        strip_parameters = msg.settings.get('url.strip_parameters',
+                                            default=TRACKING_PARAMETERS)
+        ttls = (msg.settings.get('url.cache_ttl', default=CACHE_TTL),
+                msg.settings.get('url.error_cache_ttl',
+                                 default=ERROR_CACHE_TTL))
+        max_urls = msg.settings.get('url.max_urls', default=MAX_URLS)
         fetches = []
+        seen = set()
         for iri in extract_iris(msg.content.decode(msg.encoding, 'replace')):
+            key = normalize_iri(iri, strip_parameters)
+            if key in seen:
+                continue
+            if len(seen) >= max_urls:
+                self.log.debug('Ignoring remaining URLs from {msg.actor}',
+                               msg=msg)
+                break
+            seen.add(key)
             self.log.debug(
                 'Saw URL {iri} from {msg.actor} in venue {msg.venue}',
                 iri=iri.encode('utf-8'), msg=msg)
-            fetches.append(self.fetcher.fetch_title(
-                iri, hostname_tag=True, friendly_errors=True))
+            fetches.append(self.fetch_title(iri, key, *ttls))
         finished = DeferredList(fetches)
         finished.addCallback(self.send_replies, msg)
         return finished
 
+    def configure_limits(self, settings):
+        """Apply the cache and fetch limits from the root of the
+        connection *settings*.  Every venue shares the same cache and
+        fetches, so venue-specific values are ignored."""
+        self.cache.size = settings.get('url.cache_size', default=CACHE_SIZE)
+        self.limiter.limit = settings.get('url.max_fetches',
+                                          default=MAX_FETCHES)
+        self.limiter.host_limit = settings.get('url.max_host_fetches',
+                                               default=MAX_HOST_FETCHES)
+
+    def fetch_title(self, iri, key, ttl, error_ttl):
+        """Return a `Deferred` yielding the title of *iri*, from the
+        cache if possible.  Concurrent requests for the same cache *key*
+        share a single fetch."""
+        title = self.cache.get(key)
+        if title is not None:
+            return succeed(title)
+        finished = Deferred()
+        if key in self.pending:
+            self.pending[key].append(finished)
+            return finished
+        self.pending[key] = [finished]
+        fetch = self.limiter.run(urlsplit(iri).hostname,
+                                 self.fetcher.fetch_title,
+                                 iri, hostname_tag=True)
+        fetch.addCallbacks(self._fetched, self._failed,
+                           callbackArgs=(key, ttl),
+                           errbackArgs=(iri, key, error_ttl))
+        fetch.addBoth(self._fan_out, key)
+        return finished
+
+    def _fetched(self, title, key, ttl):
+        self.cache.put(key, title, ttl)
+        return title
+
+    def _failed(self, failure, iri, key, ttl):
+        description = describe_error(failure)
+        if isinstance(description, Failure):
+            return description
+        # Match the hostname tag Little Brother adds to its own
+        # friendly error messages.
+        title = u'[{}] {}'.format(urlsplit(iri).hostname, description)
+        self.cache.put(key, title, ttl)
+        return title
+
+    def _fan_out(self, result, key):
+        for waiter in self.pending.pop(key):
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
     on_action = on_privmsg
 
     def send_replies(self, results, msg):
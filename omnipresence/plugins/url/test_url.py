@@ -3,11 +3,21 @@
 # pylint: disable=missing-docstring,too-few-public-methods
 
 
+from littlebrother import read_body
 from mock import Mock, call
-from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.error import ConnectError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
 from twisted.trial.unittest import TestCase
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
 
-from . import extract_iris, Default
+from . import (extract_iris, image_dimensions, normalize_iri, Default,
+               FetchLimiter, ImageHeaderExtractor, RangeAgent, TitleCache,
+               TitleStoppingResponse, CACHE_SIZE, MAX_FETCHES,
+               MAX_HOST_FETCHES)
 from ...test.helpers import ConnectionTestMixin, OutgoingPlugin
 
 
@@ -69,6 +79,11 @@ class ExtractIRIsTestCase(TestCase):
             u'http://i.ebayimg.com/00/s/MTAwOFgxMDI0/$(KGrHqYOKo0E6fEy4,lqBOt,yzoor!~~60_12.JPG',
             [u'http://i.ebayimg.com/00/s/MTAwOFgxMDI0/$(KGrHqYOKo0E6fEy4,lqBOt,yzoor!~~60_12.JPG'])
 
+    def test_wrapping_punctuation(self):
+        self.assert_iris(u'([http://example.com/a])',
+                         [u'http://example.com/a'])
+        self.assert_iris(u'x(http://example.com/', [])
+
     def test_unicode_iris(self):
         self.assert_iris(
             u'このサイトがすごい！ http://ドメイン名例.test/',
@@ -88,15 +103,317 @@ class URLTestCase(ConnectionTestMixin, TestCase):
         self.receive('PRIVMSG {} :http://www.example.com/'
                      .format(self.connection.nickname))
         self.fetch_title.assert_called_with(
-            u'http://www.example.com/',
-            hostname_tag=True, friendly_errors=True)
+            u'http://www.example.com/', hostname_tag=True)
         self.assertEqual(self.outgoing.last_seen.content, 'title')
 
+    def test_no_iris(self):
+        self.receive('PRIVMSG {} :nothing to see here'
+                     .format(self.connection.nickname))
+        self.assertFalse(self.fetch_title.called)
+
     def test_multiple_iris(self):
         self.receive('PRIVMSG {} :http://foo.test/ http://bar.test/'
                      .format(self.connection.nickname))
         self.fetch_title.assert_has_calls([
-            call(u'http://foo.test/', hostname_tag=True, friendly_errors=True),
-            call(u'http://bar.test/', hostname_tag=True, friendly_errors=True),
+            call(u'http://foo.test/', hostname_tag=True),
+            call(u'http://bar.test/', hostname_tag=True),
             ])
         self.assertEqual(self.outgoing.last_seen.content, 'title')
+
+    def test_duplicate_iris(self):
+        self.receive('PRIVMSG {} :http://foo.test/ http://FOO.test:80/#x'
+                     .format(self.connection.nickname))
+        self.assertEqual(self.fetch_title.call_count, 1)
+
+    def assert_title(self, title):
+        self.assertTrue(self.outgoing.last_seen.content.endswith(title))
+
+    def test_cache(self):
+        self.plugin.cache.clock = clock = Clock()
+        for channel in ('#foo', '#bar'):
+            self.receive('PRIVMSG {} :http://foo.test/'.format(channel))
+            self.assert_title('title')
+        self.assertEqual(self.fetch_title.call_count, 1)
+        clock.advance(3600)
+        self.receive('PRIVMSG #foo :http://foo.test/')
+        self.assertEqual(self.fetch_title.call_count, 2)
+
+    def test_concurrent(self):
+        pending = Deferred()
+        self.fetch_title.return_value = pending
+        self.receive('PRIVMSG #foo :http://foo.test/')
+        self.receive('PRIVMSG #bar :http://foo.test/')
+        self.assertEqual(self.fetch_title.call_count, 1)
+        pending.callback('title')
+        self.assertEqual(self.outgoing.last_seen.venue, '#bar')
+        self.assert_title('title')
+
+    def test_error(self):
+        self.plugin.cache.clock = clock = Clock()
+        self.fetch_title.return_value = fail(ConnectError())
+        self.receive('PRIVMSG #foo :http://foo.test/')
+        self.assert_title('[foo.test] Could not connect to server.')
+        self.receive('PRIVMSG #foo :http://foo.test/')
+        self.assertEqual(self.fetch_title.call_count, 1)
+        clock.advance(60)
+        self.fetch_title.return_value = succeed('title')
+        self.receive('PRIVMSG #foo :http://foo.test/')
+        self.assert_title('title')
+
+    def test_max_urls(self):
+        self.receive('PRIVMSG #foo :' + ' '.join(
+            'http://{}.test/'.format(i) for i in xrange(8)))
+        self.assertEqual(self.fetch_title.call_count, 5)
+
+    def test_host_limit(self):
+        pending = [Deferred() for _ in xrange(3)]
+        self.fetch_title.side_effect = pending
+        self.receive('PRIVMSG #foo :http://foo.test/a http://foo.test/b '
+                     'http://foo.test/c')
+        self.assertEqual(self.fetch_title.call_count, 2)
+        pending[0].callback('a')
+        self.assertEqual(self.fetch_title.call_count, 3)
+
+    def test_venue_limits_ignored(self):
+        self.connection.settings.set('url.cache_size', 1, scope='#foo')
+        self.connection.settings.set('url.max_fetches', 1, scope='#foo')
+        self.connection.settings.set('url.max_host_fetches', 1,
+                                     scope='#foo')
+        self.receive('PRIVMSG #foo :http://foo.test/')
+        self.assertEqual(self.plugin.cache.size, CACHE_SIZE)
+        self.assertEqual(self.plugin.limiter.limit, MAX_FETCHES)
+        self.assertEqual(self.plugin.limiter.host_limit, MAX_HOST_FETCHES)
+
+
+class FetchLimiterTestCase(TestCase):
+    def setUp(self):
+        self.limiter = FetchLimiter(limit=2, host_limit=1)
+        self.pending = []
+
+    def fetch(self):
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+    def test_limits(self):
+        results = [self.limiter.run(host, self.fetch)
+                   for host in ('a', 'a', 'b', 'c')]
+        # One fetch for "a" and one for "b" start; the second "a" must
+        # wait for its host, and "c" for a global slot.
+        self.assertEqual(len(self.pending), 2)
+        self.pending[1].callback('b')
+        self.assertEqual(self.successResultOf(results[2]), 'b')
+        self.assertEqual(len(self.pending), 3)
+        self.pending[0].callback('a')
+        self.assertEqual(len(self.pending), 4)
+        self.assertEqual(self.successResultOf(results[0]), 'a')
+        self.assertNoResult(results[1])
+
+    def test_failure(self):
+        result = self.limiter.run('a', self.fetch)
+        second = self.limiter.run('a', self.fetch)
+        self.pending[0].errback(ConnectError())
+        self.failureResultOf(result, ConnectError)
+        self.assertEqual(len(self.pending), 2)
+        self.pending[1].callback('a')
+        self.assertEqual(self.successResultOf(second), 'a')
+        self.assertEqual(self.limiter.active, {})
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class FakeResponse(object):
+    phrase = 'OK'
+
+    def __init__(self, chunks, code=200, headers=None, length=None):
+        self.chunks = chunks
+        self.code = code
+        self.headers = Headers(headers or {})
+        self.length = length
+        self.transport = FakeTransport()
+
+    def deliverBody(self, protocol):
+        protocol.makeConnection(self.transport)
+        for chunk in self.chunks:
+            if self.transport.stopped:
+                break
+            protocol.dataReceived(chunk)
+        if not self.transport.stopped:
+            protocol.connectionLost(Failure(ResponseDone()))
+
+
+class TitleStoppingResponseTestCase(TestCase):
+    def read(self, chunks, max_bytes=1024):
+        response = FakeResponse(chunks)
+        body = read_body(TitleStoppingResponse(response, max_bytes))
+        return self.successResultOf(body), response.transport.stopped
+
+    def test_title_end(self):
+        self.assertEqual(
+            self.read(['<title>a</ti', 'TLE >b', '<p>more']),
+            ('<title>a</tiTLE >', True))
+
+    def test_max_bytes(self):
+        self.assertEqual(self.read(['<title>', 'abcdef'], max_bytes=10),
+                         ('<title>abc', True))
+
+    def test_short_body(self):
+        self.assertEqual(self.read(['<p>no', ' title']),
+                         ('<p>no title', False))
+
+
+PNG_HEADER = ('\x89PNG\r\n\x1A\n\x00\x00\x00\rIHDR'
+              '\x00\x00\x00{\x00\x00\x00-\x08\x02\x00\x00\x00')
+JPEG_HEADER = ('\xFF\xD8\xFF\xE0\x00\x10JFIF\x00\x01\x01\x00\x00\x01'
+               '\x00\x01\x00\x00\xFF\xC0\x00\x11\x08\x00-\x00{\x03')
+
+
+class ImageDimensionsTestCase(TestCase):
+    def test_png(self):
+        self.assertEqual(image_dimensions(PNG_HEADER), ('PNG', 123, 45))
+
+    def test_gif(self):
+        self.assertEqual(image_dimensions('GIF89a{\x00-\x00\x87'),
+                         ('GIF', 123, 45))
+
+    def test_jpeg(self):
+        self.assertEqual(image_dimensions(JPEG_HEADER), ('JPEG', 123, 45))
+
+    def test_webp(self):
+        self.assertEqual(image_dimensions(
+            'RIFF>\x00\x00\x00WEBPVP8 2\x00\x00\x00\xF0\x03\x00'
+            '\x9D\x01*{\x00-\x00'), ('WEBP', 123, 45))
+        self.assertEqual(image_dimensions(
+            'RIFF\x1A\x00\x00\x00WEBPVP8L\x0E\x00\x00\x00/z\x00\x0B'
+            '\x00'), ('WEBP', 123, 45))
+        self.assertEqual(image_dimensions(
+            'RIFFz\x00\x00\x00WEBPVP8X\n\x00\x00\x00\x18\x00\x00\x00'
+            'z\x00\x00,\x00\x00'), ('WEBP', 123, 45))
+
+    def test_bmp(self):
+        self.assertEqual(image_dimensions(
+            'BM\x9AA\x00\x00\x00\x00\x00\x006\x00\x00\x00(\x00\x00\x00'
+            '{\x00\x00\x00\xD3\xFF\xFF\xFF'), ('BMP', 123, 45))
+
+    def test_truncated(self):
+        self.assertIsNone(image_dimensions(PNG_HEADER[:20]))
+        self.assertIsNone(image_dimensions(JPEG_HEADER[:-4]))
+
+    def test_unknown(self):
+        self.assertIsNone(image_dimensions('%PDF-1.4'))
+
+
+class ImageHeaderExtractorTestCase(TestCase):
+    def extract(self, chunks, length=UNKNOWN_LENGTH):
+        response = FakeResponse(chunks, length=length)
+        title = ImageHeaderExtractor().extract(response)
+        return self.successResultOf(title), response.transport.stopped
+
+    def test_early_stop(self):
+        self.assertEqual(
+            self.extract([PNG_HEADER[:10], PNG_HEADER[10:], 'x' * 1024],
+                         length=2 * 1024 * 1024),
+            (u'PNG image (123 \u00d7 45 pixels, 2.1 MB)', True))
+
+    def test_unknown_length(self):
+        self.assertEqual(self.extract([JPEG_HEADER]),
+                         (u'JPEG image (123 \u00d7 45 pixels)', True))
+
+    def test_invalid(self):
+        self.assertEqual(self.extract(['not an image']), (None, False))
+
+
+class RangeAgentTestCase(TestCase):
+    def setUp(self):
+        self.responses = []
+        self.agent = Mock()
+        self.agent.request.side_effect = lambda *args: succeed(
+            self.responses.pop(0))
+        self.ranged = RangeAgent(self.agent, 1024)
+
+    def test_partial(self):
+        self.responses.append(FakeResponse(
+            [], code=206, length=1024,
+            headers={'Content-Range': ['bytes 0-1023/5000000000']}))
+        response = self.successResultOf(
+            self.ranged.request('GET', 'http://foo.test/'))
+        self.assertEqual(response.length, 5000000000)
+        headers = self.agent.request.call_args[0][2]
+        self.assertEqual(headers.getRawHeaders('Range'), ['bytes=0-1023'])
+
+    def test_unknown_total(self):
+        self.responses.append(FakeResponse(
+            [], code=206, length=1024,
+            headers={'Content-Range': ['bytes 0-1023/*']}))
+        response = self.successResultOf(
+            self.ranged.request('GET', 'http://foo.test/'))
+        self.assertIs(response.length, UNKNOWN_LENGTH)
+
+    def test_not_satisfiable(self):
+        self.responses.extend([FakeResponse([], code=416),
+                               FakeResponse([], length=0)])
+        response = self.successResultOf(
+            self.ranged.request('GET', 'http://foo.test/'))
+        self.assertEqual(response.code, 200)
+        self.assertIsNone(self.agent.request.call_args[0][2])
+
+    def test_head(self):
+        self.responses.append(FakeResponse([]))
+        self.ranged.request('HEAD', 'http://foo.test/')
+        self.assertIsNone(self.agent.request.call_args[0][2])
+
+
+class NormalizeIRITestCase(TestCase):
+    def test_host_and_scheme(self):
+        self.assertEqual(normalize_iri(u'HTTP://Example.COM/Path'),
+                         u'http://example.com/Path')
+
+    def test_default_port(self):
+        self.assertEqual(normalize_iri(u'http://example.com:80/'),
+                         u'http://example.com/')
+        self.assertEqual(normalize_iri(u'https://example.com:443'),
+                         u'https://example.com/')
+        self.assertEqual(normalize_iri(u'http://example.com:8080/'),
+                         u'http://example.com:8080/')
+
+    def test_fragment(self):
+        self.assertEqual(normalize_iri(u'http://example.com/a?b#c'),
+                         u'http://example.com/a?b')
+
+    def test_ipv6(self):
+        self.assertEqual(normalize_iri(u'http://[2001:DB8::2]:80/foo'),
+                         u'http://[2001:db8::2]/foo')
+
+    def test_strip_parameters(self):
+        iri = u'http://example.com/?utm_source=x&id=1&fbclid=y&utm_medium'
+        self.assertEqual(normalize_iri(iri, ['utm_*', 'fbclid']),
+                         u'http://example.com/?id=1')
+        self.assertEqual(normalize_iri(iri), iri)
+
+
+class TitleCacheTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = TitleCache(size=2, clock=self.clock)
+
+    def test_expiry(self):
+        self.cache.put('a', 'title', 10)
+        self.clock.advance(9)
+        self.assertEqual(self.cache.get('a'), 'title')
+        self.clock.advance(1)
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_lru(self):
+        self.cache.put('a', 'A', 10)
+        self.cache.put('b', 'B', 10)
+        self.cache.get('a')
+        self.cache.put('c', 'C', 10)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 'A')
+        self.assertEqual(self.cache.get('c'), 'C')
@@ -6,12 +6,16 @@ import urllib
 from urlparse import urljoin
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import readBody
 
 from ...message import collapse
 from ...plugin import EventPlugin, UserVisibleError
-from ...web.html import parse as parse_html, textify
-from ...web.http import default_agent
+from ...web.html import FAST_BS4_PARSER, parse as parse_html, textify
+from ...web.http import cache_by_default, default_agent, read_body
+
+
+#: The number of seconds to cache search results for.
+CACHE_TTL = 6 * 60 * 60
+cache_by_default('https://vndb.org/v/all', CACHE_TTL)
 
 
 class Default(EventPlugin):
@@ -35,8 +39,9 @@ class Default(EventPlugin):
         q = urllib.quote_plus(msg.content)
         response = yield self.agent.request(
             'GET', 'https://vndb.org/v/all?s=pop&o=d&q={}'.format(q))
-        content = yield readBody(response)
-        soup = parse_html(content)
+        content = yield read_body(response)
+        soup = parse_html(content, only='div.vnbrowse, div#maincontent',
+                          parser=FAST_BS4_PARSER)
 
         # TODO:  Implement page navigation.
         results = []
@@ -7,7 +7,6 @@ import re
 import urllib
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import readBody
 try:
     from waapuro import romanize
 except ImportError:
@@ -15,8 +14,8 @@ except ImportError:
 
 from ...message import collapse
 from ...plugin import EventPlugin, UserVisibleError
-from ...web.html import parse as parse_html
-from ...web.http import default_agent
+from ...web.html import FAST_BS4_PARSER, parse as parse_html
+from ...web.http import cache_by_default, default_agent, read_body
 
 
 #: A regex for identifying pronunciations in a JDIC entry, if present.
@@ -26,6 +25,11 @@ PRONUNCIATIONS_RE = re.compile(ur'\[([^\]]+)\]')
 MARKINGS_RE = re.compile(ur'(?:\([^)]+\))+$')
 
 
+#: The number of seconds to cache search results for.
+CACHE_TTL = 24 * 60 * 60
+cache_by_default('http://www.edrdg.org/cgi-bin/wwwjdic/', CACHE_TTL)
+
+
 class Default(EventPlugin):
     u"""Define a Japanese word or phrase using `Jim Breen's WWWJDIC`__.
 
@@ -54,8 +58,8 @@ class Default(EventPlugin):
         q = urllib.quote_plus(msg.content)
         response = yield self.agent.request('GET',
             'http://www.edrdg.org/cgi-bin/wwwjdic/wwwjdic?1ZUJ{}'.format(q))
-        content = yield readBody(response)
-        soup = parse_html(content)
+        content = yield read_body(response)
+        soup = parse_html(content, only='pre', parser=FAST_BS4_PARSER)
         results = []
         if not soup.pre:
             returnValue(results)
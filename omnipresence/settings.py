@@ -289,6 +289,16 @@ class ConnectionSettings(object):
                 return value
         return default
 
+    def get_in_venue(self, name, venue, default=None):
+        """Return the value of the configuration variable *name* in the
+        scope of *venue*, which is either a channel name or
+        `PRIVATE_CHANNEL`, or *default* if it has not been set."""
+        for scope in (venue, None):
+            value = self.variables.get(scope, {}).get(name)
+            if value is not None:
+                return value
+        return default
+
     # Ignore rules
 
     def ignore(self, name, rule, scope=None):
@@ -97,6 +97,8 @@ class ConnectionTestMixin(object):
         self.transport = AbortableStringTransport()
         self.connection = Connection()
         self.connection.settings.set('command_prefixes', ['!'])
+        # Most tests expect outgoing lines to be sent immediately.
+        self.connection.settings.set('flood_burst', 0)
         self.connection.reactor = Clock()
         self.connection.makeConnection(self.transport)
         if self.sign_on:
@@ -9,7 +9,6 @@ from textwrap import dedent
 from twisted.internet.defer import inlineCallbacks, fail, succeed
 from twisted.trial.unittest import TestCase
 
-from ...connection import MAX_REPLY_LENGTH
 from ...message import Message, MessageType, collapse
 from ...plugin import EventPlugin, UserVisibleError
 from ...plugins.more import Default as More
@@ -71,13 +70,14 @@ class BasicCommandTestCase(CommandMonitorMixin, TestCase):
             quisque suspendisse faccummy etuerci; vullandigna praestie
             hac consectem ipisim esequi. Facidui augiam proin nisit
             diamet ing. Incinim iliquipisl ero alit amconsecte adionse
-            loborer odionsequip sagittis, (+1 more)"""))
+            loborer odionsequip sagittis, iuscipit hent dipiscipit.
+            Molore proin consecte min amcommo; lobortio platea loboreet
+            il consequis. Lan ullut corem esectem vercilisit (+1 more)
+            """))
         self.more(venue='#foo')
         self.assertEqual(self.outgoing.last_seen.content, collapse("""
-            \x0314{}: iuscipit hent dipiscipit. Molore proin consecte
-            min amcommo; lobortio platea loboreet il consequis. Lan
-            ullut corem esectem vercilisit delent exer, feu inciduipit
-            feum in augait vullam. Tortor augait dignissim."""
+            \x0314{}: delent exer, feu inciduipit feum in augait vullam.
+            Tortor augait dignissim."""
             .format(self.other_users[0].nick)))
 
     def assert_success_private(self):
@@ -89,13 +89,13 @@ class BasicCommandTestCase(CommandMonitorMixin, TestCase):
             suspendisse faccummy etuerci; vullandigna praestie hac
             consectem ipisim esequi. Facidui augiam proin nisit diamet
             ing. Incinim iliquipisl ero alit amconsecte adionse loborer
-            odionsequip sagittis, (+1 more)"""))
+            odionsequip sagittis, iuscipit hent dipiscipit. Molore proin
+            consecte min amcommo; lobortio platea loboreet il consequis.
+            Lan ullut corem esectem vercilisit delent (+1 more)"""))
         self.more(venue=self.connection.nickname)
         self.assertEqual(self.outgoing.last_seen.content, collapse("""
-            iuscipit hent dipiscipit. Molore proin consecte min amcommo;
-            lobortio platea loboreet il consequis. Lan ullut corem
-            esectem vercilisit delent exer, feu inciduipit feum in
-            augait vullam. Tortor augait dignissim."""))
+            exer, feu inciduipit feum in augait vullam. Tortor augait
+            dignissim."""))
 
     def assert_hidden_error(self, deferred_result=None):
         self.assertEqual(self.outgoing.last_seen.action, MessageType.privmsg)
@@ -274,6 +274,10 @@ class ReplyTruncationTestCase(ConnectionTestMixin, TestCase):
         self.request = Message(self.connection, False, 'command',
             actor=self.other_users[0], subaction='spam',
             venue=self.connection.nickname, target=self.other_users[0].nick)
+        # Shorten the maximum line length to leave 291 bytes for each
+        # reply, including the trailing ellipsis.
+        self.connection.supported.parse(['LINELEN={}'.format(
+            512 - self.connection.reply_length(self.request) + 291)])
 
     def test_str(self):
         self.connection.reply(collapse("""\
@@ -317,6 +321,31 @@ class ReplyTruncationTestCase(ConnectionTestMixin, TestCase):
             石...""").encode('utf-8'))
 
 
+class PackedReplyCommand(EventPlugin):
+    def on_command(self, msg):
+        return ['\x02foo', 'bar', 'baz\nquux', '*' * 400, 'spam']
+
+
+class PackedReplyTestCase(CommandMonitorMixin, TestCase):
+    command_class = PackedReplyCommand
+
+    def setUp(self):
+        super(PackedReplyTestCase, self).setUp()
+        self.connection.settings.set('reply_packing', True)
+
+    def test_packing(self):
+        self.receive('PRIVMSG {} :packedreplycommand'.format(
+            self.connection.nickname))
+        self.assertEqual(self.outgoing.last_seen.content,
+                         '\x02foo\x0F / bar / baz / quux (+2 more)')
+        self.more()
+        self.assertTrue(self.outgoing.last_seen.content.startswith('***'))
+        self.assertTrue(self.outgoing.last_seen.content.endswith(
+            '... (+1 more)'))
+        self.more()
+        self.assertEqual(self.outgoing.last_seen.content, 'spam')
+
+
 class LongReplyWithMoreCommand(EventPlugin):
     def on_command(self, msg):
         return ['*' * 999] * 999
@@ -328,8 +357,10 @@ class LongReplyWithMoreTestCase(CommandMonitorMixin, TestCase):
     def test_more_tag_visible(self):
         self.receive('PRIVMSG {} :longreplywithmorecommand'.format(
             self.connection.nickname))
+        length = self.connection.reply_length(
+            self.command_message(''), tail='... (+998 more)')
         self.assertEqual(self.outgoing.last_seen.content,
-                         '*' * MAX_REPLY_LENGTH + '... (+998 more)')
+                         '*' * length + '... (+998 more)')
         self.more()
         self.assertEqual(self.outgoing.last_seen.content,
-                         '*' * MAX_REPLY_LENGTH + '... (+997 more)')
+                         '*' * length + '... (+997 more)')
@@ -3,11 +3,15 @@
 # pylint: disable=missing-docstring,too-few-public-methods
 
 
+from itertools import count, imap
+
+from twisted.internet.defer import Deferred
 from twisted.trial.unittest import TestCase
 
 from ....compat import length_hint
 from ....message import collapse
-from ....message.buffering import ReplyBuffer
+from ....message.buffering import (LAZY_CHUNK_THRESHOLD, IteratorStore,
+                                   ReplyBuffer, chunk)
 
 
 class ReplyBufferTestCase(TestCase):
@@ -137,6 +141,22 @@ class ReplyBufferTestCase(TestCase):
             vulluptatum. Nisim netus fames esting vendipissit commolum
             facidunt."""))
 
+    def test_formatting_only_tail(self):
+        self.assertEqual(list(chunk('\x02foo bar\x02 \x03', max_length=5)),
+                         ['\x02foo', '\x02bar\x02'])
+
+    def test_lazy_str(self):
+        words = ' '.join(str(i) for i in xrange(LAZY_CHUNK_THRESHOLD))
+        buf = ReplyBuffer('\x02' + words)
+        self.assertIsInstance(buf.store, IteratorStore)
+        self.assertEqual(len(buf.store.replies), 0)
+        self.assertEqual(next(buf), '\x02' + words[:253])
+        self.assertEqual(length_hint(buf), (len(words) - 253) // 256 + 1)
+        chunks = list(buf)
+        self.assertTrue(all(len(chunk) <= 256 for chunk in chunks))
+        self.assertEqual(' '.join(chunk[1:] for chunk in chunks),
+                         words[254:])
+
     def test_sequence(self):
         buf = ReplyBuffer(['foo', 'bar', 'baz'])
         self.assertEqual(length_hint(buf), 3)
@@ -147,3 +167,76 @@ class ReplyBufferTestCase(TestCase):
         self.assertEqual(next(buf), 'baz')
         self.assertEqual(length_hint(buf), 0)
         self.assertRaises(StopIteration, next, buf)
+
+    def test_sequence_skip(self):
+        buf = ReplyBuffer(map(str, xrange(10)))
+        buf.skip(3)
+        self.assertEqual(length_hint(buf), 7)
+        self.assertEqual(next(buf), '3')
+        buf.skip(100)
+        self.assertEqual(length_hint(buf), 0)
+        self.assertRaises(StopIteration, next, buf)
+
+    def test_sequence_tee(self):
+        response = map(str, xrange(3))
+        one, two = ReplyBuffer(response).tee()
+        self.assertIs(one.store, two.store)
+        self.assertEqual(next(one), '0')
+        self.assertEqual(next(one), '1')
+        self.assertEqual(length_hint(one), 1)
+        self.assertEqual(length_hint(two), 3)
+        self.assertEqual(next(two), '0')
+        # Mutating the original response has no effect.
+        response[2] = 'foo'
+        self.assertEqual(next(one), '2')
+
+    def test_iterator(self):
+        buf = ReplyBuffer(iter(map(str, xrange(3))))
+        self.assertEqual(length_hint(buf), 3)
+        self.assertEqual(next(buf), '0')
+        self.assertEqual(length_hint(buf), 2)
+        buf.skip(1)
+        self.assertEqual(next(buf), '2')
+        self.assertRaises(StopIteration, next, buf)
+
+    def test_iterator_tee(self):
+        one, two = ReplyBuffer(imap(str, count())).tee()
+        self.assertEqual(next(one), '0')
+        self.assertEqual(next(one), '1')
+        self.assertEqual(len(one.store.replies), 2)
+        self.assertEqual(next(two), '0')
+        self.assertEqual(len(one.store.replies), 1)
+        self.assertEqual(next(two), '1')
+        self.assertEqual(len(one.store.replies), 0)
+        del one
+        self.assertEqual(next(two), '2')
+        self.assertEqual(len(two.store.replies), 0)
+
+    def test_iterator_tee_deferred(self):
+        deferreds = [Deferred(), Deferred()]
+        one, two = ReplyBuffer(iter(deferreds)).tee()
+        results = []
+        next(one).addCallback(results.append)
+        next(two).addCallback(results.append)
+        deferreds[0].callback('foo')
+        self.assertEqual(results, ['foo', 'foo'])
+        deferreds[1].errback(ValueError())
+        self.failureResultOf(next(one), ValueError)
+        self.failureResultOf(next(two), ValueError)
+
+    def test_close(self):
+        closed = []
+        def generator():
+            try:
+                yield 'foo'
+                yield 'bar'
+            finally:
+                closed.append(True)
+        one, two = ReplyBuffer(generator()).tee()
+        self.assertEqual(next(one), 'foo')
+        one.close()
+        self.assertRaises(StopIteration, next, one)
+        self.assertEqual(closed, [])
+        self.assertEqual(next(two), 'foo')
+        two.close()
+        self.assertEqual(closed, [True])
@@ -4,7 +4,8 @@
 
 from twisted.trial import unittest
 
-from ....message.formatting import remove_formatting, unclosed_formatting
+from ....message.formatting import (FormattingState, remove_formatting,
+                                      unclosed_formatting)
 
 
 class FormattingRemovalTestCase(unittest.TestCase):
@@ -45,3 +46,14 @@ class UnclosedFormattingTestCase(unittest.TestCase):
 
     def test_all_open(self):
         self._test('\x02\x031,1\x16\x1F', ['\x02', '\x031,1', '\x16', '\x1F'])
+
+
+class FormattingStateTestCase(unittest.TestCase):
+    def test_incremental(self):
+        state = FormattingState()
+        state.update('\x02a\x0F\x1Fm')
+        self.assertItemsEqual(state.open_codes(), ['\x1F'])
+        state.update('\x033e')
+        self.assertItemsEqual(state.open_codes(), ['\x1F', '\x033'])
+        state.update('t\x0F')
+        self.assertItemsEqual(state.open_codes(), [])
@@ -2,12 +2,16 @@
 # pylint: disable=missing-docstring,too-few-public-methods
 
 
+from twisted.internet.error import ConnectionDone
 from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 from twisted.web.test.test_agent import AbortableStringTransport
 from twisted.words.protocols.irc import RPL_NAMREPLY, RPL_ENDOFNAMES
 
 from ...connection import Connection, ConnectionFactory
+from ...hostmask import Hostmask
+from ...message import Message
+from ...message.buffering import ReplyBuffer
 from ...settings import ConnectionSettings
 from ..helpers import ConnectionTestMixin, NoticingPlugin
 
@@ -26,8 +30,7 @@ class JoinSuspensionTestCase(ConnectionTestMixin, TestCase):
         self.connection.join('#bar')
         self.assertEqual(self.transport.value(), '')
         self.connection.resume_joins()
-        self.assertEqual(self.transport.value(),
-                         'JOIN #foo\r\nJOIN #foo\r\nJOIN #bar\r\n')
+        self.assertEqual(self.transport.value(), 'JOIN #foo,#bar\r\n')
         self.transport.clear()
         # Same for redundant resumptions.
         self.connection.resume_joins()
@@ -149,3 +152,371 @@ class SettingsReloadingTestCase(TestCase):
             'plugin {}'.format(NoticingPlugin.name): True})
         new_plugin = self.factory.settings.active_plugins().keys()[0]
         self.assertIs(old_plugin, new_plugin)
+
+
+class ReplyBufferTestCase(ConnectionTestMixin, TestCase):
+    def setUp(self):
+        super(ReplyBufferTestCase, self).setUp()
+        self.connection.joined('#foo')
+        self.connection.names_arrived('#foo', ['alice', 'bob'])
+        self.connection.joined('#bar')
+        self.connection.names_arrived('#bar', ['alice', 'bob'])
+
+    def set_buffer(self, venue, nick, size):
+        buf = ReplyBuffer(['*' * size])
+        self.connection.set_reply_buffer(venue, nick, buf)
+        return buf
+
+    def assert_released(self, venue, nick):
+        user_info = self.connection.venues[venue].nicks[nick]
+        self.assertNotIn(user_info, self.connection.reply_buffers)
+        self.assertIsNone(next(user_info.reply_buffer, None))
+
+    def test_usage(self):
+        self.assertEqual(self.connection.reply_buffer_usage(), 0)
+        buf = self.set_buffer('#foo', 'alice', 100)
+        size = buf.size_hint()
+        self.assertGreaterEqual(size, 100)
+        self.set_buffer('#bar', 'bob', 100)
+        self.assertEqual(self.connection.reply_buffer_usage('#foo'), size)
+        self.assertEqual(self.connection.reply_buffer_usage('#FOO'), size)
+        self.assertEqual(self.connection.reply_buffer_usage(), size * 2)
+
+    def test_usage_after_reading(self):
+        buf = ReplyBuffer(['*' * 100, '*' * 100])
+        self.connection.set_reply_buffer('#foo', 'alice', buf)
+        next(buf)
+        self.assertEqual(self.connection.reply_buffer_usage(),
+                         ReplyBuffer(['*' * 100]).size_hint())
+
+    def test_ttl(self):
+        self.connection.settings.set('reply_buffer_ttl', 90)
+        self.set_buffer('#foo', 'alice', 10)
+        self.connection.reactor.advance(60)
+        self.set_buffer('#foo', 'bob', 10)
+        self.connection.reactor.advance(60)
+        self.assert_released('#foo', 'alice')
+        self.assertEqual(len(self.connection.reply_buffers), 1)
+        self.connection.reactor.advance(60)
+        self.assert_released('#foo', 'bob')
+        self.assertEqual(self.connection.reply_buffer_usage(), 0)
+
+    def test_venue_limit(self):
+        size = ReplyBuffer(['*' * 1000]).size_hint()
+        self.connection.settings.set('reply_buffer_venue_limit', size * 2)
+        self.set_buffer('#foo', 'alice', 1000)
+        self.set_buffer('#bar', 'alice', 1000)
+        self.set_buffer('#foo', 'bob', 1000)
+        self.assertEqual(len(self.connection.reply_buffers), 3)
+        self.set_buffer('#foo', 'charlie', 1000)
+        self.assert_released('#foo', 'alice')
+        self.assertEqual(self.connection.reply_buffer_usage('#foo'), size * 2)
+        self.assertEqual(self.connection.reply_buffer_usage('#bar'), size)
+
+    def test_total_limit(self):
+        size = ReplyBuffer(['*' * 1000]).size_hint()
+        self.connection.settings.set('reply_buffer_total_limit', size * 2)
+        self.set_buffer('#foo', 'alice', 1000)
+        self.set_buffer('#bar', 'alice', 1000)
+        self.set_buffer('#foo', 'bob', 1000)
+        self.assert_released('#foo', 'alice')
+        self.assertEqual(self.connection.reply_buffer_usage(), size * 2)
+
+    def test_oversized_buffer_kept(self):
+        self.connection.settings.set('reply_buffer_total_limit', 10)
+        self.set_buffer('#foo', 'alice', 1000)
+        self.set_buffer('#foo', 'bob', 1000)
+        self.assert_released('#foo', 'alice')
+        self.assertEqual(len(self.connection.reply_buffers), 1)
+
+    def test_close(self):
+        def generator():
+            try:
+                yield 'foo'
+                yield 'bar'
+            finally:
+                closed.append(True)
+        closed = []
+        buf = ReplyBuffer(generator())
+        self.assertEqual(next(buf), 'foo')
+        self.connection.set_reply_buffer('#foo', 'alice', buf)
+        self.connection.userLeft('alice', '#foo')
+        self.assertEqual(closed, [True])
+
+    def test_release_on_part(self):
+        self.set_buffer('#foo', 'alice', 10)
+        self.set_buffer('#bar', 'alice', 10)
+        user_info = self.connection.venues['#foo'].nicks['alice']
+        self.connection.userLeft('alice', '#foo')
+        self.assertNotIn(user_info, self.connection.reply_buffers)
+        self.assertEqual(len(self.connection.reply_buffers), 1)
+
+    def test_release_on_quit(self):
+        self.set_buffer('#foo', 'alice', 10)
+        self.set_buffer('#bar', 'alice', 10)
+        self.set_buffer('#bar', 'bob', 10)
+        self.connection.userQuit('alice', 'Client Quit')
+        self.assertEqual(len(self.connection.reply_buffers), 1)
+
+    def test_release_on_kick(self):
+        self.set_buffer('#foo', 'alice', 10)
+        self.connection.userKicked('alice', '#foo', 'bob', '')
+        self.assertEqual(len(self.connection.reply_buffers), 0)
+
+    def test_release_on_own_part(self):
+        self.set_buffer('#foo', 'alice', 10)
+        self.set_buffer('#foo', 'bob', 10)
+        self.set_buffer('#bar', 'bob', 10)
+        self.connection.left('#foo')
+        self.assertEqual(len(self.connection.reply_buffers), 1)
+
+
+class ReplyLengthTestCase(ConnectionTestMixin, TestCase):
+    def setUp(self):
+        super(ReplyLengthTestCase, self).setUp()
+        self.connection.joined('#foo')
+        self.request = Message(
+            self.connection, False, 'command', actor=self.other_users[0],
+            venue='#foo', target='alice', subaction='spam')
+        self.prefix = ':{}!{}@{} '.format(self.connection.nickname,
+                                         'x' * 10, 'x' * 63)
+
+    def assert_length(self, prefix):
+        self.assertEqual(self.connection.reply_length(self.request),
+                         512 - len(prefix) - len('PRIVMSG #foo :') -
+                         len('\x0314alice: ') - len('\r\n'))
+
+    def test_worst_case(self):
+        self.assert_length(self.prefix)
+
+    def test_private(self):
+        request = self.request._replace(venue=self.connection.nickname)
+        self.assertEqual(self.connection.reply_length(request, tail='...'),
+                         512 - len(self.prefix) - len('NOTICE alice :') -
+                         len('\r\n') - len('...'))
+
+    def test_own_hostmask(self):
+        self.echo('JOIN #foo')
+        self.assert_length(':{}!user@host '.format(self.connection.nickname))
+        self.connection.irc_396('irc.server.test', [
+            self.connection.nickname, 'cloaked.test', 'is now your host'])
+        self.assert_length(':{}!user@cloaked.test '.format(
+            self.connection.nickname))
+
+    def test_linelen(self):
+        length = self.connection.reply_length(self.request)
+        self.connection.supported.parse(['LINELEN=1024'])
+        self.assertEqual(self.connection.reply_length(self.request),
+                         length + 512)
+
+    def test_single_line(self):
+        self.transport.clear()
+        self.connection.reply('*' * 1000, self.request)
+        lines = self.transport.value().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(len(self.prefix + lines[0] + '\r\n'), 512)
+        self.assertTrue(lines[0].endswith('...'))
+
+
+class FloodControlTestCase(ConnectionTestMixin, TestCase):
+    def setUp(self):
+        super(FloodControlTestCase, self).setUp()
+        self.connection.settings.set('flood_burst', 2)
+        self.connection.settings.set('flood_interval', 2)
+        self.connection.joined('#foo')
+        self.transport.clear()
+
+    def request(self, nick):
+        return Message(self.connection, False, 'command',
+                       actor=Hostmask(nick, 'user', 'host'), venue=nick,
+                       target=nick, subaction='spam')
+
+    def sent(self):
+        lines = self.transport.value().splitlines()
+        self.transport.clear()
+        return lines
+
+    def test_burst(self):
+        for i in xrange(4):
+            self.connection.msg('#foo', str(i))
+        self.assertEqual(self.sent(), ['PRIVMSG #foo :0', 'PRIVMSG #foo :1'])
+        self.connection.reactor.advance(2)
+        self.assertEqual(self.sent(), ['PRIVMSG #foo :2'])
+        self.connection.reactor.advance(2)
+        self.assertEqual(self.sent(), ['PRIVMSG #foo :3'])
+        self.assertEqual(self.connection.outgoing_queue_length(), 0)
+
+    def test_priorities(self):
+        self.connection.msg('#foo', 'a')
+        self.connection.msg('#foo', 'b')
+        self.connection.msg('#foo', 'event')
+        self.connection.reply('reply', self.request('alice'))
+        self.connection.sendLine('PONG irc.server.test')
+        self.sent()
+        self.connection.reactor.pump([2] * 3)
+        self.assertEqual(self.sent(), ['PONG irc.server.test',
+                                       'NOTICE alice :reply',
+                                       'PRIVMSG #foo :event'])
+
+    def test_fairness(self):
+        self.connection.msg('#foo', 'a')
+        self.connection.msg('#foo', 'b')
+        for i in xrange(3):
+            self.connection.reply(str(i), self.request('alice'))
+        self.connection.reply('0', self.request('bob'))
+        self.sent()
+        self.connection.reactor.pump([2] * 4)
+        self.assertEqual(self.sent(), ['NOTICE alice :0', 'NOTICE bob :0',
+                                       'NOTICE alice :1', 'NOTICE alice :2'])
+
+    def test_stale_lines(self):
+        self.connection.settings.set('flood_queue_limit', 2)
+        self.connection.msg('#foo', 'a')
+        self.connection.msg('#foo', 'b')
+        self.connection.reply('reply', self.request('alice'))
+        for i in xrange(3):
+            self.connection.msg('#foo', str(i))
+        self.sent()
+        self.connection.reactor.pump([2] * 5)
+        self.assertEqual(self.sent(), ['NOTICE alice :reply',
+                                       'PRIVMSG #foo :2'])
+
+    def test_undroppable_lines(self):
+        self.connection.settings.set('flood_queue_limit', 1)
+        self.connection.msg('#foo', 'a')
+        self.connection.msg('#foo', 'b')
+        for i in xrange(2):
+            self.connection.reply(str(i), self.request('alice'))
+        self.connection.join('#bar')
+        self.connection.mode('#foo', True, 'v', user='bob')
+        self.connection.msg('NickServ', 'IDENTIFY hunter2')
+        self.connection.msg('#foo', 'chatter')
+        self.sent()
+        self.connection.reactor.pump([2] * 6)
+        self.assertEqual(self.sent(), ['NOTICE alice :0',
+                                       'NOTICE alice :1',
+                                       'JOIN #bar',
+                                       'MODE #foo +v bob',
+                                       'PRIVMSG NickServ :IDENTIFY hunter2'])
+
+    def test_queue_before_connecting(self):
+        connection = self.connection.__class__()
+        self.assertEqual(connection.outgoing_queue_length(), 0)
+        self.assertIsNone(connection.flood_call)
+
+
+class ModeBatchingTestCase(ConnectionTestMixin, TestCase):
+    def setUp(self):
+        super(ModeBatchingTestCase, self).setUp()
+        self.connection.joined('#foo')
+        self.transport.clear()
+
+    def test_mixed_modes(self):
+        self.connection.queue_mode('#foo', True, 'o', 'alice')
+        self.connection.queue_mode('#foo', True, 'o', 'alice')
+        self.connection.queue_mode('#foo', False, 'v', 'bob')
+        self.connection.queue_mode('#foo', True, 'm')
+        self.assertEqual(self.transport.value(), '')
+        self.connection.flush_modes('#FOO')
+        self.assertEqual(self.transport.value(),
+                         'MODE #foo +o-v+m alice bob\r\n')
+
+    def test_discard_on_part(self):
+        self.connection.queue_mode('#foo', True, 'v', 'alice')
+        self.connection.left('#foo')
+        self.connection.reactor.advance(self.connection.mode_batch_window)
+        self.assertEqual(self.transport.value(), '')
+
+    def test_discard_on_disconnect(self):
+        self.connection.queue_mode('#foo', True, 'v', 'alice')
+        self.connection.connectionLost(ConnectionDone())
+        self.assertEqual(self.connection.pending_modes, {})
+        self.assertEqual(self.connection.reactor.getDelayedCalls(), [])
+
+    def test_discard_on_quit(self):
+        self.connection.queue_mode('#foo', True, 'v', 'alice')
+        self.connection.quit()
+        self.connection.reactor.advance(self.connection.mode_batch_window)
+        self.assertEqual(self.transport.value(), 'QUIT :\r\n')
+
+    def test_queue_before_connecting(self):
+        connection = self.connection.__class__()
+        connection.reactor = self.connection.reactor
+        connection.queue_mode('#foo', True, 'v', 'alice')
+        self.assertIn('#foo', connection.pending_modes)
+
+
+class JoinSchedulingTestCase(ConnectionTestMixin, TestCase):
+    def setUp(self):
+        super(JoinSchedulingTestCase, self).setUp()
+        self.connection.joined('#foo')
+        self.transport.clear()
+
+    def test_targmax(self):
+        self.connection.supported.parse(['TARGMAX=JOIN:2,PRIVMSG:4'])
+        self.connection.join_channels(['#foo', '#a', '#b', '#c', '#A'])
+        self.assertEqual(self.transport.value(), 'JOIN #a,#b\r\nJOIN #c\r\n')
+
+    def test_line_length(self):
+        channels = ['#' + str(i) * 50 for i in xrange(10)]
+        self.connection.join_channels(channels)
+        lines = self.transport.value().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(','.join(line[len('JOIN '):] for line in lines),
+                         ','.join(channels))
+
+    def test_chanlimit(self):
+        self.connection.supported.parse(['CHANLIMIT=#:3,&:'])
+        self.connection.join_channels(['#a', '#b', '&c', '#d'])
+        self.assertEqual(self.transport.value(), 'JOIN #a,#b,&c\r\n')
+
+    def test_pacing(self):
+        self.connection.settings.set('flood_burst', 1)
+        self.connection.settings.set('flood_interval', 2)
+        self.connection.supported.parse(['TARGMAX=JOIN:1'])
+        self.connection.join_channels(['#a', '#b', '#c'])
+        self.assertEqual(self.transport.value(), 'JOIN #a\r\n')
+        self.assertEqual(self.connection.outgoing_queue_length(), 0)
+        self.connection.reactor.pump([2] * 2)
+        self.assertEqual(self.transport.value(),
+                         'JOIN #a\r\nJOIN #b\r\nJOIN #c\r\n')
+
+
+class BroadcastTestCase(ConnectionTestMixin, TestCase):
+    def setUp(self):
+        super(BroadcastTestCase, self).setUp()
+        self.transport.clear()
+
+    def test_no_targmax(self):
+        self.connection.broadcast(['#foo', '#bar'], 'hello')
+        self.assertEqual(self.transport.value(),
+                         'PRIVMSG #foo :hello\r\nPRIVMSG #bar :hello\r\n')
+
+    def test_targmax(self):
+        self.connection.supported.parse(['TARGMAX=PRIVMSG:2,NOTICE:'])
+        self.connection.settings.set('encoding', 'latin-1', scope='#baz')
+        self.connection.broadcast(['#a', '#b', '#baz', '#c'], u'caf\xe9')
+        self.assertEqual(self.transport.value(),
+                         'PRIVMSG #a,#b :caf\xc3\xa9\r\n'
+                         'PRIVMSG #c :caf\xc3\xa9\r\n'
+                         'PRIVMSG #baz :caf\xe9\r\n')
+        self.transport.clear()
+        self.connection.broadcast(['#a', '#b', '#c'], 'hi', notice=True)
+        self.assertEqual(self.transport.value(), 'NOTICE #a,#b,#c :hi\r\n')
+
+    def test_reply_format(self):
+        self.connection.supported.parse(['TARGMAX=PRIVMSG:4'])
+        self.connection.settings.set('reply_format', '{target}> {message}',
+                                     scope='#b')
+        self.connection.broadcast(['#a', '#b', '#c'], 'hi', target='alice')
+        self.assertEqual(self.transport.value(),
+                         'PRIVMSG #a,#c :\x0314alice: hi\r\n'
+                         'PRIVMSG #b :alice> hi\r\n')
+
+    def test_long_payload(self):
+        self.connection.supported.parse(['TARGMAX=PRIVMSG:4'])
+        self.connection.broadcast(['#a', '#b'], 'lorem ipsum ' * 60)
+        lines = self.transport.value().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(all(line.startswith('PRIVMSG #a,#b :')
+                            for line in lines))
@@ -8,7 +8,7 @@ from ...case_mapping import CaseMapping, KNOWN_CASE_MAPPINGS
 from ...hostmask import Hostmask
 from ...message import Message
 from ...plugin import EventPlugin
-from ...settings import ConnectionSettings
+from ...settings import ConnectionSettings, PRIVATE_CHANNEL
 from ..helpers import DummyConnection
 from .test_case_mapping import EXPECTED as CASE_MAPPING_EXPECTED
 
@@ -134,6 +134,18 @@ class SettingsTestCase(unittest.TestCase):
         self.assertEqual(settings.get('eggs', message=PRIVATE_MESSAGE),
                          'private')
 
+    def test_get_in_venue(self):
+        settings = ConnectionSettings({
+            'set spam': 'connection',
+            'set ham': 'connection',
+            'channel foo': {'set ham': 'channel'},
+            'private': {'set ham': 'private'}})
+        self.assertEqual(settings.get_in_venue('spam', '#FOO'), 'connection')
+        self.assertEqual(settings.get_in_venue('ham', '#FOO'), 'channel')
+        self.assertEqual(settings.get_in_venue('ham', PRIVATE_CHANNEL),
+                         'private')
+        self.assertEqual(settings.get_in_venue('eggs', '#foo', default=1), 1)
+
     def test_case_mapping(self):
         for (a, b), equal_case_mappings in CASE_MAPPING_EXPECTED.iteritems():
             settings = ConnectionSettings({
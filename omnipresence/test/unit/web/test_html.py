@@ -6,7 +6,7 @@ from __future__ import unicode_literals
 
 from twisted.trial import unittest
 
-from ....web.html import parse, textify
+from ....web.html import FAST_BS4_PARSER, parse, strainer, textify
 
 
 class HTMLTestCase(unittest.TestCase):
@@ -42,6 +42,55 @@ class HTMLTestCase(unittest.TestCase):
         self.assert_textify('lorem <i><b>ipsum</b> dolor </i>sit amet',
                             'lorem ipsum dolor sit amet', False)
 
+    def test_unicode_whitespace(self):
+        self.assert_textify('<b>a\u3000</b>\x1f b', '\x02a \x02 b')
+        self.assert_textify(' \n <i> </i> ', '\x16 \x16')
+        self.assert_textify(' \n <i> </i> ', '', False)
+
+    def test_comments(self):
+        self.assert_textify('a<!-- b -->c', 'a b c')
+        self.assert_textify('a<!-- b -->c', 'ac', False)
+
+    def test_deep_nesting(self):
+        depth = 5000
+        soup = parse('<span>' * depth + 'hello' + '</span>' * depth)
+        self.assertEqual(textify(soup), 'hello')
+
     def test_textify_tag(self):
         soup = parse('<a><b>hello</b></a>')
         self.assertEqual(textify(soup.a, format_output=False), 'hello')
+
+
+class ParseTestCase(unittest.TestCase):
+    markup = ('<div id="main"><table class="list wide"><tr><td>1</td></tr>'
+              '</table><p>skip</p></div><pre>jdic</pre>'
+              '<table class="other"><tr><td>2</td></tr></table>')
+
+    def assert_only(self, only, expected):
+        for parser in (None, FAST_BS4_PARSER):
+            soup = parse(self.markup, only=only, parser=parser)
+            self.assertEqual(textify(soup, format_output=False), expected)
+
+    def test_full(self):
+        self.assert_only(None, '1skipjdic2')
+
+    def test_tag(self):
+        self.assert_only('pre', 'jdic')
+
+    def test_class(self):
+        self.assert_only('table.list', '1')
+        self.assert_only('.wide', '1')
+
+    def test_id(self):
+        self.assert_only('div#main', '1skip')
+        self.assert_only('#main', '1skip')
+
+    def test_multiple(self):
+        self.assert_only('table.list, table.other', '12')
+
+    def test_strainer(self):
+        self.assert_only(strainer('td'), '12')
+
+    def test_invalid_selector(self):
+        for selector in ('', 'div > p', 'a.b.c', 'a:hover'):
+            self.assertRaises(ValueError, strainer, selector)
@@ -5,24 +5,609 @@
 from __future__ import print_function
 import json
 
+from twisted.internet.defer import CancelledError, Deferred, succeed
+from twisted.internet.endpoints import HostnameEndpoint
+from twisted.internet.error import ConnectionLost, TimeoutError
+from twisted.internet.task import Clock
 from twisted.test.proto_helpers import StringTransport
+from twisted.python.failure import Failure
 from twisted.trial.unittest import TestCase
-from twisted.web.client import Response
+from twisted.web.client import (URI, Response, ResponseNeverReceived,
+                                readBody)
+from twisted.web.error import SchemeNotSupported
 from twisted.web.http_headers import Headers
 
-from ....web.http import read_json_body
+from ....web.http import (CachingAgent, CircuitBreakerAgent,
+                          CircuitOpenError, CoalescingAgent, ConnectionPool,
+                          DiskStore, HostTimeouts, IdentifyingAgent,
+                          IncrementalJSONDecoder,
+                          MAX_BODY_BYTES, ResponseTooLarge, Timeouts,
+                          TimeoutAgent, TimeoutEndpointFactory,
+                          read_body, read_json_body)
+from ....plugin import UserVisibleError
 
 
-class ReadJSONBodyTestCase(TestCase):
+def make_response(code, headers, body):
+    response = Response(('HTTP', 1, 1), code, 'OK', Headers(headers),
+                        StringTransport())
+    response._bodyDataReceived(body)
+    response._bodyDataFinished()
+    return response
+
+
+class ReadBodyTestCase(TestCase):
     def test_simple(self):
-        data = [{'foo': 'bar', 'index': i} for i in xrange(10000)]
-        json_str = json.dumps(data)
+        finished = read_body(make_response(200, {}, 'foo'), max_bytes=3)
+        self.assertEqual(self.successResultOf(finished), 'foo')
+
+    def test_too_large(self):
         response = Response(('HTTP', 1, 1), 200, 'OK', Headers(),
                             StringTransport())
-        finished = read_json_body(response)
-        finished.addCallback(self.assertEqual, data)
+        finished = read_body(response, max_bytes=5)
+        response._bodyDataReceived('foo')
+        self.assertNoResult(finished)
+        response._bodyDataReceived('bar')
+        self.failureResultOf(finished, ResponseTooLarge)
+        self.assertEqual(response._transport.producerState, 'stopped')
+        response._bodyDataFinished()
+
+
+class ReadJSONBodyTestCase(TestCase):
+    def deliver(self, json_str, **kwargs):
+        response = Response(('HTTP', 1, 1), 200, 'OK', Headers(),
+                            StringTransport())
+        finished = read_json_body(response, **kwargs)
         chunk_length = 1000
         for start in xrange(0, len(json_str), chunk_length):
             response._bodyDataReceived(json_str[start:start + chunk_length])
         response._bodyDataFinished()
         return finished
+
+    def test_simple(self):
+        data = [{'foo': 'bar', 'index': i} for i in xrange(10000)]
+        finished = self.deliver(json.dumps(data))
+        finished.addCallback(self.assertEqual, data)
+        return finished
+
+    def test_incremental(self):
+        data = {'items': [{'foo': 'bar', 'index': i} for i in xrange(10000)],
+                'count': 10000}
+        finished = self.deliver(json.dumps(data), incremental=True)
+        finished.addCallback(self.assertEqual, data)
+        return finished
+
+    def test_too_large(self):
+        finished = self.deliver(json.dumps(range(1000)), max_bytes=1000)
+        self.failureResultOf(finished, ResponseTooLarge)
+
+    def test_invalid(self):
+        finished = self.deliver('[1, 2', incremental=True)
+        self.failureResultOf(finished, ValueError)
+
+
+class IncrementalJSONDecoderTestCase(TestCase):
+    def decode(self, json_str, piece_length=1):
+        decoder = IncrementalJSONDecoder()
+        for start in xrange(0, len(json_str), piece_length):
+            decoder.feed(json_str[start:start + piece_length])
+        return decoder.finish()
+
+    def test_documents(self):
+        for json_str in ('[]', '{}', ' [ 1 , 22.5 , "a,]" , null ] ',
+                         '{"a": {"b": [1, 2]}, "c": 123, "d": "}"}',
+                         '12345', '"foo"', 'true', '[[], {}]'):
+            for piece_length in (1, 3, 100):
+                self.assertEqual(self.decode(json_str, piece_length),
+                                 json.loads(json_str))
+
+    def test_member_decoding(self):
+        decoder = IncrementalJSONDecoder()
+        decoder.feed('[{"a": 1}, {"b"')
+        self.assertEqual(decoder.result, [{'a': 1}])
+        self.assertEqual(decoder.buffer, '{"b"')
+
+    def test_invalid(self):
+        for json_str in ('', '[1,]', '[1 2]', '{"a" 1}', '{1: 2}', '[}',
+                         '[1] 2', '{"a": 1'):
+            self.assertRaises(ValueError, self.decode, json_str)
+
+
+class DummyProtocol(object):
+    state = 'QUIESCENT'
+
+    def __init__(self):
+        self.transport = StringTransport()
+
+
+class DummyEndpoint(object):
+    def connect(self, factory):
+        return succeed(DummyProtocol())
+
+
+class ConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = ConnectionPool(self.clock)
+        self.pool.retryAutomatically = False
+        self.endpoint = DummyEndpoint()
+
+    def connect(self, key):
+        return self.successResultOf(
+            self.pool.getConnection(key, self.endpoint))
+
+    def test_reuse(self):
+        connection = self.connect('a')
+        self.pool._putConnection('a', connection)
+        self.assertIs(self.connect('a'), connection)
+        statistics = self.pool.statistics()
+        self.assertEqual(statistics['created'], 1)
+        self.assertEqual(statistics['reused'], 1)
+        self.assertEqual(statistics['idle'], 0)
+
+    def test_per_host_limit(self):
+        self.pool.maxPersistentPerHost = 2
+        connections = [self.connect('a') for _ in xrange(3)]
+        for connection in connections:
+            self.pool._putConnection('a', connection)
+        self.assertTrue(connections[0].transport.disconnecting)
+        self.assertEqual(self.pool.statistics()['evicted'], 1)
+        self.assertEqual(self.pool.statistics()['idle'], 2)
+
+    def test_total_limit(self):
+        self.pool.maxPersistent = 2
+        connections = [self.connect(key) for key in 'abc']
+        for key, connection in zip('abc', connections):
+            self.pool._putConnection(key, connection)
+            self.clock.advance(1)
+        self.assertTrue(connections[0].transport.disconnecting)
+        self.assertFalse(connections[1].transport.disconnecting)
+        statistics = self.pool.statistics()
+        self.assertEqual(statistics['evicted'], 1)
+        self.assertEqual(statistics['idle'], 2)
+        self.assertEqual(statistics['hosts'], 2)
+        self.assertIsNot(self.connect('a'), connections[0])
+
+    def test_idle_timeout(self):
+        connection = self.connect('a')
+        self.pool._putConnection('a', connection)
+        self.clock.advance(self.pool.cachedConnectionTimeout)
+        self.assertTrue(connection.transport.disconnecting)
+        statistics = self.pool.statistics()
+        self.assertEqual(statistics['expired'], 1)
+        self.assertEqual(statistics['idle'], 0)
+
+    def test_closed_by_server(self):
+        connection = self.connect('a')
+        self.pool._putConnection('a', connection)
+        connection.state = 'CONNECTION_LOST'
+        self.clock.advance(self.pool.cachedConnectionTimeout)
+        statistics = self.pool.statistics()
+        self.assertEqual(statistics['expired'], 0)
+        self.assertEqual(statistics['idle'], 0)
+
+
+class DummyAgent(object):
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        self.requests.append((method, uri, headers))
+        return succeed(make_response(*self.responses.pop(0)))
+
+
+class CachingAgentTestCase(TestCase):
+    uri = 'http://www.example.com/'
+
+    def setUp(self):
+        self.clock = Clock()
+        self.agent = DummyAgent()
+        self.cache = CachingAgent(self.agent, reactor=self.clock)
+
+    def fetch(self, headers=None, cache=None, uri=None):
+        response = self.successResultOf((cache or self.cache).request(
+            'GET', uri or self.uri, headers))
+        return self.successResultOf(readBody(response))
+
+    def test_max_age(self):
+        self.agent.responses.append(
+            (200, {'cache-control': ['public, max-age=60']}, 'foo'))
+        self.agent.responses.append((200, {}, 'bar'))
+        self.assertEqual(self.fetch(), 'foo')
+        self.clock.advance(59)
+        self.assertEqual(self.fetch(), 'foo')
+        self.assertEqual(len(self.agent.requests), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.fetch(), 'bar')
+        statistics = self.cache.statistics()
+        self.assertEqual(statistics['hits'], 1)
+        self.assertEqual(statistics['misses'], 2)
+        self.assertEqual(statistics['entries'], 0)
+
+    def test_cached_request(self):
+        self.agent.responses.append(
+            (200, {'cache-control': ['max-age=60']}, 'foo'))
+        self.fetch()
+        response = self.successResultOf(self.cache.request('GET', self.uri))
+        self.assertEqual(response.request.absoluteURI, self.uri)
+        self.assertEqual(response.headers.getRawHeaders('cache-control'),
+                         ['max-age=60'])
+
+    def test_expires(self):
+        self.agent.responses.append(
+            (200, {'date': ['Sun, 06 Nov 1994 08:49:37 GMT'],
+                   'expires': ['Sun, 06 Nov 1994 08:50:37 GMT']}, 'foo'))
+        self.fetch()
+        self.clock.advance(30)
+        self.assertEqual(self.fetch(), 'foo')
+        self.assertEqual(len(self.agent.requests), 1)
+
+    def test_uncacheable(self):
+        for headers in ({}, {'cache-control': ['no-store, max-age=60']},
+                        {'cache-control': ['max-age=60'],
+                         'vary': ['cookie']}):
+            self.agent.responses.append((200, headers, 'foo'))
+            self.fetch()
+        self.assertEqual(len(self.agent.requests), 3)
+        self.assertEqual(self.cache.statistics()['entries'], 0)
+
+    def test_authorization(self):
+        self.agent.responses.append(
+            (200, {'cache-control': ['max-age=60']}, 'foo'))
+        self.agent.responses.append((200, {}, 'bar'))
+        self.fetch(Headers({'authorization': ['Bearer token']}))
+        self.assertEqual(self.fetch(), 'bar')
+
+    def test_default_ttl(self):
+        self.cache.default_ttls['http://www.example.com/'] = 60
+        self.agent.responses.append((200, {}, 'foo'))
+        self.fetch()
+        self.assertEqual(self.fetch(), 'foo')
+        self.assertEqual(len(self.agent.requests), 1)
+
+    def test_revalidation(self):
+        self.agent.responses.append(
+            (200, {'cache-control': ['max-age=60'], 'etag': ['"abc"']}, 'foo'))
+        self.agent.responses.append((304, {'etag': ['"abc"']}, ''))
+        self.fetch()
+        self.clock.advance(60)
+        self.assertEqual(self.fetch(), 'foo')
+        headers = self.agent.requests[1][2]
+        self.assertEqual(headers.getRawHeaders('if-none-match'), ['"abc"'])
+        self.assertEqual(self.cache.statistics()['revalidated'], 1)
+
+    def test_stale_on_arrival(self):
+        self.agent.responses.append(
+            (200, {'cache-control': ['no-cache'], 'etag': ['"abc"']}, 'foo'))
+        self.agent.responses.append((200, {}, 'bar'))
+        self.fetch()
+        self.assertEqual(self.cache.statistics()['entries'], 0)
+        self.assertEqual(self.fetch(), 'bar')
+        headers = self.agent.requests[1][2]
+        self.assertFalse(headers.hasHeader('if-none-match'))
+
+    def test_request_headers(self):
+        self.agent.responses.append(
+            (200, {'cache-control': ['max-age=60']}, 'foo'))
+        self.agent.responses.append(
+            (200, {'cache-control': ['max-age=60']}, 'bar'))
+        english = Headers({'accept-language': ['en']})
+        self.assertEqual(self.fetch(english), 'foo')
+        self.assertEqual(
+            self.fetch(Headers({'accept-language': ['ja']})), 'bar')
+        self.assertEqual(self.fetch(english), 'foo')
+        self.assertEqual(len(self.agent.requests), 2)
+
+    def test_large_body(self):
+        body = 'x' * (MAX_BODY_BYTES + 1)
+        self.agent.responses.append(
+            (200, {'cache-control': ['max-age=60']}, body))
+        response = self.successResultOf(self.cache.request('GET', self.uri))
+        self.assertEqual(
+            self.successResultOf(read_body(response, max_bytes=None)), body)
+        self.assertEqual(self.cache.statistics()['entries'], 0)
+
+    def test_unread_body(self):
+        self.agent.responses.append(
+            (200, {'cache-control': ['max-age=60']}, 'foo'))
+        self.agent.responses.append((200, {}, 'bar'))
+        self.successResultOf(self.cache.request('GET', self.uri))
+        self.assertEqual(self.fetch(), 'bar')
+
+    def test_memory_limit(self):
+        self.cache.max_bytes = 100
+        for i in xrange(3):
+            self.agent.responses.append(
+                (200, {'cache-control': ['max-age=60']}, 'x' * 40))
+            self.fetch(uri=self.uri + str(i))
+        statistics = self.cache.statistics()
+        self.assertEqual(statistics['evicted'], 2)
+        self.assertEqual(statistics['entries'], 1)
+        self.assertLessEqual(statistics['bytes'], 100)
+
+    def test_disk_store(self):
+        store = DiskStore(self.mktemp())
+        self.cache.store = store
+        self.agent.responses.append(
+            (200, {'cache-control': ['max-age=60']}, 'foo\nbar\xff'))
+        self.fetch()
+        cache = CachingAgent(self.agent, reactor=self.clock, store=store)
+        self.assertEqual(self.fetch(cache=cache), 'foo\nbar\xff')
+        self.assertEqual(len(self.agent.requests), 1)
+        self.assertEqual(cache.statistics()['hits'], 1)
+
+
+class DeferredAgent(object):
+    def __init__(self):
+        self.requests = []
+        self.cancelled = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        finished = Deferred(lambda d: self.cancelled.append(uri))
+        self.requests.append((method, uri, finished))
+        return finished
+
+
+class CoalescingAgentTestCase(TestCase):
+    uri = 'http://www.example.com/'
+
+    def setUp(self):
+        self.agent = DeferredAgent()
+        self.coalescer = CoalescingAgent(self.agent)
+
+    def test_coalesce(self):
+        first = self.coalescer.request('GET', self.uri)
+        second = self.coalescer.request('GET', self.uri)
+        self.assertEqual(len(self.agent.requests), 1)
+        self.agent.requests[0][2].callback(make_response(200, {}, 'foo'))
+        for finished in (first, second):
+            response = self.successResultOf(finished)
+            self.assertEqual(response.request.absoluteURI, self.uri)
+            self.assertEqual(self.successResultOf(readBody(response)), 'foo')
+        self.assertEqual(self.coalescer.statistics(),
+                         {'fetches': 1, 'coalesced': 1, 'in_flight': 0})
+        self.coalescer.request('GET', self.uri)
+        self.assertEqual(len(self.agent.requests), 2)
+
+    def test_single_request(self):
+        finished = self.coalescer.request('GET', self.uri)
+        response = make_response(200, {}, 'foo')
+        self.agent.requests[0][2].callback(response)
+        self.assertIs(self.successResultOf(finished), response)
+
+    def test_large_body(self):
+        body = 'x' * (MAX_BODY_BYTES + 1)
+        first = self.coalescer.request('GET', self.uri)
+        second = self.coalescer.request('GET', self.uri)
+        self.agent.requests[0][2].callback(make_response(200, {}, body))
+        self.failureResultOf(first, ResponseTooLarge)
+        self.failureResultOf(second, ResponseTooLarge)
+
+    def test_large_single_request(self):
+        body = 'x' * (MAX_BODY_BYTES + 1)
+        finished = self.coalescer.request('GET', self.uri)
+        self.agent.requests[0][2].callback(make_response(200, {}, body))
+        response = self.successResultOf(finished)
+        self.assertEqual(
+            self.successResultOf(read_body(response, max_bytes=None)), body)
+
+    def test_cancel(self):
+        first = self.coalescer.request('GET', self.uri)
+        second = self.coalescer.request('GET', self.uri)
+        first.cancel()
+        self.failureResultOf(first, CancelledError)
+        self.assertEqual(self.agent.cancelled, [])
+        self.agent.requests[0][2].callback(make_response(200, {}, 'foo'))
+        response = self.successResultOf(second)
+        self.assertEqual(self.successResultOf(readBody(response)), 'foo')
+
+    def test_cancel_all(self):
+        first = self.coalescer.request('GET', self.uri)
+        second = self.coalescer.request('GET', self.uri)
+        first.cancel()
+        second.cancel()
+        self.failureResultOf(first, CancelledError)
+        self.failureResultOf(second, CancelledError)
+        self.assertEqual(self.agent.cancelled, [self.uri])
+        self.assertEqual(self.coalescer.statistics()['in_flight'], 0)
+        self.coalescer.request('GET', self.uri)
+        self.assertEqual(len(self.agent.requests), 2)
+
+    def test_distinct(self):
+        self.coalescer.request('GET', self.uri)
+        self.coalescer.request('HEAD', self.uri)
+        self.coalescer.request('GET', self.uri + 'foo')
+        self.coalescer.request('GET', self.uri,
+                               Headers({'accept': ['text/html']}))
+        self.coalescer.request('POST', self.uri)
+        self.coalescer.request('POST', self.uri)
+        self.assertEqual(len(self.agent.requests), 6)
+
+    def test_failure(self):
+        first = self.coalescer.request('GET', self.uri)
+        second = self.coalescer.request('GET', self.uri)
+        self.agent.requests[0][2].errback(ValueError())
+        self.failureResultOf(first, ValueError)
+        self.failureResultOf(second, ValueError)
+        self.assertEqual(self.coalescer.statistics()['in_flight'], 0)
+
+
+class AgentStackTestCase(TestCase):
+    uri = 'http://www.example.com/'
+
+    def setUp(self):
+        self.agent = DeferredAgent()
+        self.stack = IdentifyingAgent(CachingAgent(CoalescingAgent(
+            self.agent)))
+
+    def test_cancel(self):
+        finished = self.stack.request('GET', self.uri)
+        finished.cancel()
+        self.failureResultOf(finished, CancelledError)
+        self.assertEqual(self.agent.cancelled, [self.uri])
+
+
+class TimeoutEndpointFactoryTestCase(TestCase):
+    def setUp(self):
+        self.timeouts = HostTimeouts(Timeouts(5, None, None))
+        self.timeouts.hosts['slow.example.com'] = Timeouts(20, None, None)
+        self.factory = TimeoutEndpointFactory(Clock(), self.timeouts)
+
+    def endpoint(self, uri):
+        return self.factory.endpointForURI(URI.fromBytes(uri))
+
+    def test_http(self):
+        endpoint = self.endpoint('http://www.example.com/')
+        self.assertIsInstance(endpoint, HostnameEndpoint)
+        self.assertEqual(endpoint._timeout, 5)
+        self.assertEqual(self.endpoint('http://slow.example.com/')._timeout,
+                         20)
+
+    def test_https(self):
+        endpoint = self.endpoint('https://www.example.com/')
+        self.assertNotIsInstance(endpoint, HostnameEndpoint)
+        self.assertIsInstance(endpoint._wrappedEndpoint, HostnameEndpoint)
+
+    def test_unsupported_scheme(self):
+        self.assertRaises(SchemeNotSupported,
+                          self.endpoint, 'ftp://www.example.com/')
+
+
+class TimeoutAgentTestCase(TestCase):
+    uri = 'http://www.example.com/'
+
+    def setUp(self):
+        self.clock = Clock()
+        self.agent = DeferredAgent()
+        self.timeouts = HostTimeouts(Timeouts(None, 10, 30))
+        self.timeout_agent = TimeoutAgent(self.agent, self.timeouts,
+                                          reactor=self.clock)
+
+    def test_first_byte(self):
+        finished = self.timeout_agent.request('GET', self.uri)
+        self.clock.advance(10)
+        self.failureResultOf(finished, TimeoutError)
+        self.assertEqual(self.timeout_agent.statistics()['timed_out'], 1)
+
+    def test_host_override(self):
+        self.timeouts.hosts['www.example.com'] = Timeouts(None, 20, 30)
+        finished = self.timeout_agent.request('GET', self.uri)
+        self.clock.advance(10)
+        self.assertNoResult(finished)
+        self.clock.advance(10)
+        self.failureResultOf(finished, TimeoutError)
+
+    def test_total(self):
+        finished = self.timeout_agent.request('GET', self.uri)
+        self.clock.advance(5)
+        original = Response(('HTTP', 1, 1), 200, 'OK', Headers(),
+                            StringTransport())
+        self.agent.requests[0][2].callback(original)
+        body = readBody(self.successResultOf(finished))
+        original._bodyDataReceived('foo')
+        self.clock.advance(25)
+        self.assertEqual(original._transport.producerState, 'stopped')
+        original._bodyDataFinished(Failure(ConnectionLost()))
+        self.failureResultOf(body, TimeoutError)
+        self.assertEqual(self.timeout_agent.statistics()['timed_out'], 1)
+
+    def test_total_finished(self):
+        finished = self.timeout_agent.request('GET', self.uri)
+        self.agent.requests[0][2].callback(make_response(200, {}, 'foo'))
+        body = readBody(self.successResultOf(finished))
+        self.assertEqual(self.successResultOf(body), 'foo')
+        self.assertFalse(self.clock.getDelayedCalls())
+
+
+class CircuitBreakerAgentTestCase(TestCase):
+    uri = 'http://www.example.com/'
+
+    def setUp(self):
+        self.clock = Clock()
+        self.agent = DeferredAgent()
+        self.breaker_agent = CircuitBreakerAgent(self.agent,
+                                                 reactor=self.clock)
+        self.breaker_agent.failure_threshold = 2
+
+    def request(self):
+        return self.breaker_agent.request('GET', self.uri)
+
+    def fail_request(self):
+        finished = self.request()
+        self.agent.requests[-1][2].errback(TimeoutError())
+        self.failureResultOf(finished, TimeoutError)
+
+    def assert_state(self, state):
+        hosts = self.breaker_agent.statistics()['hosts']
+        self.assertEqual(hosts['www.example.com']['state'], state)
+
+    def test_open(self):
+        self.fail_request()
+        self.assert_state('closed')
+        self.fail_request()
+        self.assert_state('open')
+        failure = self.failureResultOf(self.request(), CircuitOpenError)
+        self.assertIsInstance(failure.value, UserVisibleError)
+        self.assertEqual(len(self.agent.requests), 2)
+        self.assertEqual(self.breaker_agent.statistics()['rejected'], 1)
+
+    def test_server_errors(self):
+        for _ in xrange(2):
+            finished = self.request()
+            self.agent.requests[-1][2].callback(make_response(503, {}, ''))
+            self.successResultOf(finished)
+        self.assert_state('open')
+
+    def test_success_resets(self):
+        self.fail_request()
+        finished = self.request()
+        self.agent.requests[-1][2].callback(make_response(200, {}, ''))
+        self.successResultOf(finished)
+        self.fail_request()
+        self.assert_state('closed')
+
+    def test_half_open(self):
+        self.fail_request()
+        self.fail_request()
+        self.clock.advance(self.breaker_agent.cooldown)
+        probe = self.request()
+        self.assert_state('half-open')
+        self.failureResultOf(self.request(), CircuitOpenError)
+        self.agent.requests[-1][2].callback(make_response(200, {}, ''))
+        self.successResultOf(probe)
+        self.assert_state('closed')
+        self.fail_request()
+        self.assert_state('closed')
+
+    def test_failed_probe(self):
+        self.fail_request()
+        self.fail_request()
+        self.clock.advance(self.breaker_agent.cooldown)
+        self.fail_request()
+        self.assert_state('open')
+        self.failureResultOf(self.request(), CircuitOpenError)
+
+    def test_cancelled(self):
+        for _ in xrange(2):
+            finished = self.request()
+            finished.cancel()
+            self.failureResultOf(finished, CancelledError)
+        finished = self.request()
+        self.agent.requests[-1][2].errback(
+            ResponseNeverReceived([Failure(CancelledError())]))
+        self.failureResultOf(finished, ResponseNeverReceived)
+        self.assert_state('closed')
+        self.assertEqual(
+            self.breaker_agent.statistics()['hosts']['www.example.com']
+            ['failures'], 0)
+
+    def test_cancelled_probe(self):
+        self.fail_request()
+        self.fail_request()
+        self.clock.advance(self.breaker_agent.cooldown)
+        probe = self.request()
+        probe.cancel()
+        self.failureResultOf(probe, CancelledError)
+        self.assert_state('open')
+        self.request()
+        self.assert_state('half-open')
@@ -4,20 +4,97 @@
 
 from __future__ import unicode_literals
 
-from bs4 import BeautifulSoup, NavigableString, Tag
+import re
+
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer, Tag
+try:
+    import lxml
+except ImportError:
+    lxml = None
 
 
 #: The default parser to use for BeautifulSoup.
 DEFAULT_BS4_PARSER = 'html.parser'
 
+#: The fastest parser available to BeautifulSoup, which is lxml if it is
+#: installed, and `DEFAULT_BS4_PARSER` otherwise.
+FAST_BS4_PARSER = DEFAULT_BS4_PARSER if lxml is None else 'lxml'
+
+#: A regex matching the simple CSS selectors accepted by `strainer`.
+SELECTOR_RE = re.compile(r'^([\w-]+|\*)?(?:\.([\w-]+)|#([\w-]+))?$')
+
+
+def strainer(selectors):
+    """Return a `SoupStrainer` matching the elements described by the
+    comma-separated CSS *selectors*, each of which is a tag name, a
+    class (``.name``), an ID (``#name``), or a tag name followed by a
+    class or ID, such as ``table.animelist``."""
+    matchers = []
+    for selector in selectors.split(','):
+        match = SELECTOR_RE.match(selector.strip())
+        if not match or not any(match.groups()):
+            raise ValueError('unsupported selector: {!r}'.format(selector))
+        matchers.append(match.groups())
 
-def parse(markup):
+    def matches(name, attrs):
+        # While parsing, Beautiful Soup hands us the raw attribute
+        # dictionary; afterwards, the class is split into a list.
+        attrs = attrs or {}
+        classes = attrs.get('class') or []
+        if not isinstance(classes, list):
+            classes = classes.split()
+        return any((tag in (None, '*', name) and
+                    (html_class is None or html_class in classes) and
+                    (html_id is None or attrs.get('id') == html_id))
+                   for tag, html_class, html_id in matchers)
+    return SoupStrainer(matches)
+
+
+def parse(markup, only=None, parser=None):
     """Return a `BeautifulSoup` object from the given markup.
 
-    This is a convenience method that additionally adds a default parser
-    argument, to avoid warnings.
+    If *only* is given, only the elements it matches and their contents
+    are included in the tree, which is much faster than building the
+    full tree for a large document.  It may be either a `SoupStrainer`
+    or a string of CSS selectors as accepted by `strainer`.
+
+    *parser* is the name of the Beautiful Soup tree builder to use,
+    defaulting to `DEFAULT_BS4_PARSER`.  Pass `FAST_BS4_PARSER` to use
+    the fastest one available.
     """
-    return BeautifulSoup(markup, DEFAULT_BS4_PARSER)
+    if isinstance(only, basestring):
+        only = strainer(only)
+    return BeautifulSoup(markup, parser or DEFAULT_BS4_PARSER,
+                         parse_only=only)
+
+
+#: Formatting codes added around the contents of elements by `textify`,
+#: as (opening, closing) pairs.
+ELEMENT_FORMATTING = {
+    'b': ('\x02', '\x02'), 'strong': ('\x02', '\x02'),
+    'i': ('\x16', '\x16'), 'u': ('\x16', '\x16'), 'em': ('\x16', '\x16'),
+    'cite': ('\x16', '\x16'), 'var': ('\x16', '\x16'),
+    'sup': ('^', ''), 'sub': ('_', '')}
+
+
+def _formatted_pieces(soup):
+    """Yield the strings and formatting codes making up the formatted
+    text of *soup*, in document order."""
+    stack = [soup]
+    pop, push, extend = stack.pop, stack.append, stack.extend
+    while stack:
+        node = pop()
+        if isinstance(node, NavigableString):
+            yield node
+        elif isinstance(node, tuple):  # closing formatting code
+            yield node[0]
+        else:
+            formatting = ELEMENT_FORMATTING.get(node.name)
+            if formatting is not None:
+                yield formatting[0]
+                if formatting[1]:
+                    push(formatting[1:])
+            extend(reversed(node.contents))
 
 
 def textify(html, format_output=True):
@@ -29,30 +106,29 @@ def textify(html, format_output=True):
         soup = html
     else:
         soup = parse(html)
-
-    def descend(soup):
-        if not format_output:
-            return u''.join(soup.strings)
-        # Grab the node's tag name, and add formatting if necessary.
-        if soup.name in (u'b', u'strong'):
-            fmt = u'\x02{0}\x02'
-        elif soup.name in (u'i', u'u', u'em', u'cite', u'var'):
-            fmt = u'\x16{0}\x16'
-        elif soup.name == u'sup':
-            fmt = u'^{0}'
-        elif soup.name == u'sub':
-            fmt = u'_{0}'
-        else:
-            fmt = u'{0}'
-        # Recurse into the node's contents.
-        text = u''
-        for k in soup.children:
-            if isinstance(k, NavigableString):
-                text += unicode(k)
-            else:  # is another soup element
-                text += descend(k)
-        return fmt.format(text)
-
-    # Don't strip whitespace until the very end, in order to avoid
-    # misparsing constructs like <span>hello<b> world</b></span>.
-    return u' '.join(descend(soup).split()).strip()
+    if format_output:
+        pieces = _formatted_pieces(soup)
+    else:
+        pieces = soup.strings
+    # Collapse runs of whitespace to single spaces as we go, dropping
+    # them entirely at the start and end.  Whitespace is tracked across
+    # pieces, in order to avoid misparsing constructs like
+    # <span>hello<b> world</b></span>.
+    text = []
+    space = False
+    for piece in pieces:
+        if not piece:
+            continue
+        words = piece.split()
+        if not words:
+            space = space or bool(text)
+            continue
+        if piece[0].isspace() and text:
+            space = True
+        for word in words:
+            if space:
+                text.append(' ')
+            text.append(word)
+            space = True
+        space = piece[-1].isspace()
+    return ''.join(text)
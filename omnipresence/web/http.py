@@ -2,17 +2,36 @@
 """Wrappers for Twisted's HTTP request machinery."""
 
 
+from collections import OrderedDict, namedtuple
+import errno
+import hashlib
 import json
+import os
+import re
 
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred
-from twisted.web.iweb import IAgent
-from twisted.web.client import (Agent, ContentDecoderAgent, RedirectAgent,
-                                GzipDecoder, _ReadBodyProtocol)
+from twisted.internet.defer import (CancelledError, Deferred, fail,
+                                    inlineCallbacks, returnValue, succeed)
+from twisted.internet.endpoints import HostnameEndpoint, wrapClientTLS
+from twisted.internet.error import ConnectingCancelledError, TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.python.components import proxyForInterface
+from twisted.python.failure import Failure
+from twisted.web.iweb import (IAgent, IAgentEndpointFactory, IClientRequest,
+                              IResponse, UNKNOWN_LENGTH)
+from twisted.web.client import (Agent, BrowserLikePolicyForHTTPS,
+                                ContentDecoderAgent, RedirectAgent,
+                                GzipDecoder, HTTPConnectionPool,
+                                RequestTransmissionFailed, ResponseDone,
+                                ResponseFailed, URI, _ReadBodyProtocol)
+from twisted.web.error import SchemeNotSupported
+from twisted.web.http import stringToDatetime
+from twisted.web._newclient import TransportProxyProducer
 from twisted.web.http_headers import Headers
 from zope.interface import implementer
 
 from .. import __version__, __source__
+from ..plugin import UserVisibleError
 
 
 @implementer(IAgent)
@@ -37,30 +56,1125 @@ class IdentifyingAgent(object):
         return self.agent.request(method, uri, headers, bodyProducer)
 
 
+class ConnectionPool(HTTPConnectionPool):
+    """An `HTTPConnectionPool` that also limits the total number of
+    idle connections kept open across all hosts, and keeps statistics
+    on how often connections are reused."""
+
+    # This hooks into private `HTTPConnectionPool` methods and the
+    # ``_connections`` and ``_timeouts`` attributes, as implemented in
+    # Twisted 16.6.  Check them again when upgrading Twisted.
+
+    #: The maximum number of idle connections kept open to each host.
+    maxPersistentPerHost = 4
+
+    #: The maximum number of idle connections kept open to all hosts.
+    #: When this is exceeded, the connection idle the longest is closed.
+    maxPersistent = 32
+
+    #: The number of seconds an idle connection is kept open.
+    cachedConnectionTimeout = 90
+
+    def __init__(self, reactor, persistent=True):
+        super(ConnectionPool, self).__init__(reactor, persistent)
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def getConnection(self, key, endpoint):
+        created = self.created
+        d = super(ConnectionPool, self).getConnection(key, endpoint)
+        if self.created == created:
+            self.reused += 1
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self.created += 1
+        return super(ConnectionPool, self)._newConnection(key, endpoint)
+
+    def _removeConnection(self, key, connection):
+        # This is only called when an idle connection times out.  The
+        # server may already have closed it, in which case it isn't
+        # counted.
+        if connection.state == 'QUIESCENT':
+            self.expired += 1
+        super(ConnectionPool, self)._removeConnection(key, connection)
+
+    def _putConnection(self, key, connection):
+        if (connection.state == 'QUIESCENT' and
+                len(self._connections.get(key, ())) >=
+                self.maxPersistentPerHost):
+            self.evicted += 1
+        super(ConnectionPool, self)._putConnection(key, connection)
+        while len(self._timeouts) > self.maxPersistent:
+            # The connection that will time out first is the one that
+            # has been idle the longest.
+            oldest = min(self._timeouts,
+                         key=lambda c: self._timeouts[c].getTime())
+            for connections in self._connections.itervalues():
+                if oldest in connections:
+                    connections.remove(oldest)
+                    break
+            self._timeouts.pop(oldest).cancel()
+            oldest.transport.loseConnection()
+            self.evicted += 1
+
+    def statistics(self):
+        """Return a dictionary of statistics about this pool's use:
+
+        * ``created``, the number of new connections opened.
+        * ``reused``, the number of requests sent over an idle
+          connection instead of a new one.
+        * ``evicted``, the number of idle connections closed to stay
+          within the pool's limits.
+        * ``expired``, the number of idle connections closed after
+          `cachedConnectionTimeout` seconds.
+        * ``idle``, the number of idle connections currently open.
+        * ``hosts``, the number of hosts with idle connections.
+        """
+        return {'created': self.created,
+                'reused': self.reused,
+                'evicted': self.evicted,
+                'expired': self.expired,
+                'idle': len(self._timeouts),
+                'hosts': sum(1 for connections
+                             in self._connections.itervalues()
+                             if connections)}
+
+
+#
+# Response caching
+#
+
+def _cache_control(headers):
+    """Return a dictionary of the ``Cache-Control`` directives in the
+    given `Headers` object, mapping names to values or `None`."""
+    directives = {}
+    for value in headers.getRawHeaders('cache-control', []):
+        for directive in value.split(','):
+            name, _, argument = directive.partition('=')
+            name = name.strip().lower()
+            if name:
+                directives[name] = argument.strip().strip('"') or None
+    return directives
+
+
+def _http_date(headers, name):
+    """Return the value of the date header *name* in *headers* as a
+    timestamp, or `None` if it is missing or invalid."""
+    value = headers.getRawHeaders(name, [None])[-1]
+    if value is None:
+        return None
+    try:
+        return stringToDatetime(value)
+    except (ValueError, IndexError, KeyError):
+        return None
+
+
+@implementer(IClientRequest)
+class CachedRequest(namedtuple('CachedRequest',
+                               ['method', 'absoluteURI', 'headers'])):
+    """A stand-in for the request that produced a cached response."""
+
+
+@implementer(IResponse)
+class CachedResponse(object):
+    """An `IResponse` that replays the body of a `CacheEntry`."""
+
+    version = ('HTTP', 1, 1)
+
+    def __init__(self, entry, method='GET'):
+        self.code = entry.code
+        self.phrase = entry.phrase
+        self.headers = Headers(dict(entry.headers))
+        self.length = len(entry.body)
+        self.request = CachedRequest(method, entry.uri, Headers())
+        self.previousResponse = None
+        self.body = entry.body
+
+    def deliverBody(self, protocol):
+        protocol.makeConnection(TransportProxyProducer(None))
+        if self.body:
+            protocol.dataReceived(self.body)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+    def setPreviousResponse(self, response):
+        self.previousResponse = response
+
+
+class CacheEntry(object):
+    """A response stored by a `CachingAgent`, fresh until the timestamp
+    *expires*."""
+
+    def __init__(self, code, phrase, headers, body, uri, expires):
+        self.code = code
+        self.phrase = phrase
+        #: A list of ``(name, values)`` header pairs.
+        self.headers = headers
+        self.body = body
+        #: The URI the response was actually retrieved from, after any
+        #: redirects.
+        self.uri = uri
+        self.expires = expires
+
+    @property
+    def size(self):
+        """The approximate number of bytes taken up by this entry."""
+        return len(self.body) + len(self.uri) + sum(
+            len(name) + sum(len(value) for value in values)
+            for name, values in self.headers)
+
+    def header(self, name):
+        """Return the last value of the header *name*, or `None`."""
+        for header_name, values in self.headers:
+            if header_name.lower() == name and values:
+                return values[-1]
+        return None
+
+    def add_validators(self, headers):
+        """Add conditional request headers for this entry to the
+        `Headers` object *headers*.  Return `True` if any were added,
+        or `False` if this entry can't be revalidated."""
+        etag = self.header('etag')
+        last_modified = self.header('last-modified')
+        if etag is not None:
+            headers.setRawHeaders('if-none-match', [etag])
+        if last_modified is not None:
+            headers.setRawHeaders('if-modified-since', [last_modified])
+        return etag is not None or last_modified is not None
+
+    def response(self, method='GET'):
+        """Return a new `CachedResponse` replaying this entry."""
+        return CachedResponse(self, method)
+
+    @classmethod
+    def from_body(cls, response, uri, body, expires=None):
+        """Return an entry for the Twisted Web *response* to a request
+        for *uri*, whose full body is *body*."""
+        return cls(response.code, response.phrase,
+                   list(response.headers.getAllRawHeaders()), body,
+                   getattr(response.request, 'absoluteURI', None) or uri,
+                   expires)
+
+    @classmethod
+    @inlineCallbacks
+    def from_response(cls, response, uri, expires=None, max_bytes=None):
+        """Return a `Deferred` yielding an entry containing the full
+        body of the Twisted Web *response* to a request for *uri*, or
+        failing with `ResponseTooLarge` if it is longer than *max_bytes*
+        bytes."""
+        body = yield read_body(response, max_bytes=max_bytes)
+        returnValue(cls.from_body(response, uri, body, expires))
+
+    def to_bytes(self):
+        """Serialize this entry to a byte string."""
+        metadata = json.dumps({
+            'code': self.code, 'phrase': self.phrase,
+            'headers': self.headers, 'uri': self.uri,
+            'expires': self.expires}, encoding='latin-1')
+        return metadata + '\n' + self.body
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserialize an entry produced by `to_bytes`."""
+        metadata, _, body = data.partition('\n')
+        metadata = json.loads(metadata, encoding='latin-1')
+        headers = [(name.encode('latin-1'),
+                    [value.encode('latin-1') for value in values])
+                   for name, values in metadata['headers']]
+        return cls(metadata['code'], metadata['phrase'].encode('latin-1'),
+                   headers, body, metadata['uri'].encode('latin-1'),
+                   metadata['expires'])
+
+
+class CachingProtocol(Protocol):
+    """A protocol wrapper that forwards response body data to
+    *protocol*, and calls *store* with a copy of the body once it has
+    arrived in full, unless it is longer than *max_bytes* bytes."""
+
+    def __init__(self, protocol, max_bytes, store):
+        self.protocol = protocol
+        self.max_bytes = max_bytes
+        self.store = store
+        #: The pieces of the body received so far, or `None` once they
+        #: are too long to keep.
+        self.body = []
+        self.received = 0
+
+    def makeConnection(self, transport):
+        Protocol.makeConnection(self, transport)
+        self.protocol.makeConnection(transport)
+
+    def dataReceived(self, data):
+        if self.body is not None:
+            self.received += len(data)
+            if self.received > self.max_bytes:
+                self.body = None
+            else:
+                self.body.append(data)
+        self.protocol.dataReceived(data)
+
+    def connectionLost(self, reason):
+        if self.body is not None and reason.check(ResponseDone):
+            self.store(''.join(self.body))
+        self.protocol.connectionLost(reason)
+
+
+class CachingResponse(proxyForInterface(IResponse)):
+    """A response wrapper that delivers its body as it arrives, and
+    calls *store* with a copy of it if it is no longer than *max_bytes*
+    bytes."""
+
+    def __init__(self, original, max_bytes, store):
+        super(CachingResponse, self).__init__(original)
+        self.max_bytes = max_bytes
+        self.store = store
+
+    def deliverBody(self, protocol):
+        self.original.deliverBody(
+            CachingProtocol(protocol, self.max_bytes, self.store))
+
+
+class DiskStore(object):
+    """A persistent store for `CachingAgent` entries, kept as one file
+    per entry in the directory *path*."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        """Return the entry stored under *key*, or `None`."""
+        try:
+            with open(self._filename(key), 'rb') as entry_file:
+                return CacheEntry.from_bytes(entry_file.read())
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def put(self, key, entry):
+        """Store *entry* under *key*."""
+        filename = self._filename(key)
+        with open(filename + '.tmp', 'wb') as entry_file:
+            entry_file.write(entry.to_bytes())
+        os.rename(filename + '.tmp', filename)
+
+    def delete(self, key):
+        """Remove any entry stored under *key*."""
+        try:
+            os.remove(self._filename(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+@implementer(IAgent)
+class CachingAgent(object):
+    """An `Agent` wrapper that caches the responses to ``GET`` requests
+    in memory, and in an optional persistent *store* such as a
+    `DiskStore`.
+
+    Responses are kept for as long as their ``Cache-Control`` or
+    ``Expires`` headers allow, and revalidated with conditional requests
+    once stale if they carry an ``ETag`` or ``Last-Modified`` header.
+    Responses are cached separately for each set of request headers,
+    and requests with an ``Authorization`` header are never cached.
+    Response bodies are passed on to the caller as they arrive, and
+    only stored once they have been read in full."""
+
+    #: The maximum number of bytes of responses to keep in memory.
+    #: When this is exceeded, the least recently used entries are
+    #: dropped from memory, but not from the persistent store.
+    max_bytes = 4 * 1024 * 1024
+
+    #: The maximum size in bytes of a single cached response.
+    max_entry_bytes = 512 * 1024
+
+    def __init__(self, agent, reactor=reactor, store=None):
+        self.agent = agent
+        self.reactor = reactor
+        self.store = store
+        #: A dictionary mapping URI prefixes to the number of seconds to
+        #: cache responses that don't specify their own lifetimes.
+        #: Plugins add entries for `default_cache` with
+        #: `cache_by_default`.
+        self.default_ttls = {}
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evicted = 0
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        if (method != 'GET' or bodyProducer is not None or
+                (headers is not None and headers.hasHeader('authorization'))):
+            return self.agent.request(method, uri, headers, bodyProducer)
+        return self._request(uri, headers)
+
+    @staticmethod
+    def _key(uri, headers):
+        """Return the key for the cached response to a request for *uri*
+        with the given *headers*."""
+        if headers is None:
+            return uri
+        return '\n'.join([uri] + sorted(
+            '{}: {}'.format(name.lower(), value)
+            for name, values in headers.getAllRawHeaders()
+            for value in values))
+
+    def _request(self, uri, headers):
+        key = self._key(uri, headers)
+        now = self.reactor.seconds()
+        entry = self._get(key)
+        if entry is not None and entry.expires > now:
+            self.hits += 1
+            return succeed(entry.response())
+        headers = Headers() if headers is None else headers.copy()
+        if entry is not None and not entry.add_validators(headers):
+            entry = None
+        # Return the wrapped agent's own `Deferred`, so that cancelling
+        # it cancels the request.
+        finished = self.agent.request('GET', uri, headers)
+        finished.addCallback(self._received, uri, key, entry, now)
+        return finished
+
+    def _received(self, response, uri, key, entry, now):
+        if entry is not None and response.code == 304:
+            self.revalidated += 1
+            entry.expires = now + (self._lifetime(uri, response.headers) or 0)
+            self._put(key, entry)
+            return entry.response()
+        self.misses += 1
+        self._delete(key)
+        lifetime = None
+        if response.code == 200 and (response.length is UNKNOWN_LENGTH or
+                                     response.length <= self.max_entry_bytes):
+            lifetime = self._lifetime(uri, response.headers)
+        if lifetime is None:
+            return response
+        expires = now + lifetime
+        return CachingResponse(
+            response, self.max_entry_bytes,
+            lambda body: self._store(
+                key, CacheEntry.from_body(response, uri, body, expires)))
+
+    def _lifetime(self, uri, headers):
+        """Return the number of seconds a response to *uri* with the
+        given *headers* stays fresh, or `None` if it shouldn't be
+        cached at all.  Responses that are stale on arrival aren't
+        cached, even if they could be revalidated."""
+        directives = _cache_control(headers)
+        if 'no-store' in directives:
+            return None
+        if any(value.strip().lower() not in ('', 'accept-encoding')
+               for vary in headers.getRawHeaders('vary', [])
+               for value in vary.split(',')):
+            return None
+        lifetime = None
+        if 'no-cache' in directives:
+            lifetime = 0
+        elif 'max-age' in directives:
+            try:
+                lifetime = int(directives['max-age'])
+            except (TypeError, ValueError):
+                lifetime = 0
+            try:
+                lifetime -= int(headers.getRawHeaders('age', ['0'])[-1])
+            except ValueError:
+                pass
+        elif headers.hasHeader('expires'):
+            expires = _http_date(headers, 'expires')
+            date = _http_date(headers, 'date') or self.reactor.seconds()
+            lifetime = 0 if expires is None else expires - date
+        else:
+            prefixes = [prefix for prefix in self.default_ttls
+                        if uri.startswith(prefix)]
+            if prefixes:
+                lifetime = self.default_ttls[max(prefixes, key=len)]
+        return max(lifetime or 0, 0) or None
+
+    def _get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        elif self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None:
+                self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        self._forget(key)
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            self.evicted += 1
+
+    def _forget(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _store(self, key, entry):
+        if entry.size <= self.max_entry_bytes:
+            self._put(key, entry)
+
+    def _put(self, key, entry):
+        self._remember(key, entry)
+        if self.store is not None:
+            self.store.put(key, entry)
+
+    def _delete(self, key):
+        self._forget(key)
+        if self.store is not None:
+            self.store.delete(key)
+
+    def statistics(self):
+        """Return a dictionary of statistics about this cache's use:
+
+        * ``hits``, the number of requests answered from the cache.
+        * ``misses``, the number of requests that had to be fetched.
+        * ``revalidated``, the number of stale entries confirmed to be
+          current by a conditional request.
+        * ``evicted``, the number of entries dropped from memory to stay
+          within `max_bytes`.
+        * ``entries``, the number of entries currently in memory.
+        * ``bytes``, the approximate size of those entries.
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated,
+                'evicted': self.evicted,
+                'entries': len(self.entries),
+                'bytes': self.size}
+
+
+#
+# Request coalescing
+#
+
+@implementer(IAgent)
+class CoalescingAgent(object):
+    """An `Agent` wrapper that lets concurrent identical ``GET`` and
+    ``HEAD`` requests share a single fetch.
+
+    Requests are identical if they have the same method, URI, and
+    headers.  If no identical request arrives before the response
+    headers do, the response is passed on untouched.  Otherwise, the
+    shared response body is read in full, then replayed to each caller;
+    if it is longer than `MAX_BODY_BYTES`, every caller fails with
+    `ResponseTooLarge` instead.  Cancelling a request only cancels the
+    shared fetch once every caller waiting on it has cancelled."""
+
+    def __init__(self, agent):
+        self.agent = agent
+        #: A dictionary mapping request keys to ``(fetch, waiters)``
+        #: pairs, where *fetch* is the `Deferred` for the request in
+        #: progress and *waiters* is a list of `Deferred` objects
+        #: waiting on it.
+        self.in_flight = {}
+        self.fetches = 0
+        self.coalesced = 0
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        if method not in ('GET', 'HEAD') or bodyProducer is not None:
+            return self.agent.request(method, uri, headers, bodyProducer)
+        key = (method, uri, tuple(sorted(
+            (name.lower(), tuple(values))
+            for name, values in (headers or Headers()).getAllRawHeaders())))
+        shared = self.in_flight.get(key)
+        waiters = [] if shared is None else shared[1]
+        finished = Deferred(lambda d: self._cancel(d, key, waiters))
+        waiters.append(finished)
+        if shared is not None:
+            self.coalesced += 1
+            return finished
+        self.fetches += 1
+        fetch = self.agent.request(method, uri, headers)
+        if not fetch.called:
+            self.in_flight[key] = (fetch, waiters)
+        fetch.addBoth(self._received, key, waiters, method, uri)
+        return finished
+
+    def _cancel(self, waiter, key, waiters):
+        waiters.remove(waiter)
+        shared = self.in_flight.get(key)
+        if not waiters and shared is not None and shared[1] is waiters:
+            shared[0].cancel()
+
+    def _received(self, result, key, waiters, method, uri):
+        self.in_flight.pop(key, None)
+        if len(waiters) == 1:
+            waiters.pop().callback(result)
+            return
+        if isinstance(result, Failure):
+            self._fan_out(result, waiters, method)
+            return
+        # Every caller needs to read the body, so keep a copy of it.
+        buffered = CacheEntry.from_response(result, uri,
+                                            max_bytes=MAX_BODY_BYTES)
+        buffered.addBoth(self._fan_out, waiters, method)
+
+    @staticmethod
+    def _fan_out(result, waiters, method):
+        # Callers may cancel their own requests while others are being
+        # answered, so take them off the list one at a time.
+        while waiters:
+            waiter = waiters.pop(0)
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result.response(method))
+
+    def statistics(self):
+        """Return a dictionary of statistics about this agent's use:
+
+        * ``fetches``, the number of requests actually sent.
+        * ``coalesced``, the number of requests that shared a fetch
+          already in progress.
+        * ``in_flight``, the number of fetches currently in progress.
+        """
+        return {'fetches': self.fetches,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.in_flight)}
+
+
+#
+# Timeouts and circuit breakers
+#
+
+class Timeouts(namedtuple('Timeouts', ['connect', 'first_byte', 'total'])):
+    """The number of seconds to allow an HTTP request to connect to its
+    server, to receive its response headers, and to receive its entire
+    response including the body.  `None` disables a timeout."""
+
+
+class HostTimeouts(object):
+    """A set of `Timeouts` that can be overridden for specific hosts."""
+
+    def __init__(self, default=Timeouts(connect=10, first_byte=30, total=60)):
+        #: The `Timeouts` for hosts without an override.
+        self.default = default
+        #: A dictionary mapping hostnames to `Timeouts` overrides.
+        self.hosts = {}
+
+    def __getitem__(self, host):
+        return self.hosts.get(host, self.default)
+
+
+@implementer(IAgentEndpointFactory)
+class TimeoutEndpointFactory(object):
+    """An endpoint factory for `Agent.usingEndpointFactory` that applies
+    the connect timeouts given in the `HostTimeouts` *timeouts*."""
+
+    def __init__(self, reactor, timeouts):
+        self.reactor = reactor
+        self.timeouts = timeouts
+        self.policy = BrowserLikePolicyForHTTPS()
+
+    def endpointForURI(self, uri):
+        kwargs = {}
+        timeout = self.timeouts[uri.host].connect
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        endpoint = HostnameEndpoint(self.reactor, uri.host, uri.port,
+                                    **kwargs)
+        if uri.scheme == 'http':
+            return endpoint
+        if uri.scheme == 'https':
+            return wrapClientTLS(
+                self.policy.creatorForNetloc(uri.host, uri.port), endpoint)
+        raise SchemeNotSupported('Unsupported scheme: {!r}'
+                                 .format(uri.scheme))
+
+
+class DeadlineProtocol(Protocol):
+    """A protocol wrapper that forwards response body data to
+    *protocol*, and stops the transfer if `expire` is called before it
+    is complete."""
+
+    def __init__(self, protocol, call):
+        self.protocol = protocol
+        self.call = call
+        self.expired = False
+        self.finished = False
+
+    def makeConnection(self, transport):
+        Protocol.makeConnection(self, transport)
+        self.protocol.makeConnection(transport)
+
+    def dataReceived(self, data):
+        self.protocol.dataReceived(data)
+
+    def connectionLost(self, reason=None):
+        self.finished = True
+        if self.call.active():
+            self.call.cancel()
+        if self.expired:
+            reason = Failure(TimeoutError(
+                string='response body took too long to arrive'))
+        self.protocol.connectionLost(reason)
+
+    def expire(self):
+        """Stop the transfer, failing it with a `TimeoutError`."""
+        self.expired = True
+        self.transport.stopProducing()
+
+
+class DeadlineResponse(proxyForInterface(IResponse)):
+    """A response wrapper that stops delivering its body once
+    *timeout* seconds have passed, calling *on_expire* if it does."""
+
+    def __init__(self, original, reactor, timeout, on_expire):
+        super(DeadlineResponse, self).__init__(original)
+        self.protocol = None
+        self.on_expire = on_expire
+        self.call = reactor.callLater(timeout, self._expire)
+
+    def deliverBody(self, protocol):
+        self.protocol = DeadlineProtocol(protocol, self.call)
+        self.original.deliverBody(self.protocol)
+        if not (self.call.active() or self.call.cancelled):
+            self._expire()
+
+    def _expire(self):
+        if self.protocol is not None and not self.protocol.finished:
+            self.on_expire()
+            self.protocol.expire()
+
+
+@implementer(IAgent)
+class TimeoutAgent(object):
+    """An `Agent` wrapper that fails requests with a `TimeoutError` if
+    they exceed the first-byte or total timeouts given for their host
+    in the `HostTimeouts` *timeouts*.
+
+    Connect timeouts must be handled by the wrapped agent, such as with
+    a `TimeoutEndpointFactory`."""
+
+    def __init__(self, agent, timeouts, reactor=reactor):
+        self.agent = agent
+        self.timeouts = timeouts
+        self.reactor = reactor
+        self.timed_out = 0
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        timeouts = self.timeouts[URI.fromBytes(uri).host]
+        started = self.reactor.seconds()
+        finished = self.agent.request(method, uri, headers, bodyProducer)
+        if timeouts.first_byte is not None:
+            finished.addTimeout(timeouts.first_byte, self.reactor,
+                                onTimeoutCancel=self._first_byte_timeout)
+            finished.addErrback(self._count_timeout)
+        if timeouts.total is not None:
+            finished.addCallback(self._limit_body,
+                                 started + timeouts.total)
+        return finished
+
+    @staticmethod
+    def _first_byte_timeout(result, timeout):
+        if isinstance(result, Failure) and result.check(CancelledError):
+            raise TimeoutError(
+                string='no response after {} seconds'.format(timeout))
+        return result
+
+    def _count_timeout(self, failure):
+        if failure.check(TimeoutError):
+            self.timed_out += 1
+        return failure
+
+    def _limit_body(self, response, deadline):
+        return DeadlineResponse(
+            response, self.reactor,
+            max(deadline - self.reactor.seconds(), 0),
+            on_expire=self._expired)
+
+    def _expired(self):
+        self.timed_out += 1
+
+    def statistics(self):
+        """Return a dictionary of statistics about this agent's use:
+
+        * ``timed_out``, the number of requests stopped by a timeout.
+        """
+        return {'timed_out': self.timed_out}
+
+
+def _cancelled(failure):
+    """Return `True` if *failure* was caused by the request being
+    cancelled, rather than by a problem with the server."""
+    if failure.check(CancelledError, ConnectingCancelledError):
+        return True
+    if failure.check(RequestTransmissionFailed, ResponseFailed):
+        return all(_cancelled(reason) for reason in failure.value.reasons)
+    return False
+
+
+class CircuitOpenError(UserVisibleError):
+    """Raised by `CircuitBreakerAgent` instead of sending a request to
+    a host that has recently been failing."""
+
+    def __init__(self, host):
+        super(CircuitOpenError, self).__init__(
+            u"{} isn't responding right now. Please try again later."
+            .format(host.decode('ascii', 'replace')))
+        self.host = host
+
+
+class CircuitBreaker(object):
+    """The failure state of a single host in a `CircuitBreakerAgent`.
+
+    A breaker starts out ``closed``, allowing requests through.  Once
+    opened by too many consecutive failures, it rejects requests until
+    its cooldown elapses, then becomes ``half-open`` and allows one
+    probe request to decide whether to close or open again."""
+
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = None
+
+
+@implementer(IAgent)
+class CircuitBreakerAgent(object):
+    """An `Agent` wrapper that stops sending requests to a host for
+    `cooldown` seconds after `failure_threshold` consecutive failures,
+    raising a `CircuitOpenError` instead.
+
+    Connection errors, timeouts, and server error (5xx) responses all
+    count as failures.  Requests cancelled by their callers don't."""
+
+    #: The number of consecutive failures that open a host's breaker.
+    failure_threshold = 5
+
+    #: The number of seconds to reject requests to a failing host.
+    cooldown = 60
+
+    def __init__(self, agent, reactor=reactor):
+        self.agent = agent
+        self.reactor = reactor
+        #: A dictionary mapping hostnames to `CircuitBreaker` objects.
+        self.breakers = {}
+        self.rejected = 0
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        host = URI.fromBytes(uri).host
+        breaker = self.breakers.setdefault(host, CircuitBreaker())
+        if breaker.state == 'open':
+            if self.reactor.seconds() - breaker.opened < self.cooldown:
+                self.rejected += 1
+                return fail(CircuitOpenError(host))
+            breaker.state = 'half-open'
+        elif breaker.state == 'half-open':
+            # A probe request is already in flight.
+            self.rejected += 1
+            return fail(CircuitOpenError(host))
+        finished = self.agent.request(method, uri, headers, bodyProducer)
+        finished.addCallbacks(self._succeeded, self._failed,
+                              callbackArgs=(breaker,),
+                              errbackArgs=(breaker,))
+        return finished
+
+    def _succeeded(self, response, breaker):
+        if response.code >= 500:
+            self._trip(breaker)
+        else:
+            breaker.state = 'closed'
+            breaker.failures = 0
+        return response
+
+    def _failed(self, failure, breaker):
+        if _cancelled(failure):
+            if breaker.state == 'half-open':
+                # Let the next request probe the host instead.
+                breaker.state = 'open'
+        else:
+            self._trip(breaker)
+        return failure
+
+    def _trip(self, breaker):
+        breaker.failures += 1
+        if (breaker.state == 'half-open' or
+                breaker.failures >= self.failure_threshold):
+            breaker.state = 'open'
+            breaker.opened = self.reactor.seconds()
+
+    def statistics(self):
+        """Return a dictionary of statistics about this agent's use:
+
+        * ``rejected``, the number of requests failed without being
+          sent because their host's breaker was open.
+        * ``hosts``, a dictionary mapping hostnames to dictionaries
+          giving the ``state`` of their breakers and the number of
+          consecutive ``failures`` seen.
+        """
+        return {'rejected': self.rejected,
+                'hosts': dict((host, {'state': breaker.state,
+                                      'failures': breaker.failures})
+                              for host, breaker in self.breakers.iteritems())}
+
+
+#: The `ConnectionPool` shared by requests made through `default_agent`.
+#: Its limits can be changed by setting the corresponding attributes.
+default_pool = ConnectionPool(reactor)
+
+#: The `HostTimeouts` applied to requests made through `default_agent`.
+default_timeouts = HostTimeouts()
+
+#: The `CircuitBreakerAgent` used by `default_agent`.
+default_breaker = CircuitBreakerAgent(TimeoutAgent(
+    Agent.usingEndpointFactory(
+        reactor, TimeoutEndpointFactory(reactor, default_timeouts),
+        pool=default_pool),
+    default_timeouts))
+
+#: The `CachingAgent` used by `default_agent`.
+#: Set its ``store`` attribute to a `DiskStore` to keep responses across
+#: restarts.
+default_cache = CachingAgent(CoalescingAgent(
+    ContentDecoderAgent(RedirectAgent(default_breaker),
+                        [('gzip', GzipDecoder)])))
+
 #: A Twisted Web `Agent` with reasonable settings for most requests.
 #: Use this if you need to make a request inside a plugin.
-default_agent = IdentifyingAgent(
-    ContentDecoderAgent(RedirectAgent(Agent(reactor)),
-                        [('gzip', GzipDecoder)]))
+default_agent = IdentifyingAgent(default_cache)
+
+
+def cache_by_default(prefix, ttl):
+    """Cache responses made through `default_agent` to URIs starting
+    with *prefix* for *ttl* seconds, unless they give their own
+    lifetimes.  Plugins for services that don't send caching headers
+    can call this when they are imported."""
+    default_cache.default_ttls[prefix] = ttl
 
 
 #
-# JSON response helpers
+# Response body helpers
 #
 
-class JSONBodyProtocol(_ReadBodyProtocol, object):
+#: The default maximum number of bytes accepted by `read_body` and
+#: `read_json_body`.
+MAX_BODY_BYTES = 2 * 1024 * 1024
+
+
+class ResponseTooLarge(UserVisibleError):
+    """Raised when a response body exceeds the size given to a reader
+    such as `read_body`."""
+
+    def __init__(self, max_bytes):
+        super(ResponseTooLarge, self).__init__(
+            u'The server sent more than {:,} bytes of data.'
+            .format(max_bytes))
+        self.max_bytes = max_bytes
+
+
+class LimitedBodyProtocol(_ReadBodyProtocol, object):
+    """A protocol that collects at most *max_bytes* bytes of data sent
+    to it, stopping the transfer and failing with `ResponseTooLarge`
+    if more arrive.  If *max_bytes* is `None`, any amount is accepted.
+    """
+
+    def __init__(self, status, message, deferred, max_bytes=MAX_BODY_BYTES):
+        super(LimitedBodyProtocol, self).__init__(status, message, deferred)
+        self.max_bytes = max_bytes
+        self.received = 0
+
+    def dataReceived(self, data):
+        if self.deferred.called:
+            return
+        self.received += len(data)
+        if self.max_bytes is not None and self.received > self.max_bytes:
+            self.abort(ResponseTooLarge(self.max_bytes))
+            return
+        self.consume(data)
+
+    def consume(self, data):
+        """Handle *data* that fits within the size limit."""
+        super(LimitedBodyProtocol, self).dataReceived(data)
+
+    def abort(self, error):
+        """Discard any buffered data, stop the transfer, and fail with
+        the exception *error*."""
+        self.dataBuffer = []
+        self.deferred.errback(error)
+        self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if not self.deferred.called:
+            super(LimitedBodyProtocol, self).connectionLost(reason)
+
+
+def read_body(response, max_bytes=MAX_BODY_BYTES):
+    """Return a `Deferred` yielding the body of the Twisted Web
+    *response*, or failing with `ResponseTooLarge` if it is longer than
+    *max_bytes* bytes.  Use this instead of `~twisted.web.client.
+    readBody` to avoid buffering arbitrarily large responses."""
+    finished = Deferred()
+    response.deliverBody(LimitedBodyProtocol(
+        response.code, response.phrase, finished, max_bytes))
+    return finished
+
+
+class IncrementalJSONDecoder(object):
+    """Decodes a JSON document fed to it in pieces.
+
+    Members of a top-level array or object are decoded as soon as they
+    have fully arrived, so that only the encoded form of the current
+    member is held in memory alongside the decoded objects."""
+
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        #: The next number of buffered bytes at which to try decoding
+        #: a member that was incomplete the last time around.
+        self.retry_length = 0
+        self.state = 'start'
+        self.result = None
+        self.key = None
+
+    def feed(self, data):
+        """Add *data* to the document."""
+        self.buffer += data
+        if len(self.buffer) >= self.retry_length:
+            self._decode(final=False)
+
+    def finish(self):
+        """Return the decoded document, or raise `ValueError` if it is
+        incomplete or invalid."""
+        self._decode(final=True)
+        if self.state != 'done':
+            raise ValueError('Unexpected end of JSON document')
+        return self.result
+
+    def _value(self, pos, final):
+        """Decode the value at *pos*, returning it and its end position,
+        or `None` if more data is needed."""
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, pos)
+        except ValueError:
+            if final:
+                raise
+            # Don't retry until the buffer has doubled, to avoid
+            # rescanning a large member every time a packet arrives.
+            self.retry_length = 2 * (len(self.buffer) - pos)
+            return None
+        self.retry_length = 0
+        if (not final and isinstance(value, (int, long, float)) and
+                self.buffer[end:end + 1] in ('', '.', 'e', 'E')):
+            # The number may continue in the next piece.
+            return None
+        return value, end
+
+    def _decode(self, final):
+        buf = self.buffer
+        pos = self._whitespace.match(buf).end()
+        while pos < len(buf):
+            char = buf[pos]
+            if self.state == 'start':
+                if char == '[':
+                    self.result, self.state = [], 'first'
+                    pos += 1
+                elif char == '{':
+                    self.result, self.state = {}, 'first'
+                    pos += 1
+                elif final:
+                    self.result, pos = self.decoder.raw_decode(buf, pos)
+                    self.state = 'done'
+                else:
+                    break
+            elif self.state == 'first' and char in ']}':
+                self._close(char)
+                pos += 1
+            elif self.state in ('first', 'member'):
+                decoded = self._value(pos, final)
+                if decoded is None:
+                    break
+                value, pos = decoded
+                if isinstance(self.result, list):
+                    self.result.append(value)
+                    self.state = 'separator'
+                elif isinstance(value, basestring):
+                    self.key, self.state = value, 'colon'
+                else:
+                    raise ValueError('Expected an object key')
+            elif self.state == 'colon':
+                if char != ':':
+                    raise ValueError('Expected a colon')
+                self.state = 'value'
+                pos += 1
+            elif self.state == 'value':
+                decoded = self._value(pos, final)
+                if decoded is None:
+                    break
+                self.result[self.key], pos = decoded
+                self.state = 'separator'
+            elif self.state == 'separator':
+                if char == ',':
+                    self.state = 'member'
+                else:
+                    self._close(char)
+                pos += 1
+            else:
+                raise ValueError('Extra data after JSON document')
+            pos = self._whitespace.match(buf, pos).end()
+        self.buffer = buf[pos:]
+
+    def _close(self, char):
+        if char != (']' if isinstance(self.result, list) else '}'):
+            raise ValueError('Unexpected character {!r}'.format(char))
+        self.state = 'done'
+
+
+class JSONBodyProtocol(LimitedBodyProtocol):
     """A protocol that returns a Python object deserialized from JSON
     data sent to it."""
 
-    def __init__(self, status, message, deferred):
-        super(JSONBodyProtocol, self).__init__(status, message, deferred)
+    def __init__(self, status, message, deferred, max_bytes=MAX_BODY_BYTES):
+        super(JSONBodyProtocol, self).__init__(
+            status, message, deferred, max_bytes)
         self.deferred.addCallback(json.loads)
 
 
-def read_json_body(response):
+class IncrementalJSONBodyProtocol(LimitedBodyProtocol):
+    """A protocol that decodes JSON data sent to it as it arrives,
+    using an `IncrementalJSONDecoder`."""
+
+    def __init__(self, status, message, deferred, max_bytes=MAX_BODY_BYTES):
+        super(IncrementalJSONBodyProtocol, self).__init__(
+            status, message, deferred, max_bytes)
+        self.decoder = IncrementalJSONDecoder()
+        self.deferred.addCallback(lambda _: self.decoder.finish())
+
+    def consume(self, data):
+        try:
+            self.decoder.feed(data)
+        except ValueError as e:
+            self.abort(e)
+
+
+def read_json_body(response, max_bytes=MAX_BODY_BYTES, incremental=False):
     """Return a `Deferred` yielding a Python object deserialized from
-    the Twisted Web *response* containing JSON data in its body."""
+    the Twisted Web *response* containing JSON data in its body.
+
+    As with `read_body`, the `Deferred` fails with `ResponseTooLarge`
+    if the body is longer than *max_bytes*.  If *incremental* is true,
+    the body is decoded as it arrives instead of all at once, which
+    saves memory on large responses."""
     finished = Deferred()
-    response.deliverBody(JSONBodyProtocol(
-        response.code, response.phrase, finished))
+    protocol_class = (IncrementalJSONBodyProtocol if incremental
+                      else JSONBodyProtocol)
+    response.deliverBody(protocol_class(
+        response.code, response.phrase, finished, max_bytes))
     return finished
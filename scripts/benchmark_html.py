@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Time HTML parsing on the pages recorded in the test cassettes."""
+
+
+from base64 import b64decode
+from glob import glob
+import gzip
+import json
+import os.path
+from StringIO import StringIO
+from timeit import repeat
+
+from omnipresence.web.html import DEFAULT_BS4_PARSER, FAST_BS4_PARSER, parse
+
+
+#: The parts of each plugin's pages that the plugin actually reads.
+TARGETS = {'anidb': 'table.animelist, div.anime_all',
+           'vndb': 'div.vnbrowse, div#maincontent',
+           'wwwjdic': 'pre'}
+
+CASSETTE_LIBRARY = os.path.join(
+    os.path.dirname(__file__),
+    '..', 'omnipresence', 'test', 'fixtures', 'cassettes')
+
+
+def response_bodies(plugin):
+    """Yield the decoded response bodies recorded for *plugin*."""
+    for path in sorted(glob(os.path.join(CASSETTE_LIBRARY, plugin, '*.json'))):
+        with open(path) as cassette_file:
+            cassette = json.load(cassette_file)
+        for interaction in cassette['http_interactions']:
+            response = interaction['response']
+            body = response['body']
+            if 'base64_string' in body:
+                content = b64decode(body['base64_string'])
+            else:
+                content = body['string'].encode(body['encoding'])
+            if 'gzip' in response['headers'].get('Content-Encoding', []):
+                content = gzip.GzipFile(fileobj=StringIO(content)).read()
+            yield content
+
+
+def best_time(func, number=20):
+    """Return the best average time in milliseconds of *func*."""
+    return min(repeat(func, number=number, repeat=3)) / number * 1000
+
+
+def main():
+    variants = [('full, {}'.format(DEFAULT_BS4_PARSER), None, None),
+                ('full, {}'.format(FAST_BS4_PARSER), None, FAST_BS4_PARSER),
+                ('target, {}'.format(DEFAULT_BS4_PARSER), True, None),
+                ('target, {}'.format(FAST_BS4_PARSER), True, FAST_BS4_PARSER)]
+    for plugin, target in sorted(TARGETS.iteritems()):
+        bodies = list(response_bodies(plugin))
+        size = sum(len(body) for body in bodies)
+        print '{} ({} pages, {:,} bytes):'.format(plugin, len(bodies), size)
+        for label, only, parser in variants:
+            only = target if only else None
+            elapsed = best_time(
+                lambda: [parse(body, only=only, parser=parser)
+                         for body in bodies])
+            print '    {:<24} {:8.2f} ms'.format(label, elapsed)
+
+
+if __name__ == '__main__':
+    main()
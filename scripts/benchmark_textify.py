@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Compare `textify` against its original recursive implementation on
+the pages recorded in the test cassettes."""
+
+
+from bs4 import NavigableString
+
+from omnipresence.web.html import FAST_BS4_PARSER, parse, textify
+
+from benchmark_html import TARGETS, best_time, response_bodies
+
+
+def recursive_textify(soup, format_output=True):
+    """The original implementation of `textify`, for comparison."""
+    def descend(soup):
+        if not format_output:
+            return u''.join(soup.strings)
+        if soup.name in (u'b', u'strong'):
+            fmt = u'\x02{0}\x02'
+        elif soup.name in (u'i', u'u', u'em', u'cite', u'var'):
+            fmt = u'\x16{0}\x16'
+        elif soup.name == u'sup':
+            fmt = u'^{0}'
+        elif soup.name == u'sub':
+            fmt = u'_{0}'
+        else:
+            fmt = u'{0}'
+        text = u''
+        for k in soup.children:
+            if isinstance(k, NavigableString):
+                text += unicode(k)
+            else:
+                text += descend(k)
+        return fmt.format(text)
+    return u' '.join(descend(soup).split()).strip()
+
+
+def main():
+    for plugin in sorted(TARGETS):
+        soups = [parse(body, parser=FAST_BS4_PARSER)
+                 for body in response_bodies(plugin)]
+        for soup in soups:
+            assert textify(soup) == recursive_textify(soup)
+        print '{} ({} pages):'.format(plugin, len(soups))
+        for label, func in (('recursive', recursive_textify),
+                            ('iterative', textify)):
+            elapsed = best_time(lambda: [func(soup) for soup in soups])
+            print '    {:<24} {:8.2f} ms'.format(label, elapsed)
+    soup = parse(u'<div>' + u'<b>lorem <i>ipsum</i> dolor</b> ' * 20000 +
+                 u'</div>', parser=FAST_BS4_PARSER)
+    print 'single large element:'
+    for label, func in (('recursive', recursive_textify),
+                        ('iterative', textify)):
+        print '    {:<24} {:8.2f} ms'.format(
+            label, best_time(lambda: func(soup), number=3))
+
+
+if __name__ == '__main__':
+    main()
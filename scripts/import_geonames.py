@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""Build an offline index for the geonames plugins from GeoNames dump
+files, such as those at <http://download.geonames.org/export/dump/>."""
+
+
+import argparse
+import io
+
+from omnipresence.plugins.geonames import GeoNamesIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('places', nargs='+',
+                        help='place dump files, such as cities15000.txt')
+    parser.add_argument('--countries', metavar='countryInfo.txt',
+                        help='country information file')
+    parser.add_argument('--admin1', metavar='admin1CodesASCII.txt',
+                        help='first-level administrative division file')
+    parser.add_argument('--index', required=True,
+                        help='path to the index to create or update')
+    args = parser.parse_args()
+    index = GeoNamesIndex(args.index)
+    countries = admin1_codes = ()
+    if args.countries:
+        countries = io.open(args.countries, encoding='utf-8').readlines()
+    if args.admin1:
+        admin1_codes = io.open(args.admin1, encoding='utf-8').readlines()
+    for path in args.places:
+        with io.open(path, encoding='utf-8') as places:
+            count = index.load(places, countries, admin1_codes)
+        print '{}: {} places'.format(path, count)
+
+
+if __name__ == '__main__':
+    main()
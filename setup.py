@@ -44,7 +44,7 @@ setup(
         'twisted': [
             'plugins/omnipresence_plugin.py']},
     install_requires=[
-        'Twisted>=15.3.0',
+        'Twisted>=16.5.0',
         'pyOpenSSL',
         'service_identity',
         'ipaddress',
@@ -52,7 +52,10 @@ setup(
         'enum34'],
     extras_require={
         'html': [
-            'beautifulsoup4']},
+            'beautifulsoup4'],
+        'lxml': [
+            'beautifulsoup4',
+            'lxml']},
     tests_require=[
         'tox'],
     cmdclass={